@@ -5,7 +5,11 @@ export const users = {
     namespaced: true,
     state: () => ({
         users: [],
-        usersLoading: true
+        usersLoading: true,
+        searchResults: [],
+        searchQuery: '',
+        searchCursor: null,
+        searchLoading: false
     }),
     mutations: {
         set(state, users) {
@@ -13,6 +17,23 @@ export const users = {
         },
         setLoading(state, loading) {
             state.usersLoading = loading;
+        },
+        setSearchQuery(state, query) {
+            state.searchQuery = query;
+        },
+        setSearch(state, { users, cursor }) {
+            state.searchResults = users;
+            state.searchCursor = cursor;
+        },
+        appendSearch(state, { users, cursor }) {
+            let known = new Set(state.searchResults.map(u => u.username));
+            state.searchResults = state.searchResults.concat(
+                users.filter(u => !known.has(u.username))
+            );
+            state.searchCursor = cursor;
+        },
+        setSearchLoading(state, loading) {
+            state.searchLoading = loading;
         }
     },
     actions: {
@@ -29,11 +50,57 @@ export const users = {
                     Sentry.captureException(error);
                     if (error.response.status === 500) throw error;
                 });
+        },
+        async search({ commit, state }, query) {
+            commit('setSearchQuery', query);
+            commit('setSearchLoading', true);
+            await axios
+                .get('/apis/v1/users/search/', { params: { query: query } })
+                .then(response => {
+                    // a later search may have been sent while this one was in flight
+                    if (state.searchQuery !== query) return;
+                    commit('setSearch', {
+                        users: response.data.users,
+                        cursor: response.data.cursor
+                    });
+                    commit('setSearchLoading', false);
+                })
+                .catch(error => {
+                    commit('setSearchLoading', false);
+                    Sentry.captureException(error);
+                    if (error.response.status === 500) throw error;
+                });
+        },
+        async searchMore({ commit, state }) {
+            if (state.searchCursor === null) return;
+            commit('setSearchLoading', true);
+            await axios
+                .get('/apis/v1/users/search/', {
+                    params: {
+                        query: state.searchQuery,
+                        cursor: state.searchCursor
+                    }
+                })
+                .then(response => {
+                    commit('appendSearch', {
+                        users: response.data.users,
+                        cursor: response.data.cursor
+                    });
+                    commit('setSearchLoading', false);
+                })
+                .catch(error => {
+                    commit('setSearchLoading', false);
+                    Sentry.captureException(error);
+                    if (error.response.status === 500) throw error;
+                });
         }
     },
     getters: {
         allUsers: state => state.users,
-        usersLoading: state => state.usersLoading
+        usersLoading: state => state.usersLoading,
+        searchResults: state => state.searchResults,
+        searchCursor: state => state.searchCursor,
+        searchLoading: state => state.searchLoading
         // TODO add 'developers' (users who've contributed workflows)
     }
 };
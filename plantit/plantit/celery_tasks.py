@@ -2,6 +2,7 @@ import base64
 import json
 import tempfile
 import traceback
+from contextlib import contextmanager
 from datetime import timedelta
 from os import environ
 from os.path import join
@@ -12,6 +13,7 @@ from celery import group
 from celery.utils.log import get_task_logger
 from czifile import czifile
 from django.contrib.auth.models import User
+from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
 from preview_generator.exception import UnsupportedMimeType
 from preview_generator.manager import PreviewManager
@@ -19,20 +21,40 @@ from preview_generator.manager import PreviewManager
 from plantit import settings
 from plantit.agents.models import AgentExecutor
 from plantit.celery import app
-from plantit.github import get_repo
-from plantit.redis import RedisClient
+from plantit.github import background_priority, RateLimited
+from plantit.redis import RedisClient, encode
 from plantit.sns import SnsClient
 from plantit.ssh import execute_command
 from plantit.tasks.models import Task, TaskStatus, JobQueueTask
 from plantit.utils import log_task_status, push_task_event, get_task_ssh_client, configure_local_task_environment, execute_local_task, \
     submit_jobqueue_task, \
     get_jobqueue_task_job_status, get_jobqueue_task_job_walltime, get_task_container_logs, remove_task_orchestration_logs, get_task_result_files, \
-    repopulate_personal_workflow_cache, repopulate_public_workflow_cache, calculate_user_statistics, repopulate_institutions_cache, \
-    configure_jobqueue_task_environment
+    repopulate_personal_workflow_cache, repopulate_public_workflow_cache, refresh_workflow_cache, repopulate_user_cache, update_user_statistics, repopulate_institutions_cache, \
+    configure_jobqueue_task_environment, get_user_cyverse_token, CYVERSE_TOKEN_REFRESH_WINDOW, get_user_cyverse_profile, get_github_profile, \
+    uncache_profile
 
 logger = get_task_logger(__name__)
 
 
+@contextmanager
+def github_refresh(what: str):
+    # background refreshes yield to interactive requests, and are skipped (leaving the cache as is) if they'd run into the rate limit
+    with background_priority():
+        try:
+            yield
+        except RateLimited as e:
+            logger.warning(f"Skipping refresh of {what}, keeping what's cached: {e}")
+
+
+def get_github_token(username: str):
+    # GitHub tokens are looked up by the worker rather than passed as task arguments, which are kept in the broker and logged
+    try:
+        return User.objects.select_related('profile').get(username=username).profile.github_token
+    except ObjectDoesNotExist:
+        logger.warning(f"User {username} not found")
+        return None
+
+
 @app.task(track_started=True)
 def submit_task(guid: str, auth: dict):
     try:
@@ -245,12 +267,7 @@ def list_task_results(guid: str, auth: dict):
     redis = RedisClient.get()
     ssh = get_task_ssh_client(task, auth)
     previews = PreviewManager(join(settings.MEDIA_ROOT, task.guid), create_folder=True)
-    workflow = redis.get(f"workflows/{task.workflow_owner}/{task.workflow_name}")
-
-    if workflow is None:
-        workflow = get_repo(task.workflow_owner, task.workflow_name, task.user.profile.github_token)['config']
-    else:
-        workflow = json.loads(workflow)['config']
+    workflow = task.workflow['config']  # the configuration the task actually ran with
 
     log_task_status(task, [f"Retrieving logs"])
     async_to_sync(push_task_event)(task)
@@ -263,7 +280,7 @@ def list_task_results(guid: str, auth: dict):
     expected = get_task_result_files(task, workflow, auth)
     found = [e for e in expected if e['exists']]
     workdir = join(task.agent.workdir, task.workdir)
-    redis.set(f"results/{task.guid}", json.dumps(expected))
+    redis.set(f"results/{task.guid}", encode(expected))
 
     log_task_status(task, [f"Expected {len(expected)} result(s), found {len(found)}"])
     async_to_sync(push_task_event)(task)
@@ -500,23 +517,74 @@ def list_task_results(guid: str, auth: dict):
 @app.task()
 def aggregate_user_statistics():
     users = User.objects.all()
-    for user in users:
-        logger.info(f"Aggregating usage statistics for {user.username}")
-        stats = async_to_sync(calculate_user_statistics)(user)
-        redis = RedisClient.get()
-        redis.set(f"stats/{user.username}", json.dumps(stats))
-        user.profile.stats_last_aggregated = timezone.now()
-        user.profile.save()
+    for user in users: update_user_statistics(user)
+
+
+@app.task()
+def refresh_user_statistics(username: str):
+    try:
+        user = User.objects.get(username=username)
+    except:
+        logger.warning(f"User {username} not found")
+        return
+
+    update_user_statistics(user)
+
+
+@app.task()
+def refresh_cyverse_profile(username: str):
+    try:
+        user = User.objects.get(username=username)
+    except:
+        logger.warning(f"User {username} not found")
+        return
+
+    try:
+        get_user_cyverse_profile(user, refresh=True)
+    except ValueError as e:
+        # drop the stale profile, so the user's next page load asks Terrain inline (and logs them out if their token's invalid)
+        logger.warning(f"Failed to refresh CyVerse profile for {username}: {e}")
+        uncache_profile('cyverse', username)
+
+
+@app.task()
+def refresh_github_profile(owner: str, username: str):
+    try:
+        user = User.objects.select_related('profile').get(username=username)
+    except User.DoesNotExist:
+        logger.warning(f"User {username} not found")
+        return
+
+    with github_refresh(f"GitHub profile {owner}"):
+        async_to_sync(get_github_profile)(owner, user, refresh=True)
+
+
+@app.task()
+def refresh_users(username: str):
+    token = get_github_token(username)
+    if token is None: return
+    with github_refresh("users"):
+        async_to_sync(repopulate_user_cache)(token)
 
 
 @app.task()
 def refresh_personal_workflows(owner: str):
-    repopulate_personal_workflow_cache(owner)
+    with github_refresh(f"{owner}'s workflows"):
+        async_to_sync(repopulate_personal_workflow_cache)(owner)
+
+
+@app.task()
+def refresh_workflow(owner: str, name: str):
+    with github_refresh(f"workflow {owner}/{name}"):
+        async_to_sync(refresh_workflow_cache)(owner, name)
 
 
 @app.task()
-def refresh_all_workflows(token: str):
-    repopulate_public_workflow_cache(token)
+def refresh_all_workflows(username: str):
+    token = get_github_token(username)
+    if token is None: return
+    with github_refresh("public workflows"):
+        async_to_sync(repopulate_public_workflow_cache)(token)
 
 
 @app.task()
@@ -532,20 +600,20 @@ def refresh_user_cyverse_tokens(username: str):
         logger.warning(f"User {username} not found")
         return
 
-    refresh_user_cyverse_tokens(user)
+    # only refresh if the token would otherwise expire before the next scheduled refresh
+    get_user_cyverse_token(user, refresh_window=int(settings.CYVERSE_TOKEN_REFRESH_MINUTES) * 60 + CYVERSE_TOKEN_REFRESH_WINDOW)
 
 
 @app.task()
 def refresh_all_user_cyverse_tokens():
-    tasks = Task.objects.filter(status=TaskStatus.RUNNING)
-    users = [task.user for task in list(tasks)]
+    usernames = set(Task.objects.filter(status=TaskStatus.RUNNING).values_list('user__username', flat=True))
 
-    if len(users) == 0:
+    if len(usernames) == 0:
         logger.info(f"No users with running tasks, not refreshing CyVerse tokens")
         return
 
-    group([refresh_user_cyverse_tokens.s(user.username) for user in users])()
-    logger.info(f"Refreshed CyVerse tokens for {len(users)} user(s)")
+    group([refresh_user_cyverse_tokens.s(username) for username in usernames])()
+    logger.info(f"Checked CyVerse tokens for {len(usernames)} user(s)")
 
 
 # see https://stackoverflow.com/a/41119054/6514033
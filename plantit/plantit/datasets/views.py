@@ -13,7 +13,7 @@ from django.http import HttpResponseNotFound, HttpResponseBadRequest, JsonRespon
 from django.utils import timezone
 
 from plantit.datasets.models import DatasetAccessPolicy, DatasetRole
-from plantit.utils import dataset_access_policy_to_dict
+from plantit.utils import dataset_access_policy_to_dict, get_user_cyverse_token
 
 
 @login_required
@@ -29,7 +29,7 @@ async def shared(request):  # directories shared with the current user
     policies = await sync_to_async(list)(DatasetAccessPolicy.objects.filter(guest=request.user))
     urls = [f"https://de.cyverse.org/terrain/secured/filesystem/paged-directory?limit=1000&path={policy.path}" for policy in policies]
     headers = {
-        "Authorization": f"Bearer {request.user.profile.cyverse_access_token}",
+        "Authorization": f"Bearer {await sync_to_async(get_user_cyverse_token)(request.user)}",
     }
     async with httpx.AsyncClient(headers=headers) as client:
         tasks = [client.get(url).json() for url in urls]
@@ -1,22 +1,172 @@
+import asyncio
+import json
+import logging
+import time
+import weakref
+from os import environ
+
+import httpx
 import requests
 
-from requests import RequestException, ReadTimeout, Timeout, HTTPError
-from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
+from redis import RedisError
+
+from plantit.loops import BackgroundLoop
+from plantit.redis import RedisClient
+
+logger = logging.getLogger(__name__)
+
+# how long to trust Docker Hub lookups: found images rarely disappear, while missing ones may be pushed any minute
+DOCKER_IMAGE_CACHE_TTL = int(environ.get('DOCKER_IMAGE_CACHE_TTL', 60 * 60 * 24))  # seconds
+DOCKER_IMAGE_MISSING_TTL = int(environ.get('DOCKER_IMAGE_MISSING_TTL', 60 * 5))  # seconds
+
+# how long to keep lookups past their TTL, to fall back on when Docker Hub is unreachable or rate-limiting us
+DOCKER_IMAGE_STALE_TTL = int(environ.get('DOCKER_IMAGE_STALE_TTL', 60 * 60 * 24 * 30))  # seconds
+
+# lookups happen while users wait (e.g., submitting a task), so give up on Docker Hub quickly rather than retrying
+DOCKER_HUB_TIMEOUT = float(environ.get('DOCKER_HUB_TIMEOUT', 5))  # seconds
+
+# async lookups run on a background loop, so they share a client whichever loop they're made from (see `BackgroundLoop`)
+_background = BackgroundLoop('docker')
+
+# httpx connections are bound to the event loop they were opened on (only ever the background loop, though a forked process starts a new one)
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def async_client() -> httpx.AsyncClient:
+    loop = asyncio.get_event_loop()
+    client = _async_clients.get(loop, None)
+    if client is None:
+        client = httpx.AsyncClient(timeout=DOCKER_HUB_TIMEOUT)
+        _async_clients[loop] = client
+    return client
 
 
-@retry(
-    wait=wait_exponential(multiplier=1, min=4, max=10),
-    stop=stop_after_attempt(3),
-    retry=(retry_if_exception_type(ConnectionError) | retry_if_exception_type(
-        RequestException) | retry_if_exception_type(ReadTimeout) | retry_if_exception_type(
-        Timeout) | retry_if_exception_type(HTTPError)))
 def image_exists(name, owner=None, tag=None):
+    """
+    Returns: True if the image exists, False if it doesn't, or None if Docker Hub couldn't tell us and we've never asked before.
+    """
+
+    return get_image(name, owner, tag)['exists']
+
+
+async def image_exists_async(name, owner=None, tag=None):
+    return (await get_image_async(name, owner, tag))['exists']
+
+
+def get_image(name, owner=None, tag=None) -> dict:
+    """
+    Looks up an image (or one of its tags) on Docker Hub, answering from cache while the last lookup is fresh
+    (`DOCKER_IMAGE_CACHE_TTL` if the image was found, `DOCKER_IMAGE_MISSING_TTL` if not). If Docker Hub can't be reached (or is rate
+    limiting us), falls back to the last lookup, however old, or if there is none, reports the image's existence as unknown. Callers
+    shouldn't reject an image on that account.
+
+    Returns: A dict with keys 'exists' (None if unknown), 'digest' (for tags, if Docker Hub reports one), 'last_updated' and 'checked'
+    (a timestamp).
+    """
+
+    key = image_key(name, owner, tag)
+    cached = get_cached_image(key)
+    if cached is not None and image_fresh(cached): return cached
+
+    try:
+        image = fetch_image(name, owner, tag)
+    except Exception as e:
+        return image_fallback(key, cached, e)
+
+    set_cached_image(key, image)
+    return image
+
+
+async def get_image_async(name, owner=None, tag=None) -> dict:
+    key = image_key(name, owner, tag)
+    cached = get_cached_image(key)
+    if cached is not None and image_fresh(cached): return cached
+
+    try:
+        image = await fetch_image_async(name, owner, tag)
+    except Exception as e:
+        return image_fallback(key, cached, e)
+
+    set_cached_image(key, image)
+    return image
+
+
+def image_fallback(key: str, cached: dict, error: Exception) -> dict:
+    if cached is not None:
+        logger.warning(f"Failed to look up image {key} on Docker Hub, using lookup from {int(time.time() - cached['checked'])}s ago: {error}")
+        return cached
+
+    # not cached, since it's no answer
+    logger.warning(f"Failed to look up image {key} on Docker Hub, existence unknown: {error}")
+    return {
+        'exists': None,
+        'digest': None,
+        'last_updated': None,
+        'checked': time.time()
+    }
+
+
+def fetch_image(name, owner=None, tag=None) -> dict:
+    response = requests.get(image_url(name, owner, tag), timeout=DOCKER_HUB_TIMEOUT)
+    if response.status_code != 404: response.raise_for_status()  # rate limits and outages aren't answers, so don't cache them
+    return image_metadata(response.status_code, response.json, name, owner, tag)
+
+
+async def fetch_image_async(name, owner=None, tag=None) -> dict:
+    async def get(): return await async_client().get(image_url(name, owner, tag))
+    response = await _background.run(get())
+    if response.status_code != 404: response.raise_for_status()
+    return image_metadata(response.status_code, response.json, name, owner, tag)
+
+
+def image_metadata(status_code, json_content, name, owner=None, tag=None) -> dict:
+    found = status_code == 200 and image_found(json_content, name, owner, tag)
+    content = json_content() if found else dict()
+    digest = content.get('digest', None)
+    images = content.get('images', None) or []
+    if digest is None and len(images) == 1: digest = images[0].get('digest', None)  # single-platform tag
+    return {
+        'exists': found,
+        'digest': digest,
+        'last_updated': content.get('last_updated', None),
+        'checked': time.time()
+    }
+
+
+def image_key(name, owner=None, tag=None):
+    return f"docker_images/{owner if owner is not None else 'library'}/{name}" + (f":{tag}" if tag is not None else '')
+
+
+def image_fresh(image: dict) -> bool:
+    return (time.time() - image['checked']) < (DOCKER_IMAGE_CACHE_TTL if image['exists'] else DOCKER_IMAGE_MISSING_TTL)
+
+
+def get_cached_image(key: str):
+    try:
+        cached = RedisClient.get().get(key)
+        return json.loads(cached) if cached is not None else None
+    except RedisError as e:
+        logger.warning(f"Docker image cache unavailable: {e}")
+        return None
+
+
+def set_cached_image(key: str, image: dict):
+    try:
+        RedisClient.get().set(key, json.dumps(image), ex=DOCKER_IMAGE_STALE_TTL)
+    except RedisError as e:
+        logger.warning(f"Failed to cache Docker image lookup: {e}")
+
+
+def image_url(name, owner=None, tag=None):
     url = f"https://hub.docker.com/v2/repositories/{owner if owner is not None else 'library'}/{name}/"
     if tag is not None:
         url += f"tags/{tag}/"
-    response = requests.get(url)
+    return url
+
+
+def image_found(json_content, name, owner=None, tag=None):
     try:
-        content = response.json()
+        content = json_content()
         if 'user' not in content and 'name' not in content:
             return False
         if content['name'] != tag and content['name'] != name and content['user'] != (owner if owner is not None else 'library'):
@@ -1,20 +1,248 @@
 import asyncio
+import hashlib
+import json
 import logging
-from typing import List
+import time
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import environ
+from typing import List, AsyncIterator, Dict, Tuple
 
 import httpx
-import requests
 import yaml
+from redis import RedisError
 from requests import RequestException, ReadTimeout, Timeout, HTTPError
-from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
+from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type, RetryError
 
-from plantit.docker import parse_image_components, image_exists
-from plantit.terrain import path_exists
+from plantit.docker import parse_image_components, image_exists, image_exists_async
+from plantit.loops import BackgroundLoop
+from plantit.redis import RedisClient
+from plantit.terrain import path_exists, path_exists_async
 
 logger = logging.getLogger(__name__)
 
+# how long to keep response bodies (with their ETag/Last-Modified validators) for conditional requests
+GITHUB_CONDITIONAL_CACHE_TTL = int(environ.get('GITHUB_CONDITIONAL_CACHE_TTL', 60 * 60 * 24 * 7))  # seconds
+
+# max concurrent GitHub requests per process, and how many of those background refreshes may occupy
+GITHUB_CONCURRENCY = int(environ.get('GITHUB_CONCURRENCY', 8))
+GITHUB_BACKGROUND_CONCURRENCY = int(environ.get('GITHUB_BACKGROUND_CONCURRENCY', 4))
+
+# background requests pause once a token's remaining rate limit budget drops to this, leaving the rest for interactive requests
+GITHUB_RATE_LIMIT_RESERVE = int(environ.get('GITHUB_RATE_LIMIT_RESERVE', 200))
+
+# the longest a request will wait for the rate limit to reset before giving up
+GITHUB_RATE_LIMIT_MAX_WAIT = int(environ.get('GITHUB_RATE_LIMIT_MAX_WAIT', 60))  # seconds
+
+# how many repositories to request per GraphQL query
+GITHUB_GRAPHQL_BATCH_SIZE = int(environ.get('GITHUB_GRAPHQL_BATCH_SIZE', 25))
+
+class RateLimited(Exception):
+    """
+    Raised instead of waiting when a token's rate limit won't reset within `GITHUB_RATE_LIMIT_MAX_WAIT` seconds. This says nothing
+    about the repository or user requested, so callers refreshing a cache should skip the refresh and keep what's cached.
+    """
+
+    pass
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Whether an error says only that GitHub (or another service a workflow references) couldn't be asked right now: the rate limit is
+    exhausted, the network failed, or the service answered with a 5xx. Unlike a missing or malformed `plantit.yaml`, such an error says
+    nothing about the repository, so a cache refresh should give up and keep what's cached instead of caching a placeholder.
+    """
+
+    if isinstance(error, RetryError): error = error.last_attempt.exception()
+    if isinstance(error, (RateLimited, httpx.TransportError, Timeout)): return True
+    if isinstance(error, (httpx.HTTPStatusError, HTTPError)) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code in (403, 429)
+    return False
+
+
+# requests made in a `background_priority()` block (e.g., periodic cache refreshes) yield to interactive ones
+request_priority = ContextVar('github_request_priority', default='interactive')
+
+
+@contextmanager
+def background_priority():
+    reset = request_priority.set('background')
+    try:
+        yield
+    finally:
+        request_priority.reset(reset)
+
+
+class GitHubClient:
+    """
+    Holds a pooled `httpx` client shared by all GitHub calls in this process, and schedules requests against each token's rate
+    limit budget as reported by GitHub's `X-RateLimit-*` headers. Requests are bounded by `GITHUB_CONCURRENCY`; background requests
+    get at most `GITHUB_BACKGROUND_CONCURRENCY` of those slots and stop short of `GITHUB_RATE_LIMIT_RESERVE`. The client (and its
+    semaphores) live on a background event loop, so they outlast callers' loops (see `BackgroundLoop`).
+    """
+
+    __background = BackgroundLoop('github')
+    __loops = weakref.WeakKeyDictionary()
+    __budgets = {}
+
+    @staticmethod
+    def __loop_state():
+        # httpx connections and asyncio semaphores are bound to the loop they were created on (only ever the background loop,
+        # though a forked process starts a new one)
+        loop = asyncio.get_event_loop()
+        state = GitHubClient.__loops.get(loop, None)
+        if state is None:
+            client = httpx.AsyncClient(limits=httpx.Limits(max_connections=GITHUB_CONCURRENCY, max_keepalive_connections=GITHUB_CONCURRENCY))
+            state = (client, asyncio.Semaphore(GITHUB_CONCURRENCY), asyncio.Semaphore(GITHUB_BACKGROUND_CONCURRENCY))
+            GitHubClient.__loops[loop] = state
+        return state
+
+    @staticmethod
+    async def request(method: str, url: str, token: str = '', headers: dict = None, **kwargs) -> httpx.Response:
+        headers = dict(headers) if headers is not None else dict()
+        if token != '': headers['Authorization'] = f"token {token}"
+        resource = 'search' if '/search/' in url else 'graphql' if url.endswith('/graphql') else 'core'
+        budget = (hashlib.sha256(token.encode()).hexdigest()[:16], resource)
+        background = request_priority.get() == 'background'  # read here, since context variables don't follow to the background loop
+        return await GitHubClient.__background.run(GitHubClient.__send(method, url, headers, budget, background, **kwargs))
+
+    @staticmethod
+    async def __send(method: str, url: str, headers: dict, budget: tuple, background: bool, **kwargs) -> httpx.Response:
+        client, slots, background_slots = GitHubClient.__loop_state()
+
+        # wait for the budget before taking a slot, so requests with budget to spare aren't held up behind those without
+        await GitHubClient.__wait_for_budget(budget, url, background)
+        if background: await background_slots.acquire()
+        try:
+            async with slots:
+                response = await client.request(method, url, headers=headers, **kwargs)
+                GitHubClient.__update_budget(budget, response)
+                return response
+        finally:
+            if background: background_slots.release()
+
+    @staticmethod
+    async def __wait_for_budget(budget: tuple, url: str, background: bool):
+        if budget not in GitHubClient.__budgets: return
+        remaining, reset = GitHubClient.__budgets[budget]
+        wait = reset - time.time()
+        if remaining <= (GITHUB_RATE_LIMIT_RESERVE if background else 0) and wait > 0:
+            if wait > GITHUB_RATE_LIMIT_MAX_WAIT:
+                raise RateLimited(f"GitHub rate limit exhausted ({remaining} requests remaining), not requesting {url} until reset in {int(wait)}s")
+            logger.warning(f"GitHub rate limit nearly exhausted ({remaining} requests remaining), waiting {int(wait)}s for reset before requesting {url}")
+            await asyncio.sleep(wait)
+            return
+
+        # count the request against the budget now, so concurrent requests see it before GitHub's response headers arrive
+        GitHubClient.__budgets[budget] = (remaining - 1, reset)
+
+    @staticmethod
+    def __update_budget(budget: tuple, response: httpx.Response):
+        headers = response.headers
+        if 'Retry-After' in headers and response.status_code in (403, 429):
+            # secondary (abuse) rate limit
+            GitHubClient.__budgets[budget] = (0, time.time() + int(headers['Retry-After']))
+        elif 'X-RateLimit-Remaining' in headers and 'X-RateLimit-Reset' in headers:
+            GitHubClient.__budgets[budget] = (int(headers['X-RateLimit-Remaining']), float(headers['X-RateLimit-Reset']))
+
+    @staticmethod
+    def budgets() -> dict:
+        return {f"{scope}/{resource}": {'remaining': remaining, 'reset': reset}
+                for (scope, resource), (remaining, reset) in GitHubClient.__budgets.items()}
+
+
+async def conditional_get(url: str, token: str = '', headers: dict = None) -> httpx.Response:
+    """
+    Makes a conditional GET request, sending the ETag and Last-Modified validators stored with the body of the last successful response.
+    If GitHub responds 304 Not Modified (which doesn't count against the primary rate limit), the cached body is returned in a 200 response.
+    Cached bodies are scoped to the (hashed) token they were fetched with, since what GitHub returns depends on who is asking.
+    """
+
+    headers = dict(headers) if headers is not None else dict()
+    scope = hashlib.sha256(token.encode()).hexdigest()[:16]
+    key = f"github_responses/{scope}/{hashlib.sha256((url + headers.get('Accept', '')).encode()).hexdigest()}"
+
+    try:
+        redis = RedisClient.get()
+        cached = redis.hgetall(key)
+    except RedisError as e:
+        logger.warning(f"GitHub response cache unavailable: {e}")
+        return await GitHubClient.request('GET', url, token, headers)
+
+    if b'etag' in cached: headers['If-None-Match'] = cached[b'etag'].decode()
+    if b'last_modified' in cached: headers['If-Modified-Since'] = cached[b'last_modified'].decode()
+    response = await GitHubClient.request('GET', url, token, headers)
+
+    try:
+        if response.status_code == 304 and b'body' in cached:
+            redis.expire(key, GITHUB_CONDITIONAL_CACHE_TTL)
+            return httpx.Response(200, headers=response.headers, content=cached[b'body'], request=response.request)
+        elif response.status_code == 200 and ('ETag' in response.headers or 'Last-Modified' in response.headers):
+            entry = {'body': response.content}
+            if 'ETag' in response.headers: entry['etag'] = response.headers['ETag']
+            if 'Last-Modified' in response.headers: entry['last_modified'] = response.headers['Last-Modified']
+            redis.pipeline().delete(key).hset(key, mapping=entry).expire(key, GITHUB_CONDITIONAL_CACHE_TTL).execute()
+    except RedisError as e:
+        logger.warning(f"Failed to cache GitHub response: {e}")
+
+    return response
+
 
 def validate_repo_config(config: dict, token: str) -> (bool, List[str]):
+    errors = validate_repo_config_schema(config)
+    image, input_path = get_repo_config_remote_refs(config)
+
+    if image is not None and image_exists(image[1], image[0], image[2]) is False:
+        errors.append(f"Image '{config['image']}' not found on Docker Hub")
+    if input_path is not None:
+        cyverse_path_result = path_exists(input_path, token)
+        if type(cyverse_path_result) is bool and not cyverse_path_result:
+            errors.append('Attribute \'input.path\' must be a str (either empty or a valid path in the CyVerse Data Store)')
+
+    return (True, []) if len(errors) == 0 else (False, errors)
+
+
+async def validate_repo_config_async(config: dict, token: str) -> (bool, List[str]):
+    errors = validate_repo_config_schema(config) + await check_repo_config_remote_refs(config, token)
+    return (True, []) if len(errors) == 0 else (False, errors)
+
+
+async def check_repo_config_remote_refs(config: dict, token: str) -> List[str]:
+    errors = []
+    image, input_path = get_repo_config_remote_refs(config)
+
+    # check the image and input path concurrently
+    async def false(): return False
+    image_exists_result, cyverse_path_result = await asyncio.gather(
+        image_exists_async(image[1], image[0], image[2]) if image is not None else false(),
+        path_exists_async(input_path, token) if input_path is not None else false())
+
+    if image is not None and image_exists_result is False:
+        errors.append(f"Image '{config['image']}' not found on Docker Hub")
+    if input_path is not None and type(cyverse_path_result) is bool and not cyverse_path_result:
+        errors.append('Attribute \'input.path\' must be a str (either empty or a valid path in the CyVerse Data Store)')
+
+    return errors
+
+
+def get_repo_config_remote_refs(config: dict) -> (tuple, str):
+    """
+    Finds the references in a workflow configuration which must be checked remotely: the Docker image (as owner, name and tag) and the input path.
+    """
+
+    image = None
+    if 'image' in config and type(config['image']) is str and 'docker' in config['image']:
+        image = parse_image_components(config['image'])
+
+    input_path = None
+    if 'input' in config and config['input'].get('path', None) not in ('', None):
+        input_path = config['input']['path']
+
+    return image, input_path
+
+
+def validate_repo_config_schema(config: dict) -> List[str]:
     errors = []
 
     # name (required)
@@ -34,10 +262,6 @@ def validate_repo_config(config: dict, token: str) -> (bool, List[str]):
         errors.append('Missing attribute \'image\'')
     elif type(config['image']) is not str:
         errors.append('Attribute \'image\' must be a str')
-    else:
-        image_owner, image_name, image_tag = parse_image_components(config['image'])
-        if 'docker' in config['image'] and not image_exists(image_name, image_owner, image_tag):
-            errors.append(f"Image '{config['image']}' not found on Docker Hub")
 
     # commands (required)
     if 'commands' not in config:
@@ -78,10 +302,6 @@ def validate_repo_config(config: dict, token: str) -> (bool, List[str]):
         # path
         if 'path' not in config['input']:
             errors.append('Missing attribute \'input.path\'')
-        if config['input']['path'] != '' and config['input']['path'] is not None:
-            cyverse_path_result = path_exists(config['input']['path'], token)
-            if type(cyverse_path_result) is bool and not cyverse_path_result:
-                errors.append('Attribute \'input.path\' must be a str (either empty or a valid path in the CyVerse Data Store)')
 
         # kind
         if 'kind' not in config['input']:
@@ -148,7 +368,7 @@ def validate_repo_config(config: dict, token: str) -> (bool, List[str]):
         if type(walltime) is str and not bool(pattern.match(walltime)):
             errors.append('Attribute \'walltime\' must have format XX:XX:XX')
 
-    return (True, []) if len(errors) == 0 else (False, errors)
+    return errors
 
 
 @retry(
@@ -158,11 +378,9 @@ def validate_repo_config(config: dict, token: str) -> (bool, List[str]):
         RequestException) | retry_if_exception_type(ReadTimeout) | retry_if_exception_type(
         Timeout) | retry_if_exception_type(HTTPError)))
 async def get_profile(owner: str, token: str) -> dict:
-    headers = {'Authorization': f"Bearer {token}"}
-    async with httpx.AsyncClient(headers=headers) as client:
-        response = await client.get(f"https://api.github.com/users/{owner}")
-        if response.status_code == 200: return response.json()
-        else: raise ValueError(f"Bad response from GitHub for user {owner}: {response.status_code}")
+    response = await conditional_get(f"https://api.github.com/users/{owner}", token)
+    if response.status_code == 200: return response.json()
+    else: raise ValueError(f"Bad response from GitHub for user {owner}: {response.status_code}")
 
 
 @retry(
@@ -173,19 +391,12 @@ async def get_profile(owner: str, token: str) -> dict:
         Timeout) | retry_if_exception_type(HTTPError)))
 async def get_repo(owner: str, name: str, token: str) -> dict:
     headers = {
-        "Authorization": f"token {token}",
         "Accept": "application/vnd.github.mercy-preview+json"  # so repo topics will be returned
     }
-    async with httpx.AsyncClient(headers=headers) as client:
-        response = await client.get(
-            f"https://api.github.com/repos/{owner}/{name}",
-            headers={
-                "Authorization": f"token {token}",
-                "Accept": "application/vnd.github.mercy-preview+json"  # so repo topics will be returned
-            })
-        repo = response.json()
-        if 'message' in repo and repo['message'] == 'Not Found': raise ValueError(f"Repo {owner}/{name} not found")
-        return repo
+    response = await conditional_get(f"https://api.github.com/repos/{owner}/{name}", token, headers)
+    if response.status_code == 404: raise ValueError(f"Repo {owner}/{name} not found")
+    response.raise_for_status()
+    return response.json()
 
 
 @retry(
@@ -194,21 +405,13 @@ async def get_repo(owner: str, name: str, token: str) -> dict:
     retry=(retry_if_exception_type(ConnectionError) | retry_if_exception_type(
         RequestException) | retry_if_exception_type(ReadTimeout) | retry_if_exception_type(
         Timeout) | retry_if_exception_type(HTTPError)))
-def get_repo_readme(owner: str, name: str, token: str) -> str:
-    # TODO refactor to use asyncx
-    try:
-        url = f"https://api.github.com/repos/{owner}/{name}/contents/README.md"
-        request = requests.get(url) if token == '' else requests.get(url, headers={"Authorization": f"token {token}"})
-        file = request.json()
-        return requests.get(file['download_url']).text
-    except:
-        try:
-            url = f"https://api.github.com/repos/{owner}/{name}/contents/README"
-            request = requests.get(url) if token == '' else requests.get(url, headers={"Authorization": f"token {token}"})
-            file = request.json()
-            return requests.get(file['download_url']).text
-        except:
-            return None
+async def get_repo_readme(owner: str, name: str, token: str) -> str:
+    headers = {
+        "Accept": "application/vnd.github.v3.raw"  # return the file's content rather than its metadata
+    }
+    # the readme endpoint finds README.md, README, etc
+    response = await conditional_get(f"https://api.github.com/repos/{owner}/{name}/readme", token, headers)
+    return response.text if response.status_code == 200 else None
 
 
 @retry(
@@ -217,46 +420,307 @@ def get_repo_readme(owner: str, name: str, token: str) -> str:
     retry=(retry_if_exception_type(ConnectionError) | retry_if_exception_type(
         RequestException) | retry_if_exception_type(ReadTimeout) | retry_if_exception_type(
         Timeout) | retry_if_exception_type(HTTPError)))
-async def get_repo_config(owner: str, name: str, token: str) -> dict:
+async def get_repo_head(owner: str, name: str, token: str, ref: str = 'HEAD') -> str:
+    """
+    Resolves the commit SHA the given ref (by default, the head of the repository's default branch) points to. This is a conditional
+    request, so unless the branch has moved since last time it's answered from cache and doesn't count against the rate limit.
+    """
+
     headers = {
-        "Authorization": f"token {token}",
-        "Accept": "application/vnd.github.mercy-preview+json"  # so repo topics will be returned
+        "Accept": "application/vnd.github.VERSION.sha"  # return just the SHA rather than the whole commit
+    }
+    response = await conditional_get(f"https://api.github.com/repos/{owner}/{name}/commits/{ref}", token, headers)
+    # missing repository or ref, or an empty repository (no commits yet)
+    if response.status_code in (404, 409, 422): raise ValueError(f"Bad response from GitHub for {owner}/{name}@{ref}: {response.status_code}")
+    response.raise_for_status()
+    return response.text.strip()
+
+
+def parse_repo_config(text: str) -> dict:
+    if text is None or text.strip() == '': return {'config': None, 'errors': ['Configuration file missing']}
+
+    try:
+        config = yaml.safe_load(text)
+    except yaml.YAMLError as e:
+        return {'config': None, 'errors': [f"Failed to parse configuration: {e}"]}
+
+    if not isinstance(config, dict): return {'config': None, 'errors': ['Configuration must be a YAML mapping']}
+    try:
+        return {'config': config, 'errors': validate_repo_config_schema(config)}
+    except (TypeError, KeyError, AttributeError) as e:
+        return {'config': config, 'errors': [f"Malformed configuration: {e}"]}
+
+
+@retry(
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    stop=stop_after_attempt(3),
+    retry=(retry_if_exception_type(ConnectionError) | retry_if_exception_type(
+        RequestException) | retry_if_exception_type(ReadTimeout) | retry_if_exception_type(
+        Timeout) | retry_if_exception_type(HTTPError)))
+async def get_repo_config_at(owner: str, name: str, sha: str, token: str, text: str = None) -> dict:
+    """
+    Parses a repository's `plantit.yaml` as of the given commit and checks it against the schema. The file is fetched unless its text
+    is provided. A commit's content never changes, so results are cached (by SHA) indefinitely.
+
+    Returns: A dict with keys 'config' (None if the file is missing or malformed) and 'errors' (schema validation errors).
+    """
+
+    key = f"workflow_configs/{owner}/{name}/{sha}"
+    try:
+        redis = RedisClient.get()
+        cached = redis.get(key)
+        if cached is not None: return json.loads(cached)
+    except RedisError as e:
+        logger.warning(f"Workflow configuration cache unavailable: {e}")
+        redis = None
+
+    if text is None:
+        response = await GitHubClient.request('GET', f"https://raw.githubusercontent.com/{owner}/{name}/{sha}/plantit.yaml", token)
+        if response.status_code != 404: response.raise_for_status()
+        text = response.text if response.status_code == 200 else None
+
+    entry = parse_repo_config(text)
+    try:
+        if redis is not None: redis.set(key, json.dumps(entry))
+    except RedisError as e:
+        logger.warning(f"Failed to cache workflow configuration: {e}")
+
+    return entry
+
+
+async def get_repo_config(owner: str, name: str, token: str, sha: str = None) -> dict:
+    """
+    Fetches a repository's `plantit.yaml` as of the given commit (by default, the head of the default branch).
+
+    Returns: The parsed configuration, or None if the file is missing or malformed.
+    """
+
+    if sha is None: sha = await get_repo_head(owner, name, token)
+    return (await get_repo_config_at(owner, name, sha, token))['config']
+
+
+async def get_repo_config_bundle(owner: str, name: str, token: str, sha: str = None, text: str = None) -> dict:
+    """
+    Fetches and validates a repository's `plantit.yaml` as of the given commit (by default, the head of the default branch).
+    Only the Docker image and input path checks hit the network once a commit has been seen.
+
+    Returns: A dict with keys 'sha', 'config' and 'validation'.
+    """
+
+    if sha is None: sha = await get_repo_head(owner, name, token)
+    entry = await get_repo_config_at(owner, name, sha, token, text)
+    errors = list(entry['errors'])
+    if entry['config'] is not None: errors += await check_repo_config_remote_refs(entry['config'], token)
+    return {
+        'sha': sha,
+        'config': entry['config'] if entry['config'] is not None else dict(),
+        'validation': {
+            'is_valid': len(errors) == 0,
+            'errors': errors
+        }
     }
-    async with httpx.AsyncClient(headers=headers) as client:
-        # response = await client.get(
-        #     f"https://api.github.com/repos/{owner}/{name}/contents/plantit.yaml") if token == '' \
-        #     else requests.get(f"https://api.github.com/repos/{owner}/{name}/contents/plantit.yaml",
-        #                       headers={"Authorization": f"token {token}"})
-        response = await client.get(f"https://raw.githubusercontent.com/{owner}/{name}/master/plantit.yaml")
-        config = response.text
-        # config = await client.get(response.json()['download_url']).text
-        return yaml.load(config)
 
 
 async def get_repo_bundle(owner: str, name: str, token: str) -> dict:
-    tasks = [get_repo(owner, name, token), get_repo_config(owner, name, token)]
-    responses = await asyncio.gather(*tasks, return_exceptions=True)
-    repo = responses[0]
-    config = responses[1]
-    valid = validate_repo_config(config, token)
-    if isinstance(valid, bool):
-        return {
-            'repo': repo,
-            'config': config,
+    """
+    Fetches and validates a workflow repository. If the configuration can't be loaded because it's missing or malformed, the bundle
+    says so (and is cached as such), but transient errors (see `is_transient`) are raised so the previously cached bundle is kept.
+
+    Returns: A dict with keys 'repo' (or the exception raised fetching it), 'sha', 'config' and 'validation'.
+    """
+
+    tasks = [get_repo(owner, name, token), get_repo_config_bundle(owner, name, token)]
+    repo, bundle = await asyncio.gather(*tasks, return_exceptions=True)
+    for result in (repo, bundle):
+        if isinstance(result, Exception) and is_transient(result): raise result
+
+    if isinstance(bundle, Exception):
+        logger.warning(f"Failed to load configuration for {owner}/{name}: {bundle}")
+        bundle = {
+            'sha': None,
+            'config': dict(),
             'validation': {
-                'is_valid': True,
-                'errors': []
+                'is_valid': False,
+                'errors': [f"Failed to load configuration: {bundle}"]
             }
         }
-    else:
-        return {
-            'repo': repo,
-            'config': config,
-            'validation': {
-                'is_valid': valid[0],
-                'errors': valid[1]
+
+    return {'repo': repo, **bundle}
+
+
+# README file names GitHub recognizes at the repository root, in the order it prefers them
+README_NAMES = ('README.md', 'README', 'README.rst', 'README.txt', 'README.markdown', 'readme.md', 'Readme.md', 'readme.rst', 'readme')
+
+GRAPHQL_REPO_FIELDS = """
+    name
+    nameWithOwner
+    description
+    url
+    createdAt
+    updatedAt
+    pushedAt
+    stargazerCount
+    forkCount
+    isPrivate
+    isFork
+    owner { login avatarUrl }
+    primaryLanguage { name }
+    repositoryTopics(first: 20) { nodes { topic { name } } }
+    defaultBranchRef { name target { oid } }
+    config: object(expression: "HEAD:plantit.yaml") { ... on Blob { text } }
+""" + '\n'.join(f"    readme{i}: object(expression: \"HEAD:{name}\") {{ ... on Blob {{ text }} }}" for i, name in enumerate(README_NAMES)) + '\n'
+
+
+def graphql_repo_readme(node: dict) -> str:
+    # the first of the README aliases that exists (if any)
+    return next((node[f"readme{i}"]['text'] for i in range(len(README_NAMES)) if node.get(f"readme{i}", None) is not None), None)
+
+
+@retry(
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    stop=stop_after_attempt(3),
+    retry=(retry_if_exception_type(ConnectionError) | retry_if_exception_type(
+        RequestException) | retry_if_exception_type(ReadTimeout) | retry_if_exception_type(
+        Timeout) | retry_if_exception_type(HTTPError)))
+async def query_repos(repos: List[Tuple[str, str]], token: str) -> List[dict]:
+    """
+    Fetches metadata, topics, the default branch's `plantit.yaml` and README for several repositories with a single GraphQL query.
+
+    Returns: The repositories' GraphQL nodes in the order requested (None for any which weren't found).
+    """
+
+    variables = {}
+    fields = []
+    for i, (owner, name) in enumerate(repos):
+        variables[f"owner{i}"] = owner
+        variables[f"name{i}"] = name
+        fields.append(f"repo{i}: repository(owner: $owner{i}, name: $name{i}) {{ {GRAPHQL_REPO_FIELDS} }}")
+    parameters = ', '.join([f"$owner{i}: String!, $name{i}: String!" for i in range(len(repos))])
+    query = f"query({parameters}) {{ {' '.join(fields)} }}"
+
+    response = await GitHubClient.request('POST', 'https://api.github.com/graphql', token, json={'query': query, 'variables': variables})
+    response.raise_for_status()
+    content = response.json()
+    data = content.get('data', None)
+    if data is None: raise ValueError(f"Bad response from GitHub GraphQL API: {content.get('errors', content)}")
+    return [data.get(f"repo{i}", None) for i in range(len(repos))]
+
+
+# the repository fields the app (and the front end) use, all that's kept of GitHub's REST representation when caching
+REPO_FIELDS = ('name', 'full_name', 'description', 'html_url', 'default_branch', 'topics', 'language', 'stargazers_count', 'forks_count',
+               'private', 'fork', 'created_at', 'updated_at', 'pushed_at')
+
+
+def trim_repo(repo: dict) -> dict:
+    if not isinstance(repo, dict): return repo
+    trimmed = {field: repo[field] for field in REPO_FIELDS if field in repo}
+    if 'owner' in repo: trimmed['owner'] = {field: repo['owner'][field] for field in ('login', 'avatar_url') if field in repo['owner']}
+    return trimmed
+
+
+def graphql_repo_to_rest(node: dict) -> dict:
+    # the subset of the REST representation the rest of the app (and the front end) uses
+    return {
+        'name': node['name'],
+        'full_name': node['nameWithOwner'],
+        'owner': {
+            'login': node['owner']['login'],
+            'avatar_url': node['owner']['avatarUrl']
+        },
+        'description': node['description'],
+        'html_url': node['url'],
+        'default_branch': node['defaultBranchRef']['name'] if node['defaultBranchRef'] is not None else None,
+        'topics': [topic['topic']['name'] for topic in node['repositoryTopics']['nodes']],
+        'language': node['primaryLanguage']['name'] if node['primaryLanguage'] is not None else None,
+        'stargazers_count': node['stargazerCount'],
+        'forks_count': node['forkCount'],
+        'private': node['isPrivate'],
+        'fork': node['isFork'],
+        'created_at': node['createdAt'],
+        'updated_at': node['updatedAt'],
+        'pushed_at': node['pushedAt']
+    }
+
+
+async def get_repo_bundles(repos: List[Tuple[str, str]], token: str) -> Dict[Tuple[str, str], dict]:
+    """
+    Fetches and validates many workflow repositories at once. With a token, repositories are requested `GITHUB_GRAPHQL_BATCH_SIZE`
+    at a time via GraphQL (one request per batch, including each `plantit.yaml` and README); without one (the GraphQL API requires
+    authentication), or if a batch query fails, falls back to REST (see `get_repo_bundle`).
+
+    Returns: A map from (owner, name) to bundle, with keys 'repo', 'config' and 'validation' (and 'readme', if fetched via GraphQL).
+    Repositories that couldn't be found are omitted. Transient errors (see `is_transient`) are raised rather than omitting repositories.
+    """
+
+    repos = list(dict.fromkeys(repos))
+    semaphore = asyncio.Semaphore(GITHUB_CONCURRENCY)
+
+    async def rest(repo: Tuple[str, str]) -> dict:
+        async with semaphore:
+            try:
+                bundle = await get_repo_bundle(repo[0], repo[1], token)
+                if isinstance(bundle['repo'], Exception): raise bundle['repo']
+                return bundle
+            except Exception as e:
+                if is_transient(e): raise
+                logger.warning(f"Failed to load workflow {repo[0]}/{repo[1]}: {e}")
+                return None
+
+    async def validate(node: dict) -> dict:
+        async with semaphore:
+            repo = graphql_repo_to_rest(node)
+            try:
+                # empty repositories have no default branch (or configuration)
+                if node['defaultBranchRef'] is None: raise ValueError('Repository is empty')
+                bundle = await get_repo_config_bundle(
+                    repo['owner']['login'],
+                    repo['name'],
+                    token,
+                    sha=node['defaultBranchRef']['target']['oid'],
+                    text=node['config']['text'] if node['config'] is not None else '')
+            except Exception as e:
+                if is_transient(e): raise
+                bundle = {
+                    'sha': None,
+                    'config': dict(),
+                    'validation': {
+                        'is_valid': False,
+                        'errors': [f"Failed to load configuration: {e}"]
+                    }
+                }
+
+            readme = graphql_repo_readme(node)
+            if readme is None and node['defaultBranchRef'] is not None:
+                # the README may be named otherwise or kept elsewhere (e.g., in docs/ or .github/), which the readme endpoint finds
+                try:
+                    readme = await get_repo_readme(repo['owner']['login'], repo['name'], token)
+                except Exception as e:
+                    if is_transient(e): raise
+                    logger.warning(f"Failed to load README for {repo['full_name']}: {e}")
+
+            return {
+                'repo': repo,
+                'readme': readme,
+                **bundle
             }
-        }
+
+    async def batch(chunk: List[Tuple[str, str]]) -> List[dict]:
+        try:
+            nodes = await query_repos(chunk, token)
+        except Exception as e:
+            logger.warning(f"GraphQL query for {len(chunk)} repositories failed, falling back to REST: {e}")
+            return await asyncio.gather(*[rest(repo) for repo in chunk])
+        return await asyncio.gather(*[validate(node) if node is not None else none() for node in nodes])
+
+    async def none(): return None
+
+    if token == '':
+        bundles = await asyncio.gather(*[rest(repo) for repo in repos])
+    else:
+        chunks = [repos[i:i + GITHUB_GRAPHQL_BATCH_SIZE] for i in range(0, len(repos), GITHUB_GRAPHQL_BATCH_SIZE)]
+        bundles = [bundle for chunk in await asyncio.gather(*[batch(chunk) for chunk in chunks]) for bundle in chunk]
+
+    return {repo: bundle for repo, bundle in zip(repos, bundles) if bundle is not None}
 
 
 @retry(
@@ -265,33 +729,52 @@ async def get_repo_bundle(owner: str, name: str, token: str) -> dict:
     retry=(retry_if_exception_type(ConnectionError) | retry_if_exception_type(
         RequestException) | retry_if_exception_type(ReadTimeout) | retry_if_exception_type(
         Timeout) | retry_if_exception_type(HTTPError)))
-async def list_connectable_repos_by_owner(owner: str, token: str) -> List[dict]:
+async def search_connectable_repos_by_owner(owner: str, token: str) -> List[dict]:
     headers = {
-        "Authorization": f"token {token}",
         "Accept": "application/vnd.github.mercy-preview+json"  # so repo topics will be returned
     }
-    async with httpx.AsyncClient(headers=headers) as client:
-        response = await client.get(
-            f"https://api.github.com/search/code?q=filename:plantit.yaml+user:{owner}",
-            headers={
-                "Authorization": f"token {token}",
-                "Accept": "application/vnd.github.mercy-preview+json"  # so repo topics will be returned
-            })
-        content = response.json()
-        workflows = []
-        for item in (content['items'] if 'items' in content else []):
-            repo = item['repository']
-            config = await get_repo_config(item['repository']['owner']['login'], item['repository']['name'], token)
-            # readme = get_repo_readme(item['repository']['owner']['login'], item['repository']['name'], token)
-            validation = validate_repo_config(config, token)
-            workflows.append({
+    response = await conditional_get(f"https://api.github.com/search/code?q=filename:plantit.yaml+user:{owner}", token, headers)
+    content = response.json()
+    return [item['repository'] for item in (content['items'] if 'items' in content else [])]
+
+
+async def iter_connectable_repos_by_owner(owner: str, token: str) -> AsyncIterator[dict]:
+    """
+    Finds the given owner's repositories containing a `plantit.yaml` file, then fetches and validates each repository's configuration
+    concurrently (at most `GITHUB_CONCURRENCY` at a time). This method is an async generator and yields workflows in search result order.
+    """
+
+    semaphore = asyncio.Semaphore(GITHUB_CONCURRENCY)
+
+    async def bundle(repo: dict) -> dict:
+        async with semaphore:
+            try:
+                config = await get_repo_config_bundle(repo['owner']['login'], repo['name'], token)
+                # readme = await get_repo_readme(repo['owner']['login'], repo['name'], token)
+            except Exception as e:
+                if is_transient(e): raise
+                logger.warning(f"Failed to load configuration for {repo['full_name'] if 'full_name' in repo else repo['name']}: {e}")
+                config = {
+                    'sha': None,
+                    'config': dict(),
+                    'validation': {
+                        'is_valid': False,
+                        'errors': [f"Failed to load configuration: {e}"]
+                    }
+                }
+            return {
                 'repo': repo,
-                'config': config,
                 # 'readme': readme,
-                'validation': {
-                    'is_valid': validation[0],
-                    'errors': validation[1]
-                }
-            })
+                **config
+            }
 
-        return workflows
+    tasks = [asyncio.ensure_future(bundle(repo)) for repo in await search_connectable_repos_by_owner(owner, token)]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks: task.cancel()
+
+
+async def list_connectable_repos_by_owner(owner: str, token: str) -> List[dict]:
+    return [workflow async for workflow in iter_connectable_repos_by_owner(owner, token)]
@@ -0,0 +1,33 @@
+import asyncio
+import os
+import threading
+
+
+class BackgroundLoop:
+    """
+    An event loop running on its own daemon thread for the life of the process. `async_to_sync` (as used by Celery tasks and sync
+    views) runs each call on a new event loop, so a client pooled per loop would only ever serve one call and be dropped unclosed
+    when the loop is. Clients kept on a background loop are shared by all callers instead, whichever loop they're running on.
+    """
+
+    def __init__(self, name: str):
+        self.__name = name
+        self.__lock = threading.Lock()
+        self.__loop = None
+        self.__pid = None
+
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self.__lock:
+            # a forked child (e.g., a Celery worker) inherits the loop but not the thread running it
+            if self.__loop is None or self.__pid != os.getpid():
+                self.__loop = asyncio.new_event_loop()
+                self.__pid = os.getpid()
+                threading.Thread(target=self.__loop.run_forever, name=self.__name, daemon=True).start()
+            return self.__loop
+
+    async def run(self, coroutine):
+        """
+        Runs the coroutine on the background loop and waits (on the caller's loop) for its result. Cancelling the caller cancels it.
+        """
+
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.loop()))
@@ -1,5 +1,37 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+from os import environ
+
+import orjson
 import redis
 
+logger = logging.getLogger(__name__)
+
+# how long a single-flight lock is held without renewal (it's renewed every third of this while its holder is alive)
+SINGLE_FLIGHT_LEASE = int(environ.get('SINGLE_FLIGHT_LEASE', 60))  # seconds
+
+# how long callers wait for another's refresh to finish before going ahead with whatever is cached
+SINGLE_FLIGHT_WAIT = int(environ.get('SINGLE_FLIGHT_WAIT', 120))  # seconds
+
+# max entries in each process's in-memory cache in front of Redis (0 disables it)
+LOCAL_CACHE_SIZE = int(environ.get('LOCAL_CACHE_SIZE', 1024))
+
+# the pub/sub channel over which rewritten keys are announced, so every process drops them from its local cache
+LOCAL_CACHE_CHANNEL = 'local_cache_invalidations'
+
+# encoded cache values at least this large (in bytes) are stored zlib-compressed
+CACHE_COMPRESSION_THRESHOLD = int(environ.get('CACHE_COMPRESSION_THRESHOLD', 2048))
+
+# the first byte of each encoded cache value says how the rest is encoded (values written before this scheme are plain JSON text)
+CODEC_JSON = b'\x01'
+CODEC_JSON_ZLIB = b'\x02'
+
 
 class RedisClient:
     __client = None
@@ -9,3 +41,178 @@ class RedisClient:
         if RedisClient.__client is None:
             RedisClient.__client = redis.Redis('redis', 6379, db=0)
         return RedisClient.__client
+
+
+class LocalCache:
+    """
+    A small per-process LRU cache (of up to `LOCAL_CACHE_SIZE` decoded values) in front of Redis. Whoever rewrites a cached key
+    must call `invalidate()`, which publishes the key to every process (including this one) to evict. Entries are only kept while
+    this process is subscribed, and are all dropped if the subscription is lost. Values are shared by callers, so don't mutate them.
+    """
+
+    __entries = OrderedDict()
+    __lock = threading.Lock()
+    __generation = 0
+    __subscribed = False
+    __listener = None
+
+    @staticmethod
+    def get(key: str):
+        if LOCAL_CACHE_SIZE <= 0: return None
+        LocalCache.__listen()
+        with LocalCache.__lock:
+            if key not in LocalCache.__entries: return None
+            LocalCache.__entries.move_to_end(key)
+            return LocalCache.__entries[key]
+
+    @staticmethod
+    def generation() -> int:
+        """
+        Returns a token to pass to `put()`, which should be obtained before reading the value from Redis. If any key is invalidated
+        in between, the put is skipped, since the value read may already be stale.
+        """
+
+        return LocalCache.__generation
+
+    @staticmethod
+    def put(key: str, value, generation: int):
+        if LOCAL_CACHE_SIZE <= 0: return
+        with LocalCache.__lock:
+            if not LocalCache.__subscribed or generation != LocalCache.__generation: return
+            LocalCache.__entries[key] = value
+            LocalCache.__entries.move_to_end(key)
+            while len(LocalCache.__entries) > LOCAL_CACHE_SIZE: LocalCache.__entries.popitem(last=False)
+
+    @staticmethod
+    def invalidate(keys: list, pipeline=None):
+        """
+        Evicts the given keys here and announces them to other processes. Pass a pipeline to announce them when it executes.
+        """
+
+        if len(keys) == 0: return
+        LocalCache.__evict(keys)
+        (pipeline if pipeline is not None else RedisClient.get()).publish(LOCAL_CACHE_CHANNEL, json.dumps(list(keys)))
+
+    @staticmethod
+    def __evict(keys: list):
+        with LocalCache.__lock:
+            LocalCache.__generation += 1
+            for key in keys: LocalCache.__entries.pop(key, None)
+
+    @staticmethod
+    def __clear():
+        with LocalCache.__lock:
+            LocalCache.__generation += 1
+            LocalCache.__subscribed = False
+            LocalCache.__entries.clear()
+
+    @staticmethod
+    def __listen():
+        with LocalCache.__lock:
+            if LocalCache.__listener is not None: return
+            LocalCache.__listener = threading.Thread(target=LocalCache.__subscribe, daemon=True)
+        LocalCache.__listener.start()
+
+    @staticmethod
+    def __subscribe():
+        while True:
+            try:
+                pubsub = RedisClient.get().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(LOCAL_CACHE_CHANNEL)
+                with LocalCache.__lock: LocalCache.__subscribed = True
+                for message in pubsub.listen():
+                    if message['type'] == 'message': LocalCache.__evict(json.loads(message['data']))
+            except redis.RedisError as e:
+                logger.warning(f"Lost local cache invalidation subscription, clearing local cache: {e}")
+            # we may have missed invalidations, so start over
+            LocalCache.__clear()
+            time.sleep(1)
+
+
+def encode(value) -> bytes:
+    """
+    Serializes a value for caching in Redis: orjson-encoded, and compressed if larger than `CACHE_COMPRESSION_THRESHOLD`.
+    """
+
+    data = orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY)
+    if len(data) >= CACHE_COMPRESSION_THRESHOLD: return CODEC_JSON_ZLIB + zlib.compress(data)
+    return CODEC_JSON + data
+
+
+def decode(data: bytes):
+    """
+    Deserializes a value written by `encode()` (or a legacy JSON string).
+    """
+
+    codec = data[:1]
+    if codec == CODEC_JSON: return orjson.loads(data[1:])
+    if codec == CODEC_JSON_ZLIB: return orjson.loads(zlib.decompress(data[1:]))
+    return json.loads(data)
+
+
+def _acquire(name: str):
+    lock = RedisClient.get().lock(f"locks/{name}", timeout=SINGLE_FLIGHT_LEASE, thread_local=False)
+    if not lock.acquire(blocking=False): return None, None
+
+    # renew the lease from a thread, so it holds however long the refresh takes (and whether or not the holder's event loop is busy)
+    # but lapses soon after the holder dies
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(SINGLE_FLIGHT_LEASE / 3):
+            try:
+                lock.reacquire()
+            except redis.exceptions.LockError:
+                logger.warning(f"Lost lock {name} before finishing")
+                return
+            except redis.RedisError as e:
+                logger.warning(f"Failed to renew lock {name}: {e}")
+
+    threading.Thread(target=renew, daemon=True).start()
+    return lock, stop
+
+
+def _release(name: str, lock, stop: threading.Event):
+    stop.set()
+    try:
+        lock.release()
+    except redis.exceptions.LockError:
+        logger.warning(f"Lock {name} expired before release")
+
+
+@contextmanager
+def single_flight(name: str, wait: bool = True):
+    """
+    Lets only one caller (in any process) at a time run the guarded block, e.g. a cache refresh. The caller taking the lock
+    yields True; others wait for it to finish (up to `SINGLE_FLIGHT_WAIT` seconds), then yield False and should read the cache
+    rather than refresh it again. Callers with a stale cache to fall back on should pass `wait=False`, to yield False right away.
+    """
+
+    lock, stop = _acquire(name)
+    if lock is not None:
+        try:
+            yield True
+        finally:
+            _release(name, lock, stop)
+    elif not wait:
+        yield False
+    else:
+        deadline = time.monotonic() + SINGLE_FLIGHT_WAIT
+        while RedisClient.get().exists(f"locks/{name}") and time.monotonic() < deadline: time.sleep(0.1)
+        yield False
+
+
+@asynccontextmanager
+async def single_flight_async(name: str, wait: bool = True):
+    lock, stop = _acquire(name)
+    if lock is not None:
+        try:
+            yield True
+        finally:
+            _release(name, lock, stop)
+    elif not wait:
+        yield False
+    else:
+        deadline = time.monotonic() + SINGLE_FLIGHT_WAIT
+        while RedisClient.get().exists(f"locks/{name}") and time.monotonic() < deadline: await asyncio.sleep(0.1)
+        yield False
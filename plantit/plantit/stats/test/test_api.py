@@ -0,0 +1,16 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+
+class TerrainStatsTests(TestCase):
+    url = '/apis/v1/stats/terrain/'
+
+    def test_forbidden_for_non_staff(self):
+        self.client.force_login(User.objects.create_user(username='user', password='password'))
+        self.assertEqual(403, self.client.get(self.url).status_code)
+
+    def test_allowed_for_staff(self):
+        self.client.force_login(User.objects.create_user(username='staff', password='password', is_staff=True))
+        response = self.client.get(self.url)
+        self.assertEqual(200, response.status_code)
+        self.assertIn('uploads', response.json())
@@ -5,4 +5,5 @@ from . import views
 urlpatterns = [
     path(r'counts/', views.counts),
     path(r'institutions/', views.institutions),
+    path(r'terrain/', views.terrain),
 ]
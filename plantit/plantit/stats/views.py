@@ -1,7 +1,9 @@
+from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.db.models import Count
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponseForbidden
 
+from plantit.terrain import TerrainClient, upload_stats
 from plantit.tasks.models import Task, TaskCounter
 from plantit.users.models import Profile
 from plantit.utils import list_institutions
@@ -17,4 +19,15 @@ def counts(request):
 
 
 def institutions(request):
-    return JsonResponse({'institutions': list_institutions()})
+    institutions, age = list_institutions()
+    return JsonResponse({'institutions': institutions, 'age': age})
+
+
+@login_required
+def terrain(request):
+    # recent uploads include other users' Data Store paths
+    if not request.user.is_staff: return HttpResponseForbidden()
+    return JsonResponse({
+        'latencies': TerrainClient.metrics(),
+        'uploads': upload_stats()
+    })
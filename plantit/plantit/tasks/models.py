@@ -60,6 +60,7 @@ class Task(models.Model):
     workflow = models.JSONField(null=False, blank=False)
     workflow_owner = models.CharField(max_length=280, null=False, blank=False)
     workflow_name = models.CharField(max_length=280, null=False, blank=False)
+    workflow_sha = models.CharField(max_length=40, null=True, blank=True)
     workflow_image_url = models.URLField(null=True, blank=True)
     results = ArrayField(models.CharField(max_length=250), blank=True, null=True)
     previews_loaded = models.BooleanField(default=False)
@@ -1,20 +1,196 @@
+import asyncio
+import hashlib
 import json
 import logging
-import multiprocessing
 import pprint
-from contextlib import closing
-from multiprocessing import Pool
+import threading
+import time
+import uuid
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from os import environ, listdir
-from os.path import basename, join, isfile, isdir
-from typing import List
+from os.path import basename, join, isfile, isdir, getsize, getmtime
+from typing import List, Iterator, Dict, Optional
 
+import httpx
 import requests
+from redis import RedisError
 from requests import RequestException, ReadTimeout, Timeout, HTTPError
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from requests_toolbelt import MultipartEncoder
 from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
 
+from plantit.loops import BackgroundLoop
+from plantit.redis import RedisClient
+
 logger = logging.getLogger(__name__)
 
+TERRAIN_URL = 'https://de.cyverse.org/terrain'
+TERRAIN_UPLOAD_CONCURRENCY = int(environ.get('TERRAIN_UPLOAD_CONCURRENCY', 4))
+TERRAIN_PAGE_SIZE = int(environ.get('TERRAIN_PAGE_SIZE', 1000))
+TERRAIN_STAT_BATCH_SIZE = int(environ.get('TERRAIN_STAT_BATCH_SIZE', 200))
+TERRAIN_HTTP2 = environ.get('TERRAIN_HTTP2', 'False').lower() == 'true'
+TERRAIN_CACHE_TTL = int(environ.get('TERRAIN_CACHE_TTL', 60))  # seconds
+TERRAIN_CACHE_FILL_TIMEOUT = int(environ.get('TERRAIN_CACHE_FILL_TIMEOUT', 30))  # seconds
+
+# per-endpoint request timeouts in seconds, overridable with a JSON object, e.g. TERRAIN_TIMEOUTS='{"upload": 3600}'
+TERRAIN_TIMEOUTS = {
+    'user-info': 15,
+    'token': 15,
+    'paged-directory': 60,
+    'stat': 60,
+    'delete': 60,
+    'rename': 60,
+    'upload': 1800,
+    **json.loads(environ.get('TERRAIN_TIMEOUTS', '{}'))
+}
+
+# recent per-file upload throughput, newest last (see `upload_stats()`)
+UPLOAD_STATS = deque(maxlen=1000)
+
+
+class TerrainClient:
+    """
+    Holds the HTTP clients shared by all Terrain (and CyVerse KeyCloak) calls in this process: a keep-alive `requests` session for
+    synchronous callers like Celery tasks, and an `httpx` client on a background loop (see `BackgroundLoop`) shared by async views
+    whichever loop they're running on. Requests made through the client use per-endpoint timeouts (see `TERRAIN_TIMEOUTS`) and have
+    their latency recorded per endpoint (see `metrics()`).
+    """
+
+    __session = None
+    __async_clients = weakref.WeakKeyDictionary()
+    __background = BackgroundLoop('terrain')
+    __latencies = {}
+    __lock = threading.Lock()
+
+    @staticmethod
+    def session() -> requests.Session:
+        if TerrainClient.__session is None:
+            with TerrainClient.__lock:
+                if TerrainClient.__session is None:
+                    session = requests.Session()
+                    session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=TERRAIN_UPLOAD_CONCURRENCY))
+                    TerrainClient.__session = session
+        return TerrainClient.__session
+
+    @staticmethod
+    def async_client() -> httpx.AsyncClient:
+        # httpx connections are bound to the event loop they were opened on (only ever the background loop, though a forked process starts a new one)
+        loop = asyncio.get_event_loop()
+        client = TerrainClient.__async_clients.get(loop, None)
+        if client is None:
+            limits = httpx.Limits(max_connections=TERRAIN_UPLOAD_CONCURRENCY * 2, max_keepalive_connections=TERRAIN_UPLOAD_CONCURRENCY)
+            try:
+                client = httpx.AsyncClient(http2=TERRAIN_HTTP2, limits=limits)
+            except ImportError:
+                logger.warning(f"HTTP/2 requested for Terrain but the 'h2' package is not installed, falling back to HTTP/1.1")
+                client = httpx.AsyncClient(limits=limits)
+            TerrainClient.__async_clients[loop] = client
+        return client
+
+    @staticmethod
+    def request(method: str, endpoint: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', TERRAIN_TIMEOUTS.get(endpoint, None))
+        start = time.monotonic()
+        try:
+            return TerrainClient.session().request(method, url, **kwargs)
+        finally:
+            TerrainClient.record(endpoint, time.monotonic() - start)
+
+    @staticmethod
+    async def request_async(method: str, endpoint: str, url: str, **kwargs) -> httpx.Response:
+        kwargs.setdefault('timeout', TERRAIN_TIMEOUTS.get(endpoint, None))
+        start = time.monotonic()
+        try:
+            return await TerrainClient.__background.run(TerrainClient.__request_async(method, url, **kwargs))
+        finally:
+            TerrainClient.record(endpoint, time.monotonic() - start)
+
+    @staticmethod
+    async def __request_async(method: str, url: str, **kwargs) -> httpx.Response:
+        return await TerrainClient.async_client().request(method, url, **kwargs)
+
+    @staticmethod
+    def record(endpoint: str, seconds: float):
+        with TerrainClient.__lock:
+            TerrainClient.__latencies.setdefault(endpoint, deque(maxlen=500)).append(seconds)
+
+    @staticmethod
+    def metrics() -> dict:
+        """
+        Summarizes recent request latencies (in seconds) for each Terrain endpoint called by this process.
+        """
+
+        with TerrainClient.__lock:
+            latencies = {endpoint: sorted(recent) for endpoint, recent in TerrainClient.__latencies.items()}
+        return {endpoint: {
+            'count': len(recent),
+            'mean': sum(recent) / len(recent),
+            'p50': recent[len(recent) // 2],
+            'p95': recent[min(len(recent) - 1, int(len(recent) * 0.95))],
+            'max': recent[-1]
+        } for endpoint, recent in latencies.items() if len(recent) > 0}
+
+
+def _cache_key(kind: str, path: str, token: str) -> str:
+    # what a user can see depends on their permissions, so entries are scoped to the (hashed) token they were fetched with
+    scope = hashlib.sha256(token.encode()).hexdigest()[:16]
+    return f"terrain/{kind}/{scope}/{path.strip('/')}"
+
+
+@contextmanager
+def _single_flight(redis, key: str):
+    """
+    Lets only one caller at a time fill the given cache entry. The first caller to take the (expiring) lock yields True;
+    others wait until it is released or expires, then yield False and should check the cache again.
+    """
+
+    lock = f"{key}/lock"
+    if redis.set(lock, 1, nx=True, ex=TERRAIN_CACHE_FILL_TIMEOUT):
+        try:
+            yield True
+        finally:
+            redis.delete(lock)
+    else:
+        deadline = time.monotonic() + TERRAIN_CACHE_FILL_TIMEOUT
+        while redis.exists(lock) and time.monotonic() < deadline: time.sleep(0.05)
+        yield False
+
+
+def _cached(key: str, compute):
+    try:
+        redis = RedisClient.get()
+        value = redis.get(key)
+        if value is None:
+            with _single_flight(redis, key) as leader:
+                if not leader: value = redis.get(key)
+                if value is None:
+                    computed = compute()
+                    redis.set(key, json.dumps(computed), ex=TERRAIN_CACHE_TTL)
+                    return computed
+        return json.loads(value)
+    except RedisError as e:
+        logger.warning(f"Terrain cache unavailable: {e}")
+        return compute()
+
+
+def invalidate(paths: List[str], token: str):
+    """
+    Drops cached listings and stats for the given paths and their parent directories, e.g. after uploading or deleting files.
+    """
+
+    keys = []
+    for path in paths:
+        parent = path.rstrip('/').rpartition('/')[0]
+        keys += [_cache_key(kind, p, token) for kind in ('listings', 'counts', 'stats') for p in (path, parent)]
+    try:
+        RedisClient.get().delete(*keys)
+    except RedisError as e:
+        logger.warning(f"Failed to invalidate Terrain cache: {e}")
+
 
 def list_files(path,
                include_patterns=None,
@@ -55,13 +231,33 @@ def list_files(path,
         RequestException) | retry_if_exception_type(ReadTimeout) | retry_if_exception_type(
         Timeout) | retry_if_exception_type(HTTPError)))
 def get_profile(username: str, access_token: str) -> dict:
-    response = requests.get(
-        f"https://de.cyverse.org/terrain/secured/user-info?username={username}",
+    response = TerrainClient.request(
+        'GET',
+        'user-info',
+        f"{TERRAIN_URL}/secured/user-info?username={username}",
         headers={'Authorization': f"Bearer {access_token}"})
-    if response.status_code == 401 or response.status_code == 403:
+    return _parse_profile(username, response.status_code, response.json)
+
+
+@retry(
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    stop=stop_after_attempt(3),
+    retry=(retry_if_exception_type(ConnectionError) | retry_if_exception_type(
+        httpx.TransportError) | retry_if_exception_type(httpx.HTTPStatusError)))
+async def get_profile_async(username: str, access_token: str) -> dict:
+    response = await TerrainClient.request_async(
+        'GET',
+        'user-info',
+        f"{TERRAIN_URL}/secured/user-info?username={username}",
+        headers={'Authorization': f"Bearer {access_token}"})
+    return _parse_profile(username, response.status_code, response.json)
+
+
+def _parse_profile(username: str, status_code: int, json_content) -> dict:
+    if status_code == 401 or status_code == 403:
         raise ValueError('Invalid token')
     else:
-        content = response.json()
+        content = json_content()
         if username in content:
             return content[username]
         else:
@@ -75,13 +271,13 @@ def get_profile(username: str, access_token: str) -> dict:
         RequestException) | retry_if_exception_type(ReadTimeout) | retry_if_exception_type(
         Timeout) | retry_if_exception_type(HTTPError)))
 def refresh_tokens(username: str, refresh_token: str) -> (str, str):
-    response = requests.post("https://kc.cyverse.org/auth/realms/CyVerse/protocol/openid-connect/token", data={
+    response = TerrainClient.request('POST', 'token', "https://kc.cyverse.org/auth/realms/CyVerse/protocol/openid-connect/token", data={
         'grant_type': 'refresh_token',
         'client_id': environ.get('CYVERSE_CLIENT_ID'),
         'client_secret': environ.get('CYVERSE_CLIENT_SECRET'),
         'refresh_token': refresh_token,
         'redirect_uri': environ.get('CYVERSE_REDIRECT_URL')},
-                             auth=HTTPBasicAuth(username, environ.get('CYVERSE_CLIENT_SECRET')))
+                                     auth=HTTPBasicAuth(username, environ.get('CYVERSE_CLIENT_SECRET')))
 
     if response.status_code == 400:
         raise ValueError('Unauthorized for KeyCloak token endpoint')
@@ -95,23 +291,134 @@ def refresh_tokens(username: str, refresh_token: str) -> (str, str):
     return content['access_token'], content['refresh_token']
 
 
+def list_dir(path: str, token: str, filetypes: List[str] = None, cached: bool = True) -> List[str]:
+    return [file['path'] for file in iter_dir(path, token, filetypes=filetypes, cached=cached)]
+
+
 @retry(
     wait=wait_exponential(multiplier=1, min=4, max=10),
     stop=stop_after_attempt(3),
     retry=(retry_if_exception_type(ConnectionError) | retry_if_exception_type(
         RequestException) | retry_if_exception_type(ReadTimeout) | retry_if_exception_type(
         Timeout) | retry_if_exception_type(HTTPError)))
-def list_dir(path: str, token: str) -> List[str]:
-    with requests.get(
-            f"https://de.cyverse.org/terrain/secured/filesystem/paged-directory?limit=1000&path={path}",
+def list_dir_page(path: str, token: str, limit: int, offset: int = 0) -> dict:
+    with TerrainClient.request(
+            'GET',
+            'paged-directory',
+            f"{TERRAIN_URL}/secured/filesystem/paged-directory",
+            params={'path': path, 'limit': limit, 'offset': offset, 'entity-type': 'file', 'sort-col': 'NAME', 'sort-dir': 'ASC'},
             headers={'Authorization': f"Bearer {token}"}) as response:
         if response.status_code == 500 and response.json()['error_code'] == 'ERR_DOES_NOT_EXIST':
             raise ValueError(f"Path {path} does not exist")
 
         response.raise_for_status()
-        content = response.json()
-        files = content['files']
-        return [file['path'] for file in files]
+        return response.json()
+
+
+def iter_dir(path: str, token: str, page_size: int = None, filetypes: List[str] = None, cached: bool = True) -> Iterator[dict]:
+    """
+    Lists the files in a Data Store directory, requesting one page at a time until the listing is exhausted.
+    This method is a generator and yields each file's metadata (e.g. 'path', 'label', 'file-size', 'date-modified').
+
+    Args:
+        path: The directory path
+        token: The CyVerse access token
+        page_size: The number of entries to request per page (defaults to `TERRAIN_PAGE_SIZE`)
+        filetypes: Only yield files whose names contain one of these patterns (case-insensitive, see `filetype_patterns()`). The
+            paged-directory endpoint can only filter by entity and info type, not by name, so this filter is applied to each page here.
+        cached: Whether to read (and fill) the listing cache, which holds listings for `TERRAIN_CACHE_TTL` seconds
+    """
+
+    limit = page_size if page_size is not None else TERRAIN_PAGE_SIZE
+    patterns = filetype_patterns(filetypes)
+    pages = _iter_dir_cached(path, token, limit) if cached else _iter_dir_pages(path, token, limit)
+    for files in pages:
+        yield from (file for file in files if len(patterns) == 0 or any(pattern in file['label'].lower() for pattern in patterns))
+
+
+def _iter_dir_pages(path: str, token: str, limit: int) -> Iterator[List[dict]]:
+    offset = 0
+    while True:
+        files = list_dir_page(path, token, limit, offset)['files']
+        yield files
+        if len(files) < limit: break
+        offset += limit
+
+
+def _iter_dir_cached(path: str, token: str, limit: int) -> Iterator[List[dict]]:
+    key = _cache_key('listings', path, token)
+    try:
+        redis = RedisClient.get()
+        # treat listings about to expire as misses, so they can't disappear halfway through being read
+        hit = redis.ttl(key) > 5
+    except RedisError as e:
+        logger.warning(f"Terrain cache unavailable: {e}")
+        yield from _iter_dir_pages(path, token, limit)
+        return
+
+    if not hit:
+        with _single_flight(redis, key) as leader:
+            # fill the whole listing before yielding any of it, so a slow reader can't hold the lock (or let it lapse) mid-fill
+            filled = _fill_listing(redis, key, _iter_dir_pages(path, token, limit)) if leader or redis.ttl(key) <= 5 else True
+        if not filled:
+            yield from _iter_dir_pages(path, token, limit)
+            return
+
+    total = redis.llen(key)
+    read = 0
+    while read < total:
+        files = [json.loads(file) for file in redis.lrange(key, read, read + limit - 1)]
+        if len(files) == 0: raise ValueError(f"Cached listing of {path} expired while being read")
+        read += len(files)
+        yield files
+
+
+def _fill_listing(redis, key: str, pages: Iterator[List[dict]]) -> bool:
+    """
+    Caches a listing page by page under a temporary key, swapped in once the listing is complete.
+
+    Returns: Whether the listing was cached.
+    """
+
+    staging = f"{key}/{uuid.uuid4().hex}"
+    try:
+        for files in pages:
+            if len(files) == 0: continue
+            redis.pipeline().rpush(staging, *[json.dumps(file) for file in files]).expire(staging, TERRAIN_CACHE_FILL_TIMEOUT * 2).execute()
+        if redis.exists(staging): redis.pipeline().rename(staging, key).expire(key, TERRAIN_CACHE_TTL).execute()
+        return True
+    except RedisError as e:
+        logger.warning(f"Failed to cache listing: {e}")
+        return False
+
+
+def count_dir(path: str, token: str, filetypes: List[str] = None, cached: bool = True) -> int:
+    """
+    Counts the files in a Data Store directory. Without filetypes this is a single request for the listing's total,
+    otherwise the listing is streamed (without being held in memory) and matching files are counted.
+    """
+
+    if filetypes is None or len(filetypes) == 0:
+        count = lambda: int(list_dir_page(path, token, 1)['total'])
+        return _cached(_cache_key('counts', path, token), count) if cached else count()
+    return sum(1 for _ in iter_dir(path, token, filetypes=filetypes, cached=cached))
+
+
+def filetype_patterns(filetypes: List[str] = None) -> List[str]:
+    if filetypes is None: return []
+
+    # allow for both spellings of JPG
+    patterns = [filetype.lower() for filetype in filetypes]
+    if 'jpg' in patterns and 'jpeg' not in patterns:
+        patterns.append("jpeg")
+    elif 'jpeg' in patterns and 'jpg' not in patterns:
+        patterns.append("jpg")
+    return patterns
+
+
+def normalize_path(path: str) -> str:
+    # Terrain reports paths without trailing slashes
+    return path.rstrip('/') or '/'
 
 
 @retry(
@@ -120,19 +427,161 @@ def list_dir(path: str, token: str) -> List[str]:
     retry=(retry_if_exception_type(ConnectionError) | retry_if_exception_type(
         RequestException) | retry_if_exception_type(ReadTimeout) | retry_if_exception_type(
         Timeout) | retry_if_exception_type(HTTPError)))
-def get_file(path: str, token: str) -> List[str]:
-    with requests.post(
-            "https://de.cyverse.org/terrain/secured/filesystem/stat",
-            data=json.dumps({'paths': [path]}),
+def _stat_batch(paths: List[str], token: str) -> Dict[str, dict]:
+    with TerrainClient.request(
+            'POST',
+            'stat',
+            f"{TERRAIN_URL}/secured/filesystem/stat",
+            data=json.dumps({'paths': paths}),
             headers={'Authorization': f"Bearer {token}", "Content-Type": 'application/json;charset=utf-8'}) as response:
         if response.status_code == 500 and response.json()['error_code'] == 'ERR_DOES_NOT_EXIST':
-            raise ValueError(f"Path {path} does not exist")
+            # the whole batch fails if any path is missing: drop the missing paths (or bisect, if they aren't named) and try again
+            missing = set(normalize_path(path) for path in response.json().get('paths', None) or [])
+            remaining = [path for path in paths if normalize_path(path) not in missing]
+            if len(remaining) == 0: return {}
+            elif len(remaining) < len(paths): return _stat_batch(remaining, token)
+            elif len(paths) == 1: return {}
+            middle = len(paths) // 2
+            return {**_stat_batch(paths[:middle], token), **_stat_batch(paths[middle:], token)}
         elif response.status_code == 400:
             pprint.pprint(response.json())
 
         response.raise_for_status()
-        content = response.json()
-        return content['paths'][path]
+        return {normalize_path(path): stat for path, stat in response.json()['paths'].items()}
+
+
+def stat_many(paths: List[str], token: str, cached: bool = True, concurrency: int = None) -> Dict[str, Optional[dict]]:
+    """
+    Looks up metadata for many Data Store paths (files or directories) at once. Paths are sent to Terrain in batches of
+    `TERRAIN_STAT_BATCH_SIZE`, with batches running concurrently.
+
+    Returns: A map from each path (as given) to its metadata, or to None if the path does not exist.
+    """
+
+    given = paths
+    paths = list(dict.fromkeys(normalize_path(path) for path in given))
+    stats = {path: None for path in paths}
+    keys = {path: _cache_key('stats', path, token) for path in paths}
+    redis = None
+    if cached:
+        try:
+            redis = RedisClient.get()
+            for path, value in zip(paths, redis.mget([keys[path] for path in paths])):
+                if value is not None: stats[path] = json.loads(value)
+        except RedisError as e:
+            logger.warning(f"Terrain cache unavailable: {e}")
+            redis = None
+
+    misses = [path for path in paths if stats[path] is None]
+    batches = [misses[i:i + TERRAIN_STAT_BATCH_SIZE] for i in range(0, len(misses), TERRAIN_STAT_BATCH_SIZE)]
+    if len(batches) > 1:
+        workers = concurrency if concurrency is not None else TERRAIN_UPLOAD_CONCURRENCY
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(batches)))) as executor:
+            found = {path: stat for batch in executor.map(lambda b: _stat_batch(b, token), batches) for path, stat in batch.items()}
+    else:
+        found = _stat_batch(batches[0], token) if len(batches) == 1 else {}
+
+    found = {path: stat for path, stat in found.items() if path in stats}
+    stats.update(found)
+    if redis is not None and len(found) > 0:
+        try:
+            pipeline = redis.pipeline()
+            for path, stat in found.items(): pipeline.set(keys[path], json.dumps(stat), ex=TERRAIN_CACHE_TTL)
+            pipeline.execute()
+        except RedisError as e:
+            logger.warning(f"Failed to cache stats: {e}")
+
+    return {path: stats[normalize_path(path)] for path in given}
+
+
+def get_file(path: str, token: str, cached: bool = True) -> dict:
+    stat = stat_many([path], token, cached)[path]
+    if stat is None: raise ValueError(f"Path {path} does not exist")
+    return stat
+
+
+@retry(
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    stop=stop_after_attempt(3),
+    retry=(retry_if_exception_type(ConnectionError) | retry_if_exception_type(
+        httpx.TransportError) | retry_if_exception_type(httpx.HTTPStatusError)))
+async def _stat_async(path: str, token: str) -> Optional[dict]:
+    response = await TerrainClient.request_async(
+        'POST',
+        'stat',
+        f"{TERRAIN_URL}/secured/filesystem/stat",
+        data=json.dumps({'paths': [normalize_path(path)]}),
+        headers={'Authorization': f"Bearer {token}", "Content-Type": 'application/json;charset=utf-8'})
+    if response.status_code == 500 and response.json()['error_code'] == 'ERR_DOES_NOT_EXIST':
+        return None
+
+    response.raise_for_status()
+    content = response.json()
+    return {normalize_path(p): stat for p, stat in content['paths'].items()}[normalize_path(path)]
+
+
+async def stat_async(path: str, token: str, cached: bool = True) -> Optional[dict]:
+    """
+    Looks up metadata for a single Data Store path without blocking the event loop (see `stat_many`).
+
+    Returns: The path's metadata, or None if it does not exist.
+    """
+
+    key = _cache_key('stats', path, token)
+    try:
+        value = RedisClient.get().get(key) if cached else None
+        if value is not None: return json.loads(value)
+    except RedisError as e:
+        logger.warning(f"Terrain cache unavailable: {e}")
+        cached = False
+
+    stat = await _stat_async(path, token)
+    try:
+        if cached and stat is not None: RedisClient.get().set(key, json.dumps(stat), ex=TERRAIN_CACHE_TTL)
+    except RedisError as e:
+        logger.warning(f"Failed to cache stats: {e}")
+    return stat
+
+
+async def get_file_async(path: str, token: str, cached: bool = True) -> dict:
+    stat = await stat_async(path, token, cached)
+    if stat is None: raise ValueError(f"Path {path} does not exist")
+    return stat
+
+
+async def path_exists_async(path, token, cached: bool = True):
+    stat = await stat_async(path, token, cached)
+    if stat is None:
+        print(f"Path '{path}' does not exist")
+        return False
+    return True, 'directory' if stat.get('type', None) == 'dir' else 'file'
+
+
+def path_exists(path, token, cached: bool = True):
+    stat = stat_many([path], token, cached)[path]
+    if stat is None:
+        print(f"Path '{path}' does not exist")
+        return False
+    return True, 'directory' if stat.get('type', None) == 'dir' else 'file'
+
+
+def file_md5(path: str, chunk_size: int = 1024 * 1024) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def remote_file_matches(from_path: str, remote: dict) -> bool:
+    """
+    Checks whether a Data Store file (as returned by the stat endpoint) has the same size and checksum as the given local file.
+    The local checksum is only computed if the sizes match.
+    """
+
+    if remote is None or remote.get('type', 'file') != 'file': return False
+    if int(remote.get('file-size', -1)) != getsize(from_path): return False
+    return 'md5' in remote and remote['md5'] == file_md5(from_path)
 
 
 @retry(
@@ -141,40 +590,122 @@ def get_file(path: str, token: str) -> List[str]:
     retry=(retry_if_exception_type(ConnectionError) | retry_if_exception_type(
         RequestException) | retry_if_exception_type(ReadTimeout) | retry_if_exception_type(
         Timeout) | retry_if_exception_type(HTTPError)))
-def path_exists(path, token):
-    response = requests.get(f"https://de.cyverse.org/terrain/secured/filesystem/paged-directory?limit=1000&path={path}",
-                            headers={"Authorization": f"Bearer {token}"})
-    content = response.json()
-    input_type = 'directory'
-    if response.status_code != 200:
-        if 'error_code' not in content or ('error_code' in content and content['error_code'] == 'ERR_DOES_NOT_EXIST'):
-            path_split = path.rpartition('/')
-            base = path_split[0]
-            file = path_split[2]
-            up_response = requests.get(f"https://de.cyverse.org/terrain/secured/filesystem/paged-directory?limit=1000&path={base}",
-                                       headers={"Authorization": f"Bearer {token}"})
-            up_content = up_response.json()
-            if up_response.status_code != 200:
-                if 'error_code' not in up_content:
-                    print(f"Unknown error: {up_content}")
-                    return False
-                elif 'error_code' in up_content:
-                    print(f"Error: {up_content['error_code']}")
-                    return False
-            elif 'files' not in up_content:
-                print(f"Directory '{base}' does not exist")
-                return False
-            elif len(up_content['files']) != 1:
-                print(f"Multiple files found in directory '{base}' matching name '{file}'")
-                return False
-            elif up_content['files'][0]['label'] != file:
-                print(f"File '{file}' does not exist in directory '{base}'")
-                return False
-            else:
-                input_type = 'file'
+def delete_paths(paths: List[str], token: str, missing_ok: bool = False):
+    with TerrainClient.request(
+            'POST',
+            'delete',
+            f"{TERRAIN_URL}/secured/filesystem/delete",
+            data=json.dumps({'paths': paths}),
+            headers={'Authorization': f"Bearer {token}", "Content-Type": 'application/json;charset=utf-8'}) as response:
+        # e.g., an earlier attempt deleted it but the response was lost
+        if missing_ok and response.status_code == 500 and response.json().get('error_code', None) == 'ERR_DOES_NOT_EXIST': pass
+        else: response.raise_for_status()
+    invalidate(paths, token)
+
+
+@retry(
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    stop=stop_after_attempt(3),
+    retry=(retry_if_exception_type(ConnectionError) | retry_if_exception_type(
+        RequestException) | retry_if_exception_type(ReadTimeout) | retry_if_exception_type(
+        Timeout) | retry_if_exception_type(HTTPError)))
+def rename_path(from_path: str, to_path: str, token: str):
+    with TerrainClient.request(
+            'POST',
+            'rename',
+            f"{TERRAIN_URL}/secured/filesystem/rename",
+            data=json.dumps({'source': from_path, 'dest': to_path}),
+            headers={'Authorization': f"Bearer {token}", "Content-Type": 'application/json;charset=utf-8'}) as response:
+        # if the source is gone but the destination is there, an earlier attempt went through but the response was lost
+        if not (response.status_code == 500 and response.json().get('error_code', None) == 'ERR_DOES_NOT_EXIST' and
+                _exists_uncached(to_path, token)):
+            response.raise_for_status()
+    invalidate([from_path, to_path], token)
+
+
+def _exists_uncached(path: str, token: str) -> bool:
+    try:
+        return get_file(path, token, cached=False) is not None
+    except ValueError:
+        return False
+
+
+def upload_name(name: str) -> str:
+    """
+    Returns: A temporary name to upload a replacement for the given file under, before it's moved over the original.
+    """
+
+    return f".{name}.{uuid.uuid4().hex[:8]}.upload"
+
+
+def push_file(from_path: str, to_prefix: str, token: str, overwrite: bool = False, check: bool = True, replace: bool = False) -> dict:
+    """
+    Uploads a local file to the given Data Store directory. The request body is streamed from disk rather than buffered.
+    If a file with the same name, size and checksum already exists remotely the upload is skipped. If the remote file differs,
+    it is replaced when `overwrite` is set and otherwise left alone. Callers which already know the remote state can disable the
+    `check`, in which case the file is uploaded directly, or with `replace` is known to differ and is replaced.
+
+    Replacements are uploaded under a temporary name and only moved over the remote file once they've landed, so a failed upload
+    leaves the previous copy in place. Each step (the upload, deleting the previous copy and moving the new one into place) is
+    retried on its own, so a transient failure late on doesn't upload the file again.
+
+    Returns: A summary of the transfer, with keys 'path', 'status' ('uploaded', 'skipped' or 'exists'), 'bytes', 'seconds' and 'bytes_per_second'.
+    """
+
+    to_path = join(to_prefix, basename(from_path))
+    size = getsize(from_path)
+    result = {'path': to_path, 'status': 'skipped', 'bytes': size, 'seconds': 0.0, 'bytes_per_second': 0.0}
+
+    try:
+        remote = get_file(to_path, token, cached=False) if check else None
+    except ValueError:
+        remote = None
+
+    if remote is not None:
+        if remote_file_matches(from_path, remote):
+            print(f"File '{to_path}' already exists with the same size and checksum, skipping upload")
+            return result
+        elif not overwrite:
+            print(f"File '{to_path}' already exists, skipping upload")
+            result['status'] = 'exists'
+            return result
         else:
-            return False
-    return True, input_type
+            print(f"File '{to_path}' differs from '{from_path}', replacing it")
+            replace = True
+
+    name = upload_name(basename(from_path)) if replace else basename(from_path)
+    print(f"Uploading '{from_path}' to '{to_prefix}'" + (f" (as '{name}')" if replace else ''))
+    start = time.monotonic()
+    # a replacement's temporary name is unique to this push, so if it already exists, an earlier attempt landed
+    if not _upload_file(from_path, name, to_prefix, token) and not replace:
+        print(f"File '{to_path}' already exists, skipping upload")
+        result['status'] = 'exists'
+        return result
+
+    seconds = time.monotonic() - start
+    if replace:
+        # the old copy is only deleted once its replacement has landed (the rename can't overwrite it)
+        upload_path = join(to_prefix, name)
+        try:
+            delete_paths([to_path], token, missing_ok=True)
+        except Exception:
+            # the old copy is still there, so drop the new one rather than leave it lying around
+            logger.warning(f"Failed to delete '{to_path}' to replace it, keeping it")
+            _try_delete_paths([upload_path], token)
+            raise
+        try:
+            rename_path(upload_path, to_path, token)
+        except Exception:
+            logger.warning(f"Failed to move '{upload_path}' over '{to_path}', the new copy is left at '{upload_path}'")
+            raise
+
+    invalidate([to_path], token)
+    result['status'] = 'uploaded'
+    result['seconds'] = seconds
+    result['bytes_per_second'] = size / seconds if seconds > 0 else 0.0
+    UPLOAD_STATS.append(result)
+    logger.info(f"Uploaded '{from_path}' to '{to_prefix}' ({size} bytes in {seconds:.2f}s, {result['bytes_per_second'] / 1024 / 1024:.2f} MB/s)")
+    return result
 
 
 @retry(
@@ -183,35 +714,188 @@ def path_exists(path, token):
     retry=(retry_if_exception_type(ConnectionError) | retry_if_exception_type(
         RequestException) | retry_if_exception_type(ReadTimeout) | retry_if_exception_type(
         Timeout) | retry_if_exception_type(HTTPError)))
-def push_file(from_path: str, to_prefix: str, token: str):
-    print(f"Uploading '{from_path}' to '{to_prefix}'")
+def _upload_file(from_path: str, name: str, to_prefix: str, token: str) -> bool:
+    """
+    Streams a local file to the given Data Store directory under the given name.
+
+    Returns: True if the file was uploaded, False if one by that name already exists.
+    """
+
     with open(from_path, 'rb') as file:
-        with requests.post(f"https://de.cyverse.org/terrain/secured/fileio/upload?dest={to_prefix}",
-                           headers={'Authorization': f"Bearer {token}"},
-                           files={'file': (basename(from_path), file, 'application/octet-stream')}) as response:
-            if response.status_code == 500 and response.json()['error_code'] == 'ERR_EXISTS':
-                print(f"File '{join(to_prefix, basename(file.name))}' already exists, skipping upload")
-            else:
-                response.raise_for_status()
+        encoder = MultipartEncoder(fields={'file': (name, file, 'application/octet-stream')})
+        with TerrainClient.request('POST',
+                                   'upload',
+                                   f"{TERRAIN_URL}/secured/fileio/upload",
+                                   params={'dest': to_prefix},
+                                   headers={'Authorization': f"Bearer {token}", 'Content-Type': encoder.content_type},
+                                   data=encoder) as response:
+            if response.status_code == 500 and response.json()['error_code'] == 'ERR_EXISTS': return False
+            response.raise_for_status()
+            return True
+
+
+def _try_delete_paths(paths: List[str], token: str):
+    try:
+        delete_paths(paths, token)
+    except Exception as e:
+        logger.warning(f"Failed to delete {paths}: {e}")
+
+
+def _try_push_file(from_path: str, to_prefix: str, token: str, overwrite: bool, check: bool, replace: bool = False) -> dict:
+    # push_file retries on its own, so a file that still fails is reported rather than raised to keep the other uploads going
+    try:
+        return push_file(from_path, to_prefix, token, overwrite, check, replace)
+    except Exception as e:
+        logger.warning(f"Failed to upload '{from_path}' to '{to_prefix}': {e}")
+        return {'path': join(to_prefix, basename(from_path)), 'status': 'failed', 'error': str(e)}
+
+
+def iter_push_files(from_paths: List[str],
+                    to_prefix: str,
+                    token: str,
+                    concurrency: int = None,
+                    overwrite: bool = False,
+                    check: bool = True,
+                    replace: List[str] = None) -> Iterator[dict]:
+    """
+    Uploads several local files to the given Data Store directory, at most `concurrency` at a time (by default `TERRAIN_UPLOAD_CONCURRENCY`).
+    All uploads share the client's connection pool, and each file is retried independently. This method is a generator and yields one
+    transfer summary (see `push_file`) per file, in the same order as the given paths, with 'index' and 'total' keys for progress.
+    Files that fail after retrying have status 'failed' and an 'error' message. Local paths listed in `replace` are known to differ from
+    their remote counterparts, which are replaced (see `push_file`).
+    """
+
+    workers = concurrency if concurrency is not None else TERRAIN_UPLOAD_CONCURRENCY
+    replace = set(replace) if replace is not None else set()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(_try_push_file, path, to_prefix, token, overwrite, check, path in replace) for path in from_paths]
+        for i, future in enumerate(futures):
+            result = future.result()
+            result['index'] = i + 1
+            result['total'] = len(futures)
+            yield result
+
+
+def push_files(from_paths: List[str], to_prefix: str, token: str, concurrency: int = None, overwrite: bool = False) -> List[dict]:
+    """
+    Uploads several local files to the given Data Store directory (see `iter_push_files`).
+
+    Returns: Per-file transfer summaries, in the same order as the given paths.
+    """
+
+    return list(iter_push_files(from_paths, to_prefix, token, concurrency, overwrite))
+
+
+def upload_stats() -> dict:
+    """
+    Summarizes recent upload throughput, for tuning concurrency against the Terrain API.
+    """
+
+    uploads = list(UPLOAD_STATS)
+    total_bytes = sum(u['bytes'] for u in uploads)
+    total_seconds = sum(u['seconds'] for u in uploads)
+    return {
+        'files': len(uploads),
+        'bytes': total_bytes,
+        'seconds': total_seconds,
+        'mean_bytes_per_second': total_bytes / total_seconds if total_seconds > 0 else 0.0,
+        'recent': uploads[-10:]
+    }
+
+
+def diff_dir(from_paths: List[str], to_prefix: str, token: str, compare: str = 'size', concurrency: int = None) -> dict:
+    """
+    Compares local files against the contents of a Data Store directory, which is listed once (all pages).
+    With `compare='size'` a file counts as changed if its size differs or it was modified locally after the remote copy;
+    with `compare='checksum'` files of equal size are also compared by md5.
+
+    Returns: A manifest diff with keys 'new', 'changed' and 'unchanged' (lists of local paths).
+    """
+
+    if compare not in ('size', 'checksum'): raise ValueError(f"Unsupported comparison '{compare}' (expected 'size' or 'checksum')")
+
+    try:
+        remote = {file['label']: file for file in iter_dir(to_prefix, token, cached=False)}
+    except ValueError:
+        remote = {}
+
+    new, changed, unchanged, same_size = [], [], [], []
+    for path in from_paths:
+        file = remote.get(basename(path), None)
+        if file is None: new.append(path)
+        elif int(file['file-size']) != getsize(path): changed.append(path)
+        elif compare == 'checksum': same_size.append(path)
+        elif getmtime(path) * 1000 > int(file['date-modified']): changed.append(path)
+        else: unchanged.append(path)
+
+    if len(same_size) > 0:
+        stats = stat_many([join(to_prefix, basename(path)) for path in same_size], token, cached=False, concurrency=concurrency)
+        for path in same_size:
+            stat = stats[join(to_prefix, basename(path))]
+            if stat is None: new.append(path)
+            else: (unchanged if remote_file_matches(path, stat) else changed).append(path)
+
+    return {'new': new, 'changed': changed, 'unchanged': unchanged}
+
+
+def sync_dir(from_paths: List[str],
+             to_prefix: str,
+             token: str,
+             compare: str = 'size',
+             dry_run: bool = False,
+             concurrency: int = None) -> dict:
+    """
+    Uploads only those local files which are missing from, or differ from, their counterparts in the given Data Store directory
+    (see `diff_dir`). Changed files are replaced, each only once its new copy has been uploaded. With `dry_run` nothing is uploaded or deleted.
+
+    Returns: The manifest diff, plus an 'uploaded' list of transfer summaries (see `push_file`).
+    """
+
+    report = diff_dir(from_paths, to_prefix, token, compare, concurrency)
+    report['dry_run'] = dry_run
+    report['uploaded'] = []
+    print(f"Syncing {len(from_paths)} file(s) to '{to_prefix}': {len(report['new'])} new, {len(report['changed'])} changed, "
+          f"{len(report['unchanged'])} unchanged" + (" (dry run)" if dry_run else ''))
+    if dry_run: return report
+
+    for result in iter_push_files(report['new'] + report['changed'], to_prefix, token, concurrency, check=False, replace=report['changed']):
+        print(f"[{result['index']}/{result['total']}] {result['path']}: {result['status']}")
+        report['uploaded'].append(result)
+
+    return report
 
 
 def push_dir(from_path: str,
              to_prefix: str,
+             token: str,
              include_patterns: List[str] = None,
              include_names: List[str] = None,
              exclude_patterns: List[str] = None,
-             exclude_names: List[str] = None):
+             exclude_names: List[str] = None,
+             concurrency: int = None,
+             overwrite: bool = False,
+             sync: bool = False,
+             compare: str = 'size',
+             dry_run: bool = False):
     is_file = isfile(from_path)
     is_dir = isdir(from_path)
 
     if not (is_dir or is_file):
         raise FileNotFoundError(f"Local path '{from_path}' does not exist")
     elif is_dir:
-        from_paths = list_files(from_path, include_patterns, include_names, exclude_patterns, exclude_names)
-        print(f"Uploading directory '{from_path}' with {len(from_paths)} file(s) to '{to_prefix}'")
-        with closing(Pool(processes=multiprocessing.cpu_count())) as pool:
-            pool.starmap(push_file, [(path, to_prefix) for path in [str(p) for p in from_paths]])
+        from_paths = [str(p) for p in list_files(from_path, include_patterns, include_names, exclude_patterns, exclude_names)]
+        if sync:
+            results = sync_dir(from_paths, to_prefix, token, compare, dry_run, concurrency)['uploaded']
+        else:
+            print(f"Uploading directory '{from_path}' with {len(from_paths)} file(s) to '{to_prefix}'")
+            results = []
+            for result in iter_push_files(from_paths, to_prefix, token, concurrency, overwrite):
+                print(f"[{result['index']}/{result['total']}] {result['path']}: {result['status']}")
+                results.append(result)
+        failed = [result['path'] for result in results if result['status'] == 'failed']
+        if len(failed) > 0:
+            raise ValueError(f"Failed to upload {len(failed)} file(s) to '{to_prefix}': {', '.join(failed)}")
     elif is_file:
-        push_file(from_path, to_prefix)
+        push_file(from_path, to_prefix, token, overwrite)
     else:
         raise ValueError(f"Remote path '{to_prefix}' is a file; specify a directory path instead")
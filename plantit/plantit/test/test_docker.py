@@ -0,0 +1,66 @@
+import asyncio
+import json
+import time
+from unittest import mock
+
+import httpx
+import requests
+from asgiref.sync import async_to_sync
+from django.test import TestCase
+
+import plantit.docker as docker
+
+
+def response(status_code: int, content: dict = None) -> requests.Response:
+    mocked = requests.Response()
+    mocked.status_code = status_code
+    mocked._content = b'{}' if content is None else json.dumps(content).encode()
+    return mocked
+
+
+class GetImageTests(TestCase):
+    key = docker.image_key('alpine', None, 'latest')
+
+    def tearDown(self):
+        docker.RedisClient.get().delete(self.key)
+
+    def test_found_image_is_cached(self):
+        with mock.patch.object(docker.requests, 'get', return_value=response(200, {'name': 'latest', 'digest': 'sha256:abc'})) as get:
+            self.assertTrue(docker.get_image('alpine', None, 'latest')['exists'])
+            self.assertEqual('sha256:abc', docker.get_image('alpine', None, 'latest')['digest'])
+            self.assertEqual(1, get.call_count)
+
+    def test_missing_image_is_cached(self):
+        with mock.patch.object(docker.requests, 'get', return_value=response(404)):
+            self.assertFalse(docker.image_exists('alpine', None, 'latest'))
+        self.assertIsNotNone(docker.get_cached_image(self.key))
+
+    def test_rate_limit_without_cache_is_unknown_and_not_cached(self):
+        with mock.patch.object(docker.requests, 'get', return_value=response(429)) as get:
+            self.assertIsNone(docker.image_exists('alpine', None, 'latest'))
+            self.assertEqual(1, get.call_count)
+        self.assertIsNone(docker.get_cached_image(self.key))
+
+    def test_outage_with_stale_cache_serves_stale(self):
+        stale = {'exists': True, 'digest': 'sha256:abc', 'last_updated': None, 'checked': time.time() - docker.DOCKER_IMAGE_CACHE_TTL - 1}
+        docker.set_cached_image(self.key, stale)
+        with mock.patch.object(docker.requests, 'get', return_value=response(503)):
+            self.assertEqual(stale, docker.get_image('alpine', None, 'latest'))
+
+    def test_async_rate_limit_without_cache_is_unknown(self):
+        request = httpx.Request('GET', docker.image_url('alpine', None, 'latest'))
+        with mock.patch.object(httpx.AsyncClient, 'get', return_value=httpx.Response(429, request=request)) as get:
+            self.assertIsNone(asyncio.run(docker.image_exists_async('alpine', None, 'latest')))
+            self.assertEqual(1, get.call_count)
+
+    def test_async_client_is_shared_across_event_loops(self):
+        clients = []
+
+        async def get(client, url, **kwargs):
+            clients.append(client)
+            return httpx.Response(404, request=httpx.Request('GET', url))
+
+        with mock.patch.object(httpx.AsyncClient, 'get', autospec=True, side_effect=get):
+            # each async_to_sync call (as from a Celery task or sync view) runs on a new event loop
+            for _ in range(2): async_to_sync(docker.fetch_image_async)('alpine', None, 'latest')
+        self.assertIs(clients[0], clients[1])
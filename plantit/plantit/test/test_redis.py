@@ -0,0 +1,152 @@
+import asyncio
+import json
+import threading
+import time
+import zlib
+
+from django.test import TestCase
+
+from plantit.redis import RedisClient, LocalCache, LOCAL_CACHE_CHANNEL, single_flight, single_flight_async, _acquire, _release, encode, decode, CODEC_JSON, CODEC_JSON_ZLIB, \
+    CACHE_COMPRESSION_THRESHOLD
+
+
+class CodecTests(TestCase):
+    def padded(self, size: int) -> str:
+        # a JSON string encoding to exactly `size` bytes (the quotes count)
+        return 'x' * (size - 2)
+
+    def test_small_value_is_plain_json(self):
+        value = {'name': 'workflow', 'tags': ['a', 'b'], 'count': 1, 'public': True, 'sha': None}
+        data = encode(value)
+        self.assertEqual(CODEC_JSON, data[:1])
+        self.assertEqual(value, json.loads(data[1:]))
+        self.assertEqual(value, decode(data))
+
+    def test_large_value_is_compressed(self):
+        value = {'readme': 'lorem ipsum ' * 1000}
+        data = encode(value)
+        self.assertEqual(CODEC_JSON_ZLIB, data[:1])
+        self.assertLess(len(data), len(json.dumps(value)))
+        self.assertEqual(value, json.loads(zlib.decompress(data[1:])))
+        self.assertEqual(value, decode(data))
+
+    def test_compression_threshold(self):
+        self.assertEqual(CODEC_JSON, encode(self.padded(CACHE_COMPRESSION_THRESHOLD - 1))[:1])
+        self.assertEqual(CODEC_JSON_ZLIB, encode(self.padded(CACHE_COMPRESSION_THRESHOLD))[:1])
+        self.assertEqual(self.padded(CACHE_COMPRESSION_THRESHOLD), decode(encode(self.padded(CACHE_COMPRESSION_THRESHOLD))))
+
+    def test_legacy_json_is_decoded(self):
+        value = {'name': 'workflow', 'tags': ['a']}
+        self.assertEqual(value, decode(json.dumps(value).encode()))
+        self.assertEqual(value, decode(json.dumps(value)))
+        self.assertEqual([1, 2], decode(b'[1, 2]'))
+
+
+class LocalCacheTests(TestCase):
+    key = 'tests/local_cache'
+
+    def setUp(self):
+        # entries are only kept once this process is subscribed to invalidations
+        LocalCache.get(self.key)
+        self.wait_for(lambda: LocalCache._LocalCache__subscribed)
+
+    def tearDown(self):
+        LocalCache.invalidate([self.key])
+
+    def wait_for(self, condition, timeout: float = 5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline: self.fail('Timed out')
+            time.sleep(0.01)
+
+    def test_put_then_get(self):
+        LocalCache.put(self.key, {'value': 1}, LocalCache.generation())
+        self.assertEqual({'value': 1}, LocalCache.get(self.key))
+
+    def test_invalidate_evicts(self):
+        LocalCache.put(self.key, {'value': 1}, LocalCache.generation())
+        LocalCache.invalidate([self.key])
+        self.assertIsNone(LocalCache.get(self.key))
+
+    def test_put_is_skipped_if_anything_was_invalidated_since_reading(self):
+        generation = LocalCache.generation()
+        LocalCache.invalidate(['tests/some_other_key'])
+        LocalCache.put(self.key, {'value': 'stale'}, generation)
+        self.assertIsNone(LocalCache.get(self.key))
+
+        LocalCache.put(self.key, {'value': 'fresh'}, LocalCache.generation())
+        self.assertEqual({'value': 'fresh'}, LocalCache.get(self.key))
+
+    def test_invalidation_from_another_process_evicts_and_bumps_generation(self):
+        generation = LocalCache.generation()
+        LocalCache.put(self.key, {'value': 1}, generation)
+        RedisClient.get().publish(LOCAL_CACHE_CHANNEL, json.dumps([self.key]))
+        self.wait_for(lambda: LocalCache.get(self.key) is None)
+        self.assertGreater(LocalCache.generation(), generation)
+
+
+class SingleFlightTests(TestCase):
+    name = 'tests/single_flight'
+
+    def tearDown(self):
+        RedisClient.get().delete(f"locks/{self.name}")
+
+    def hold(self, seconds: float = None):
+        # take the lock as another process would, optionally releasing it after a while
+        lock, stop = _acquire(self.name)
+        if seconds is not None: threading.Timer(seconds, _release, args=(self.name, lock, stop)).start()
+        return lock, stop
+
+    def test_leader_runs_and_releases(self):
+        with single_flight(self.name) as leader:
+            self.assertTrue(leader)
+            self.assertTrue(RedisClient.get().exists(f"locks/{self.name}"))
+        self.assertFalse(RedisClient.get().exists(f"locks/{self.name}"))
+
+    def test_leader_releases_on_error(self):
+        with self.assertRaises(ValueError):
+            with single_flight(self.name):
+                raise ValueError()
+        self.assertFalse(RedisClient.get().exists(f"locks/{self.name}"))
+
+    def test_waiter_waits_for_leader(self):
+        self.hold(0.5)
+        start = time.monotonic()
+        with single_flight(self.name) as leader:
+            self.assertFalse(leader)
+        self.assertGreaterEqual(time.monotonic() - start, 0.4)
+        self.assertFalse(RedisClient.get().exists(f"locks/{self.name}"))
+
+    def test_waiter_with_cache_returns_immediately(self):
+        lock, stop = self.hold()
+        try:
+            start = time.monotonic()
+            with single_flight(self.name, wait=False) as leader:
+                self.assertFalse(leader)
+            self.assertLess(time.monotonic() - start, 0.1)
+        finally:
+            _release(self.name, lock, stop)
+
+    def test_async_leader_and_waiters(self):
+        async def run():
+            async with single_flight_async(self.name) as leader:
+                self.assertTrue(leader)
+                async with single_flight_async(self.name, wait=False) as other:
+                    self.assertFalse(other)
+
+            # released, so the next caller leads
+            async with single_flight_async(self.name, wait=False) as leader:
+                self.assertTrue(leader)
+
+        asyncio.run(run())
+
+    def test_async_waiter_waits_for_leader(self):
+        self.hold(0.5)
+
+        async def run():
+            start = time.monotonic()
+            async with single_flight_async(self.name) as leader:
+                self.assertFalse(leader)
+            return time.monotonic() - start
+
+        self.assertGreaterEqual(asyncio.run(run()), 0.4)
@@ -0,0 +1,378 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from os.path import join, basename
+from unittest import mock
+
+import httpx
+from django.test import TestCase
+from requests import HTTPError, ConnectionError
+from tenacity import wait_none, RetryError
+
+import plantit.terrain as terrain
+
+
+def response(status_code: int = 200):
+    mocked = mock.MagicMock(status_code=status_code)
+    mocked.__enter__.return_value = mocked
+    if status_code >= 400: mocked.raise_for_status.side_effect = HTTPError(f"{status_code}")
+    return mocked
+
+
+def response_json(status_code: int, content: dict):
+    mocked = response(status_code)
+    mocked.json.return_value = content
+    return mocked
+
+
+class TerrainClientTests(TestCase):
+    def test_requests_share_a_session_and_use_endpoint_timeouts(self):
+        with mock.patch.object(terrain.TerrainClient.session(), 'request', return_value=response()) as request:
+            terrain.TerrainClient.request('GET', 'stat', 'https://example.com/stat')
+            terrain.TerrainClient.request('GET', 'stat', 'https://example.com/stat', timeout=1)
+        self.assertIs(terrain.TerrainClient.session(), terrain.TerrainClient.session())
+        self.assertEqual(terrain.TERRAIN_TIMEOUTS.get('stat', None), request.call_args_list[0].kwargs['timeout'])
+        self.assertEqual(1, request.call_args_list[1].kwargs['timeout'])
+
+    def test_latency_is_recorded_even_when_requests_fail(self):
+        before = terrain.TerrainClient.metrics().get('metrics-test', {'count': 0})['count']
+        with mock.patch.object(terrain.TerrainClient.session(), 'request', side_effect=ConnectionError('unreachable')):
+            with self.assertRaises(ConnectionError):
+                terrain.TerrainClient.request('GET', 'metrics-test', 'https://example.com')
+        self.assertEqual(before + 1, terrain.TerrainClient.metrics()['metrics-test']['count'])
+
+    def test_async_requests_share_a_client_across_event_loops(self):
+        clients = []
+
+        async def request(client, method, url, **kwargs):
+            clients.append(client)
+            return httpx.Response(200, request=httpx.Request(method, url))
+
+        with mock.patch.object(httpx.AsyncClient, 'request', autospec=True, side_effect=request):
+            for _ in range(2): asyncio.run(terrain.TerrainClient.request_async('GET', 'stat', 'https://example.com/stat'))
+        self.assertEqual(2, len(clients))
+        self.assertIs(clients[0], clients[1])
+
+
+class PushFileTests(TestCase):
+    def setUp(self):
+        self.file = tempfile.NamedTemporaryFile(suffix='.txt')
+        self.file.write(b'new contents')
+        self.file.flush()
+        self.to_path = join('/iplant/home/user/dir', basename(self.file.name))
+        self.remote = {'path': self.to_path, 'type': 'file', 'file-size': 3, 'md5': 'old'}
+        self.calls = []
+
+    def tearDown(self):
+        self.file.close()
+
+    def push(self, **responses):
+        # each endpoint answers with the next of its given responses (an exception is raised), or 200 once those run out
+        def request(method, endpoint, url, **kwargs):
+            if endpoint == 'upload': self.calls.append(('upload', kwargs['data'].fields['file'][0]))
+            elif endpoint == 'delete': self.calls.append(('delete', json.loads(kwargs['data'])['paths']))
+            elif endpoint == 'rename': self.calls.append(('rename', *json.loads(kwargs['data']).values()))
+            queued = responses.get(endpoint, [])
+            answer = queued.pop(0) if len(queued) > 0 else response(200)
+            if isinstance(answer, Exception): raise answer
+            return answer
+
+        with mock.patch.object(terrain._upload_file.retry, 'wait', wait_none()), \
+             mock.patch.object(terrain.delete_paths.retry, 'wait', wait_none()), \
+             mock.patch.object(terrain.rename_path.retry, 'wait', wait_none()), \
+             mock.patch.object(terrain, 'get_file', return_value=self.remote), \
+             mock.patch.object(terrain.TerrainClient, 'request', side_effect=request), \
+             mock.patch.object(terrain, 'invalidate'):
+            return terrain.push_file(self.file.name, '/iplant/home/user/dir', 'token', overwrite=True)
+
+    def endpoints(self):
+        return [call[0] for call in self.calls]
+
+    def test_replacement_is_uploaded_before_the_old_copy_is_deleted(self):
+        result = self.push()
+        self.assertEqual('uploaded', result['status'])
+        self.assertEqual(['upload', 'delete', 'rename'], self.endpoints())
+
+        uploaded_as = self.calls[0][1]
+        self.assertNotEqual(basename(self.file.name), uploaded_as)
+        self.assertEqual([self.to_path], self.calls[1][1])
+        self.assertEqual((join('/iplant/home/user/dir', uploaded_as), self.to_path), self.calls[2][1:])
+
+    def test_failed_replacement_keeps_the_old_copy(self):
+        with self.assertRaises(RetryError):
+            self.push(upload=[response(503)] * 3)
+        self.assertEqual(['upload'] * 3, self.endpoints())
+
+    def test_transient_rename_failure_retries_only_the_rename(self):
+        result = self.push(rename=[ConnectionError('connection reset')])
+        self.assertEqual('uploaded', result['status'])
+        self.assertEqual(['upload', 'delete', 'rename', 'rename'], self.endpoints())
+
+    def test_old_copy_already_deleted_is_not_an_error(self):
+        result = self.push(delete=[ConnectionError('connection reset'), response_json(500, {'error_code': 'ERR_DOES_NOT_EXIST'})])
+        self.assertEqual('uploaded', result['status'])
+        self.assertEqual(['upload', 'delete', 'delete', 'rename'], self.endpoints())
+
+    def test_rename_that_went_through_before_failing_is_not_an_error(self):
+        result = self.push(rename=[ConnectionError('connection reset'), response_json(500, {'error_code': 'ERR_DOES_NOT_EXIST'})])
+        self.assertEqual('uploaded', result['status'])
+        self.assertEqual(['upload', 'delete', 'rename', 'rename'], self.endpoints())
+
+    def test_replacement_upload_that_landed_before_failing_is_kept(self):
+        result = self.push(upload=[ConnectionError('connection reset'), response_json(500, {'error_code': 'ERR_EXISTS'})])
+        self.assertEqual('uploaded', result['status'])
+        self.assertEqual(self.calls[0][1], self.calls[1][1])
+        self.assertEqual(['upload', 'upload', 'delete', 'rename'], self.endpoints())
+
+
+class PushFilesTests(TestCase):
+    prefix = '/iplant/home/user/dir'
+
+    def test_uploads_are_bounded_and_reported_in_order(self):
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def push_file(from_path, to_prefix, token, overwrite, check, replace):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock: running[0] -= 1
+            return {'path': join(to_prefix, basename(from_path)), 'status': 'uploaded'}
+
+        paths = [f"/tmp/{i}.txt" for i in range(8)]
+        with mock.patch.object(terrain, 'push_file', side_effect=push_file):
+            results = terrain.push_files(paths, self.prefix, 'token', concurrency=3)
+        self.assertEqual([join(self.prefix, basename(path)) for path in paths], [result['path'] for result in results])
+        self.assertEqual(list(range(1, 9)), [result['index'] for result in results])
+        self.assertTrue(all(result['total'] == 8 for result in results))
+        self.assertEqual(3, peak[0])
+
+    def test_failed_file_does_not_stop_the_others(self):
+        def push_file(from_path, to_prefix, token, overwrite, check, replace):
+            if from_path.endswith('b.txt'): raise HTTPError('500')
+            return {'path': join(to_prefix, basename(from_path)), 'status': 'uploaded'}
+
+        with mock.patch.object(terrain, 'push_file', side_effect=push_file):
+            results = terrain.push_files(['/tmp/a.txt', '/tmp/b.txt', '/tmp/c.txt'], self.prefix, 'token')
+        self.assertEqual(['uploaded', 'failed', 'uploaded'], [result['status'] for result in results])
+        self.assertEqual('500', results[1]['error'])
+
+    def test_push_dir_raises_after_uploading_the_rest(self):
+        with tempfile.TemporaryDirectory() as dir:
+            for name in ['a.txt', 'b.txt']:
+                with open(join(dir, name), 'w') as file: file.write(name)
+
+            def push_file(from_path, to_prefix, token, overwrite, check, replace):
+                if from_path.endswith('a.txt'): raise HTTPError('500')
+                return {'path': join(to_prefix, basename(from_path)), 'status': 'uploaded'}
+
+            with mock.patch.object(terrain, 'push_file', side_effect=push_file) as pushed, \
+                 self.assertRaisesRegex(ValueError, 'Failed to upload 1 file'):
+                terrain.push_dir(dir, self.prefix, 'token')
+            self.assertEqual(2, pushed.call_count)
+
+
+class DiffDirTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.prefix = '/iplant/home/user/dir'
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def local(self, name: str, contents: bytes, mtime: int = 1000) -> str:
+        path = join(self.dir.name, name)
+        with open(path, 'wb') as file: file.write(contents)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def remote(self, name: str, size: int, modified: int = 2000, md5: str = None) -> dict:
+        file = {'label': name, 'path': join(self.prefix, name), 'type': 'file', 'file-size': size, 'date-modified': modified * 1000}
+        if md5 is not None: file['md5'] = md5
+        return file
+
+    def diff(self, paths, remote, compare):
+        stats = {file['path']: file for file in remote}
+        with mock.patch.object(terrain, 'iter_dir', return_value=iter(remote)), \
+             mock.patch.object(terrain, 'stat_many', side_effect=lambda ps, *args, **kwargs: {p: stats.get(p, None) for p in ps}):
+            return terrain.diff_dir(paths, self.prefix, 'token', compare)
+
+    def test_missing_file_is_new(self):
+        path = self.local('a.txt', b'abc')
+        self.assertEqual({'new': [path], 'changed': [], 'unchanged': []}, self.diff([path], [], 'size'))
+
+    def test_different_size_is_changed(self):
+        path = self.local('a.txt', b'abc')
+        diff = self.diff([path], [self.remote('a.txt', 4)], 'size')
+        self.assertEqual([path], diff['changed'])
+
+    def test_same_size_modified_locally_since_is_changed(self):
+        path = self.local('a.txt', b'abc', mtime=3000)
+        diff = self.diff([path], [self.remote('a.txt', 3, modified=2000)], 'size')
+        self.assertEqual([path], diff['changed'])
+
+    def test_same_size_not_modified_since_is_unchanged(self):
+        path = self.local('a.txt', b'abc', mtime=1000)
+        diff = self.diff([path], [self.remote('a.txt', 3, modified=2000)], 'size')
+        self.assertEqual([path], diff['unchanged'])
+
+    def test_same_size_and_checksum_is_unchanged_whatever_the_mtime(self):
+        path = self.local('a.txt', b'abc', mtime=3000)
+        diff = self.diff([path], [self.remote('a.txt', 3, modified=2000, md5=terrain.file_md5(path))], 'checksum')
+        self.assertEqual([path], diff['unchanged'])
+
+    def test_same_size_different_checksum_is_changed(self):
+        path = self.local('a.txt', b'abc', mtime=1000)
+        diff = self.diff([path], [self.remote('a.txt', 3, modified=2000, md5='0' * 32)], 'checksum')
+        self.assertEqual([path], diff['changed'])
+
+    def test_sync_replaces_changed_files_without_deleting_them_first(self):
+        new, changed, unchanged = self.local('a.txt', b'abc'), self.local('b.txt', b'abcd'), self.local('c.txt', b'abc')
+        remote = [self.remote('b.txt', 3), self.remote('c.txt', 3)]
+        pushed = []
+
+        def push(path, to_prefix, token, overwrite, check, replace):
+            pushed.append((basename(path), replace))
+            return {'path': join(to_prefix, basename(path)), 'status': 'uploaded'}
+
+        with mock.patch.object(terrain, 'iter_dir', return_value=iter(remote)), \
+             mock.patch.object(terrain, 'push_file', side_effect=push), \
+             mock.patch.object(terrain, 'delete_paths') as delete_paths:
+            report = terrain.sync_dir([new, changed, unchanged], self.prefix, 'token')
+
+        delete_paths.assert_not_called()
+        self.assertEqual([unchanged], report['unchanged'])
+        self.assertEqual([('a.txt', False), ('b.txt', True)], pushed)
+
+
+class CachedListingTests(TestCase):
+    def setUp(self):
+        self.path = '/iplant/home/user/listing'
+        self.key = terrain._cache_key('listings', self.path, 'token')
+        self.files = [{'label': f"{i}.txt", 'path': f"{self.path}/{i}.txt"} for i in range(5)]
+
+    def tearDown(self):
+        terrain.RedisClient.get().delete(self.key, f"{self.key}/lock")
+
+    def page(self, path, token, limit, offset=0):
+        return {'files': self.files[offset:offset + limit]}
+
+    def test_listing_is_filled_and_unlocked_before_the_first_page_is_read(self):
+        redis = terrain.RedisClient.get()
+        with mock.patch.object(terrain, 'list_dir_page', side_effect=self.page) as list_dir_page:
+            pages = terrain._iter_dir_cached(self.path, 'token', 2)
+            first = next(pages)
+            self.assertFalse(redis.exists(f"{self.key}/lock"))
+            self.assertEqual(5, redis.llen(self.key))
+            self.assertEqual(self.files, first + [file for files in pages for file in files])
+            self.assertEqual(3, list_dir_page.call_count)
+
+    def test_cached_listing_is_served_without_listing_again(self):
+        with mock.patch.object(terrain, 'list_dir_page', side_effect=self.page) as list_dir_page:
+            list(terrain.iter_dir(self.path, 'token', page_size=2))
+            self.assertEqual(self.files, list(terrain.iter_dir(self.path, 'token', page_size=2)))
+            self.assertEqual(3, list_dir_page.call_count)
+
+
+class FiletypeFilterTests(TestCase):
+    path = '/iplant/home/user/images'
+    files = [{'label': label, 'path': f"/iplant/home/user/images/{label}"} for label in
+             ['a.JPG', 'b.jpeg', 'c.png', 'd.txt', 'e.jpg.txt', 'f.PNG', 'g']]
+
+    def page(self, path, token, limit, offset=0):
+        return {'files': self.files[offset:offset + limit], 'total': len(self.files)}
+
+    def test_count_matches_listing(self):
+        with mock.patch.object(terrain, 'list_dir_page', side_effect=self.page), \
+             mock.patch.object(terrain, 'TERRAIN_PAGE_SIZE', 2):
+            for filetypes, expected in [(['jpg'], 3), (['png', 'txt'], 4), (['tif'], 0), (None, 7)]:
+                listed = list(terrain.iter_dir(self.path, 'token', filetypes=filetypes, cached=False))
+                self.assertEqual(expected, len(listed))
+                self.assertEqual(len(listed), terrain.count_dir(self.path, 'token', filetypes=filetypes, cached=False))
+
+
+class StatAsyncTests(TestCase):
+    path = '/iplant/home/user/dir'
+
+    def tearDown(self):
+        terrain.RedisClient.get().delete(terrain._cache_key('stats', self.path, 'token'))
+
+    def exists(self, response: httpx.Response, calls: int = 1):
+        response.request = httpx.Request('POST', f"{terrain.TERRAIN_URL}/secured/filesystem/stat")
+        request = mock.AsyncMock(return_value=response)
+        with mock.patch.object(terrain.TerrainClient, 'request_async', request):
+            results = [asyncio.run(terrain.path_exists_async(self.path, 'token')) for _ in range(calls)]
+        return results, request
+
+    def test_directory_is_found_and_cached(self):
+        results, request = self.exists(httpx.Response(200, json={'paths': {f"{self.path}/": {'type': 'dir'}}}), calls=2)
+        self.assertEqual([(True, 'directory'), (True, 'directory')], results)
+        self.assertEqual(1, request.call_count)
+
+    def test_missing_path_is_not_cached(self):
+        results, request = self.exists(httpx.Response(500, json={'error_code': 'ERR_DOES_NOT_EXIST'}), calls=2)
+        self.assertEqual([False, False], results)
+        self.assertEqual(2, request.call_count)
+
+
+class StatManyTests(TestCase):
+    existing = {f"/iplant/home/user/{name}": {'path': f"/iplant/home/user/{name}", 'type': 'file'} for name in ('a', 'b', 'c', 'd')}
+
+    def setUp(self):
+        self.batches = []
+
+    def stat(self, name_missing: bool):
+        def request(method, endpoint, url, **kwargs):
+            paths = json.loads(kwargs['data'])['paths']
+            self.batches.append(paths)
+            missing = [path for path in paths if path not in self.existing]
+            if len(missing) == 0: return response_json(200, {'paths': {path: self.existing[path] for path in paths}})
+            # Terrain sometimes names the missing paths in a different form than they were sent, or not at all
+            return response_json(500, {'error_code': 'ERR_DOES_NOT_EXIST', **({'paths': [f"{missing[0]}/"]} if name_missing else {})})
+        return request
+
+    def stat_many(self, paths, name_missing: bool = True):
+        with mock.patch.object(terrain.TerrainClient, 'request', side_effect=self.stat(name_missing)):
+            return terrain.stat_many(paths, 'token', cached=False)
+
+    def test_named_missing_paths_are_dropped(self):
+        stats = self.stat_many(['/iplant/home/user/a', '/iplant/home/user/x', '/iplant/home/user/b'])
+        self.assertIsNone(stats['/iplant/home/user/x'])
+        self.assertEqual('/iplant/home/user/a', stats['/iplant/home/user/a']['path'])
+        self.assertEqual('/iplant/home/user/b', stats['/iplant/home/user/b']['path'])
+        self.assertEqual(2, len(self.batches))
+
+    def test_unnamed_missing_paths_are_found_by_bisecting(self):
+        stats = self.stat_many(['/iplant/home/user/a', '/iplant/home/user/b', '/iplant/home/user/x', '/iplant/home/user/c'], name_missing=False)
+        self.assertEqual({'/iplant/home/user/a', '/iplant/home/user/b', '/iplant/home/user/c'}, set(p for p, stat in stats.items() if stat is not None))
+        self.assertIsNone(stats['/iplant/home/user/x'])
+
+    def test_missing_paths_named_differently_than_sent_are_still_dropped(self):
+        with mock.patch.object(terrain.TerrainClient, 'request') as request:
+            request.side_effect = [
+                response_json(500, {'error_code': 'ERR_DOES_NOT_EXIST', 'paths': ['/elsewhere']}),
+                response_json(200, {'paths': {'/iplant/home/user/a': self.existing['/iplant/home/user/a']}}),
+                response_json(500, {'error_code': 'ERR_DOES_NOT_EXIST'})]
+            stats = terrain.stat_many(['/iplant/home/user/a', '/iplant/home/user/x'], 'token', cached=False)
+        self.assertIsNotNone(stats['/iplant/home/user/a'])
+        self.assertIsNone(stats['/iplant/home/user/x'])
+
+    def test_paths_with_trailing_slashes_are_found(self):
+        stats = self.stat_many(['/iplant/home/user/a/', '/iplant/home/user/b'])
+        self.assertEqual('/iplant/home/user/a', stats['/iplant/home/user/a/']['path'])
+        self.assertEqual(1, len(self.batches))
+
+    def test_transient_failure_is_retried(self):
+        with mock.patch.object(terrain._stat_batch.retry, 'wait', wait_none()), \
+             mock.patch.object(terrain.TerrainClient, 'request') as request:
+            request.side_effect = [
+                ConnectionError('connection reset'),
+                response_json(200, {'paths': {'/iplant/home/user/a': self.existing['/iplant/home/user/a']}})]
+            stats = terrain.stat_many(['/iplant/home/user/a'], 'token', cached=False)
+        self.assertEqual('/iplant/home/user/a', stats['/iplant/home/user/a']['path'])
+        self.assertEqual(2, request.call_count)
@@ -1,8 +1,28 @@
+import asyncio
+import hashlib
 import os
+import threading
+import time
+import uuid
+from datetime import timedelta
+from unittest import mock
+
+import httpx
+import jwt
 import requests
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
 from django.test import TestCase
-from plantit.github import validate_repo_config
+from django.utils import timezone
+
+import plantit.github as github
+import plantit.utils as utils
+from plantit.agents.models import Agent
+from plantit.tasks.models import Task, TaskStatus
+from plantit.utils import user_index_entries, aggregate_user_task_statistics
+from plantit.github import validate_repo_config, validate_repo_config_schema, parse_repo_config
 from plantit.docker import image_exists
+from plantit.redis import RedisClient, _acquire, _release
 from plantit.terrain import path_exists
 
 
@@ -262,3 +282,498 @@ class UtilsTest(TestCase):
             'output': {'path': 'outputdir'}
         }, Token.get())
         self.assertTrue(result)
+
+
+class RepoConfigSchemaTests(TestCase):
+    valid = {
+        'name': 'Test Flow',
+        'author': 'Computational Plant Science Lab',
+        'image': 'docker://alpine',
+        'commands': 'echo "Hello, world!"'
+    }
+
+    def test_valid_config_has_no_errors(self):
+        self.assertEqual([], validate_repo_config_schema(self.valid))
+
+    def test_missing_required_attributes(self):
+        errors = validate_repo_config_schema({})
+        self.assertIn('Missing attribute \'name\'', errors)
+        self.assertIn('Missing attribute \'image\'', errors)
+        self.assertIn('Missing attribute \'commands\'', errors)
+
+    def test_wrong_types(self):
+        errors = validate_repo_config_schema({**self.valid, 'name': True, 'image': 1, 'commands': ['echo']})
+        self.assertIn('Attribute \'name\' must be a str', errors)
+        self.assertIn('Attribute \'image\' must be a str', errors)
+        self.assertIn('Attribute \'commands\' must be a str', errors)
+
+    def test_empty_mount(self):
+        self.assertIn('Attribute \'mount\' must not be empty', validate_repo_config_schema({**self.valid, 'mount': []}))
+
+    def test_bad_input_kind(self):
+        errors = validate_repo_config_schema({**self.valid, 'input': {'path': '', 'kind': 'folder'}})
+        self.assertIn('Attribute \'input.kind\' must be a string (either \'file\', \'files\', or \'directory\')', errors)
+
+    def test_bad_walltime(self):
+        self.assertIn('Attribute \'walltime\' must have format XX:XX:XX', validate_repo_config_schema({**self.valid, 'walltime': '1h'}))
+
+    def test_deprecated_attributes(self):
+        errors = validate_repo_config_schema({**self.valid, 'from': 'somewhere', 'to': 'elsewhere'})
+        self.assertIn('Attribute \'from\' is deprecated; use an \'input\' section instead', errors)
+        self.assertIn('Attribute \'to\' is deprecated; use an \'output\' section instead', errors)
+
+
+class ParseRepoConfigTests(TestCase):
+    def test_valid_config_is_parsed(self):
+        entry = parse_repo_config('name: Test Flow\nimage: docker://alpine\ncommands: echo "Hello, world!"\n')
+        self.assertEqual('Test Flow', entry['config']['name'])
+        self.assertEqual([], entry['errors'])
+
+    def test_invalid_config_is_parsed_with_errors(self):
+        entry = parse_repo_config('name: Test Flow\n')
+        self.assertEqual({'name': 'Test Flow'}, entry['config'])
+        self.assertIn('Missing attribute \'image\'', entry['errors'])
+
+    def test_missing_config(self):
+        for text in (None, '', '  \n'):
+            self.assertEqual({'config': None, 'errors': ['Configuration file missing']}, parse_repo_config(text))
+
+    def test_malformed_yaml(self):
+        entry = parse_repo_config('name: [unclosed')
+        self.assertIsNone(entry['config'])
+        self.assertTrue(entry['errors'][0].startswith('Failed to parse configuration'))
+
+    def test_config_must_be_a_mapping(self):
+        self.assertEqual({'config': None, 'errors': ['Configuration must be a YAML mapping']}, parse_repo_config('- name: Test Flow'))
+
+    def test_malformed_sections_are_reported_rather_than_raised(self):
+        entry = parse_repo_config('name: Test Flow\nimage: docker://alpine\ncommands: echo\ninput: directory\n')
+        self.assertEqual('Test Flow', entry['config']['name'])
+        self.assertTrue(entry['errors'][0].startswith('Malformed configuration'))
+
+
+class RepoBundleTests(TestCase):
+    repo = {'name': 'workflow', 'full_name': 'owner/workflow', 'owner': {'login': 'owner'}}
+
+    def bundle(self, config_error: Exception):
+        async def get_repo(owner, name, token): return self.repo
+        async def get_repo_config_bundle(owner, name, token): raise config_error
+
+        with mock.patch.object(github, 'get_repo', side_effect=get_repo), \
+             mock.patch.object(github, 'get_repo_config_bundle', side_effect=get_repo_config_bundle):
+            return asyncio.run(github.get_repo_bundle('owner', 'workflow', 'token'))
+
+    def status_error(self, status_code: int) -> httpx.HTTPStatusError:
+        request = httpx.Request('GET', 'https://api.github.com/repos/owner/workflow/commits/HEAD')
+        return httpx.HTTPStatusError(f"{status_code}", request=request, response=httpx.Response(status_code, request=request))
+
+    def test_missing_or_empty_repository_gets_a_placeholder(self):
+        bundle = self.bundle(ValueError('Bad response from GitHub for owner/workflow@HEAD: 409'))
+        self.assertEqual(self.repo, bundle['repo'])
+        self.assertEqual(dict(), bundle['config'])
+        self.assertFalse(bundle['validation']['is_valid'])
+
+    def test_rate_limit_is_raised(self):
+        with self.assertRaises(github.RateLimited):
+            self.bundle(github.RateLimited('exhausted'))
+
+    def test_network_error_is_raised(self):
+        with self.assertRaises(httpx.ConnectError):
+            self.bundle(httpx.ConnectError('unreachable', request=httpx.Request('GET', 'https://api.github.com/repos/owner/workflow')))
+
+    def test_server_error_is_raised(self):
+        with self.assertRaises(httpx.HTTPStatusError):
+            self.bundle(self.status_error(502))
+
+    def test_transient_errors(self):
+        self.assertTrue(github.is_transient(self.status_error(500)))
+        self.assertTrue(github.is_transient(self.status_error(429)))
+        self.assertFalse(github.is_transient(self.status_error(404)))
+        self.assertFalse(github.is_transient(ValueError('Repo owner/workflow not found')))
+
+
+class GraphQLRepoBundleTests(TestCase):
+    def node(self, **readmes) -> dict:
+        return {
+            'name': 'workflow',
+            'nameWithOwner': 'owner/workflow',
+            'owner': {'login': 'owner', 'avatarUrl': ''},
+            'description': None,
+            'url': 'https://github.com/owner/workflow',
+            'defaultBranchRef': {'name': 'main', 'target': {'oid': 'abc'}},
+            'repositoryTopics': {'nodes': []},
+            'primaryLanguage': None,
+            'stargazerCount': 0,
+            'forkCount': 0,
+            'isPrivate': False,
+            'isFork': False,
+            'createdAt': None,
+            'updatedAt': None,
+            'pushedAt': None,
+            'config': {'text': 'name: workflow'},
+            **{f"readme{github.README_NAMES.index(name)}": {'text': text} for name, text in readmes.items()}
+        }
+
+    def bundle(self, node: dict, readme: str = None):
+        async def query_repos(repos, token): return [node]
+        async def get_repo_config_bundle(owner, name, token, sha, text): return {'sha': sha, 'config': {}, 'validation': {'is_valid': True}}
+        async def get_repo_readme(owner, name, token): return readme
+
+        with mock.patch.object(github, 'query_repos', side_effect=query_repos), \
+             mock.patch.object(github, 'get_repo_config_bundle', side_effect=get_repo_config_bundle), \
+             mock.patch.object(github, 'get_repo_readme', side_effect=get_repo_readme) as rest:
+            bundles = asyncio.run(github.get_repo_bundles([('owner', 'workflow')], 'token'))
+        return bundles[('owner', 'workflow')], rest
+
+    def test_every_readme_name_is_queried(self):
+        for name in github.README_NAMES: self.assertIn(f"HEAD:{name}", github.GRAPHQL_REPO_FIELDS)
+
+    def test_first_readme_found_is_used(self):
+        bundle, rest = self.bundle(self.node(**{'README.rst': 'rst', 'readme.md': 'md'}))
+        self.assertEqual('rst', bundle['readme'])
+        rest.assert_not_called()
+
+    def test_readme_elsewhere_is_fetched_via_rest(self):
+        bundle, rest = self.bundle(self.node(), readme='docs')
+        self.assertEqual('docs', bundle['readme'])
+        rest.assert_called_once_with('owner', 'workflow', 'token')
+
+
+class WorkflowCacheSingleFlightTests(TestCase):
+    owner = 'someone'
+
+    def tearDown(self):
+        redis = RedisClient.get()
+        redis.delete(f"workflow_owners/{self.owner}", f"locks/workflows/owner/{self.owner}")
+
+    def test_owner_lock_is_distinct_from_public_lock(self):
+        lock, stop = _acquire('workflows/public')
+        try:
+            with mock.patch.object(utils.Profile.objects, 'get', side_effect=utils.Profile.DoesNotExist) as get:
+                asyncio.run(utils.repopulate_personal_workflow_cache('public'))
+            get.assert_called_once()
+        finally:
+            _release('workflows/public', lock, stop)
+
+    def test_waiter_with_cache_returns_without_waiting(self):
+        RedisClient.get().sadd(f"workflow_owners/{self.owner}", 'workflow')
+        lock, stop = _acquire(f"workflows/owner/{self.owner}")
+        try:
+            start = time.monotonic()
+            with mock.patch.object(utils.Profile.objects, 'get') as get:
+                asyncio.run(utils.repopulate_personal_workflow_cache(self.owner))
+            get.assert_not_called()
+            self.assertLess(time.monotonic() - start, 1)
+        finally:
+            _release(f"workflows/owner/{self.owner}", lock, stop)
+
+    def test_leader_refreshes(self):
+        with mock.patch.object(utils.Profile.objects, 'get', side_effect=utils.Profile.DoesNotExist) as get:
+            asyncio.run(utils.repopulate_personal_workflow_cache(self.owner))
+        get.assert_called_once_with(github_username=self.owner)
+        self.assertFalse(RedisClient.get().exists(f"locks/workflows/owner/{self.owner}"))
+
+
+class CyVerseTokenTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='someone', password='password')
+        utils.Profile.objects.create(user=self.user, cyverse_access_token=self.token(60), cyverse_refresh_token='refresh')
+
+    def tearDown(self):
+        utils.cyverse_tokens.pop(self.user.username, None)
+        RedisClient.get().delete(f"locks/cyverse_tokens/{self.user.username}")
+
+    @staticmethod
+    def token(expires_in: int) -> str:
+        return jwt.encode({'exp': int(time.time()) + expires_in}, 'secret' * 8, algorithm='HS256')
+
+    def test_lock_is_held_for_as_long_as_the_refresh_takes(self):
+        refreshed = self.token(3600)
+        held = []
+
+        def refresh_tokens(username, refresh_token):
+            time.sleep(1.5)
+            held.append(RedisClient.get().exists(f"locks/cyverse_tokens/{username}"))
+            return refreshed, 'refreshed'
+
+        with mock.patch('plantit.redis.SINGLE_FLIGHT_LEASE', 1), \
+             mock.patch('plantit.utils.terrain.refresh_tokens', side_effect=refresh_tokens):
+            self.assertEqual(refreshed, utils.get_user_cyverse_token(self.user))
+        self.assertEqual([1], held)
+        self.assertFalse(RedisClient.get().exists(f"locks/cyverse_tokens/{self.user.username}"))
+
+    def test_waiter_uses_the_token_refreshed_by_the_holder(self):
+        refreshed = self.token(3600)
+        lock, stop = _acquire(f"cyverse_tokens/{self.user.username}")
+        # the holder has stored the refreshed token, but not yet released the lock
+        utils.Profile.objects.filter(user=self.user).update(cyverse_access_token=refreshed)
+
+        def finish():
+            time.sleep(0.3)
+            _release(f"cyverse_tokens/{self.user.username}", lock, stop)
+
+        with mock.patch('plantit.utils.terrain.refresh_tokens') as refresh_tokens:
+            thread = threading.Thread(target=finish)
+            thread.start()
+            token = utils.get_user_cyverse_token(self.user)
+            thread.join()
+        refresh_tokens.assert_not_called()
+        self.assertEqual(refreshed, token)
+
+
+class WorkflowIndexTests(TestCase):
+    owners = ['alice', 'bob']
+
+    def tearDown(self):
+        RedisClient.get().delete('workflow_bundles', 'workflow_public', *[f"{index}/{owner}" for owner in self.owners for index in ['workflow_owners', 'workflows_updated']])
+
+    def bundle(self, owner: str, name: str, public: bool = True) -> dict:
+        return {'repo': {'name': name, 'owner': {'login': owner}}, 'public': public, 'config': {'name': name}}
+
+    def names(self, bundles: list) -> list:
+        return [f"{bundle['repo']['owner']['login']}/{bundle['repo']['name']}" for bundle in bundles]
+
+    def test_listings_are_read_from_the_indexes(self):
+        utils.cache_workflow('alice', 'b', self.bundle('alice', 'b'))
+        utils.cache_workflow('alice', 'a', self.bundle('alice', 'a', public=False))
+        utils.cache_workflow('bob', 'c', self.bundle('bob', 'c'))
+        with mock.patch.object(RedisClient.get(), 'scan_iter') as scan_iter:
+            self.assertEqual(['alice/a', 'alice/b'], self.names(utils.list_cached_workflows(owner='alice')))
+            self.assertEqual(['alice/b', 'bob/c'], self.names(utils.list_cached_workflows(public=True)))
+            self.assertEqual(['alice/a', 'alice/b', 'bob/c'], self.names(utils.list_cached_workflows()))
+        scan_iter.assert_not_called()
+
+    def test_workflow_made_private_leaves_the_public_index(self):
+        utils.cache_workflow('alice', 'a', self.bundle('alice', 'a'))
+        utils.cache_workflow('alice', 'a', self.bundle('alice', 'a', public=False))
+        self.assertEqual([], utils.list_cached_workflows(public=True))
+        self.assertFalse(utils.get_cached_workflow('alice', 'a')['public'])
+
+    def test_emptying_an_owners_cache_leaves_other_owners(self):
+        utils.cache_workflow('alice', 'a', self.bundle('alice', 'a'))
+        utils.cache_workflow('bob', 'c', self.bundle('bob', 'c'))
+        self.assertEqual(1, utils.empty_personal_workflow_cache('alice'))
+        self.assertIsNone(utils.get_cached_workflow('alice', 'a'))
+        self.assertEqual(['bob/c'], self.names(utils.list_cached_workflows(public=True)))
+
+    def test_replacing_an_owners_workflows_drops_the_stale_ones(self):
+        utils.cache_workflow('alice', 'a', self.bundle('alice', 'a'))
+        utils.cache_workflow('alice', 'b', self.bundle('alice', 'b'))
+        utils.replace_cached_workflows('alice', [self.bundle('alice', 'b'), self.bundle('alice', 'c')])
+        self.assertEqual(['alice/b', 'alice/c'], self.names(utils.list_cached_workflows(owner='alice')))
+        self.assertEqual(['alice/b', 'alice/c'], self.names(utils.list_cached_workflows(public=True)))
+
+
+class UserIndexEntriesTests(TestCase):
+    def test_terms_are_lowercased_and_paired_with_username(self):
+        entries = user_index_entries({'username': 'jdoe', 'first_name': 'Jane', 'last_name': 'Doe', 'github_username': 'JaneD'})
+        self.assertEqual({'jdoe\x00jdoe', 'jane doe\x00jdoe', 'doe\x00jdoe', 'janed\x00jdoe'}, entries)
+
+    def test_terms_prefixing_other_terms_are_pruned(self):
+        # 'jane' prefixes both 'jane doe' and 'janed', so it matches nothing they don't
+        entries = user_index_entries({'username': 'jdoe', 'first_name': 'Jane', 'last_name': 'Doe', 'github_username': 'JaneD'})
+        self.assertNotIn('jane\x00jdoe', entries)
+
+    def test_duplicate_terms_are_indexed_once(self):
+        entries = user_index_entries({'username': 'doe', 'first_name': '', 'last_name': 'Doe'})
+        self.assertEqual({'doe\x00doe'}, entries)
+
+    def test_missing_and_blank_names_are_skipped(self):
+        entries = user_index_entries({'username': 'jdoe', 'first_name': None, 'last_name': ' ', 'github_username': None})
+        self.assertEqual({'jdoe\x00jdoe'}, entries)
+
+
+class UserTaskStatisticsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='password')
+        other = User.objects.create_user(username='other', password='password')
+        self.owned = Agent.objects.create(name='owned', guid='owned', user=self.user, workdir='/', username='user', hostname='owned')
+        self.guest = Agent.objects.create(name='guest', guid='guest', user=other, workdir='/', username='other', hostname='guest')
+        self.guest.users_authorized.add(self.user)
+        self.start = timezone.now() - timedelta(hours=1)
+
+        self.task('one', TaskStatus.SUCCESS, self.owned, completed=60, results=['a.png', 'b.png'])
+        self.task('one', TaskStatus.FAILURE, self.guest, completed=30)
+        self.task('two', TaskStatus.RUNNING, self.owned, results=['c.png'])  # not completed, so neither its runtime nor results count
+        self.task('one', TaskStatus.SUCCESS, self.guest, user=other, completed=600, results=['d.png'])
+
+    def task(self, workflow: str, status: str, agent: Agent, user: User = None, completed: int = None, results: list = None):
+        guid = str(uuid.uuid4())
+        return Task.objects.create(
+            guid=guid,
+            user=user if user is not None else self.user,
+            agent=agent,
+            token=guid[:40],
+            workflow={'config': {'name': workflow}},
+            workflow_owner='owner',
+            workflow_name=workflow,
+            status=status,
+            created=self.start,
+            completed=self.start + timedelta(seconds=completed) if completed is not None else None,
+            results=results)
+
+    def test_aggregates_only_the_users_tasks(self):
+        stats = async_to_sync(aggregate_user_task_statistics)(self.user)
+        self.assertEqual(3, stats['total_tasks'])
+        self.assertEqual(90, stats['total_task_seconds'])
+        self.assertEqual(2, stats['total_task_results'])
+        self.assertEqual({'values': [2, 1], 'labels': ['owner/one', 'owner/two']}, stats['workflow_usage'])
+        self.assertEqual({'values': [1, 2], 'labels': ['guest', 'owned']}, stats['agent_usage'])
+        self.assertEqual({'values': [1, 1, 1], 'labels': ['FAILURE', 'RUNNING', 'SUCCESS']}, stats['task_status'])
+        self.assertEqual(['owned'], stats['owned_agents'])
+        self.assertEqual(['guest'], stats['guest_agents'])
+
+    def test_user_without_tasks(self):
+        stats = async_to_sync(aggregate_user_task_statistics)(User.objects.create_user(username='new', password='password'))
+        self.assertEqual(0, stats['total_tasks'])
+        self.assertEqual(0, stats['total_task_seconds'])
+        self.assertEqual(0, stats['total_task_results'])
+        self.assertEqual({'values': [], 'labels': []}, stats['workflow_usage'])
+        self.assertEqual({'values': [], 'labels': []}, stats['task_status'])
+
+
+class ConnectableReposTests(TestCase):
+    repos = [{'name': f"workflow{i}", 'full_name': f"owner/workflow{i}", 'owner': {'login': 'owner'}} for i in range(6)]
+
+    def connectable(self, get_repo_config_bundle, concurrency: int = 2):
+        async def search(owner, token): return self.repos
+
+        async def connectable():
+            return await github.list_connectable_repos_by_owner('owner', 'token')
+
+        with mock.patch.object(github, 'search_connectable_repos_by_owner', side_effect=search), \
+             mock.patch.object(github, 'get_repo_config_bundle', side_effect=get_repo_config_bundle), \
+             mock.patch.object(github, 'GITHUB_CONCURRENCY', concurrency):
+            return asyncio.run(connectable())
+
+    def test_configs_are_fetched_concurrently_and_yielded_in_search_order(self):
+        running = [0]
+        peak = [0]
+
+        async def get_repo_config_bundle(owner, name, token):
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            # later repositories finish first
+            await asyncio.sleep(0.01 * (6 - int(name[-1])))
+            running[0] -= 1
+            return {'sha': name, 'config': {}, 'validation': {'is_valid': True}}
+
+        workflows = self.connectable(get_repo_config_bundle)
+        self.assertEqual([repo['name'] for repo in self.repos], [workflow['sha'] for workflow in workflows])
+        self.assertEqual(2, peak[0])
+
+    def test_invalid_config_gets_a_placeholder(self):
+        async def get_repo_config_bundle(owner, name, token):
+            if name == 'workflow1': raise ValueError('Bad response from GitHub for owner/workflow1@HEAD: 404')
+            return {'sha': name, 'config': {}, 'validation': {'is_valid': True}}
+
+        workflows = self.connectable(get_repo_config_bundle)
+        self.assertEqual(6, len(workflows))
+        self.assertFalse(workflows[1]['validation']['is_valid'])
+        self.assertIsNone(workflows[1]['sha'])
+
+    def test_rate_limit_is_raised(self):
+        async def get_repo_config_bundle(owner, name, token): raise github.RateLimited('exhausted')
+
+        with self.assertRaises(github.RateLimited):
+            self.connectable(get_repo_config_bundle)
+
+
+class ConditionalGetTests(TestCase):
+    url = 'https://api.github.com/repos/owner/workflow'
+
+    def tearDown(self):
+        redis = RedisClient.get()
+        for key in redis.scan_iter('github_responses/*'): redis.delete(key)
+
+    def get(self, *responses: httpx.Response, token: str = 'token'):
+        for response in responses: response.request = httpx.Request('GET', self.url)
+        request = mock.AsyncMock(side_effect=list(responses))
+        with mock.patch.object(github.GitHubClient, 'request', request):
+            results = [asyncio.run(github.conditional_get(self.url, token)) for _ in responses]
+        return results, [call.args[3] for call in request.call_args_list]
+
+    def test_not_modified_serves_the_cached_body(self):
+        (first, second), (_, revalidation) = self.get(
+            httpx.Response(200, headers={'ETag': '"abc"', 'Last-Modified': 'Mon, 19 Oct 2026 00:00:00 GMT'}, json={'name': 'workflow'}),
+            httpx.Response(304))
+        self.assertEqual('"abc"', revalidation['If-None-Match'])
+        self.assertEqual('Mon, 19 Oct 2026 00:00:00 GMT', revalidation['If-Modified-Since'])
+        self.assertEqual(200, second.status_code)
+        self.assertEqual(first.json(), second.json())
+
+    def test_response_without_validators_is_not_cached(self):
+        _, (_, second) = self.get(httpx.Response(200, json={}), httpx.Response(200, json={}))
+        self.assertNotIn('If-None-Match', second)
+
+    def test_cached_bodies_are_scoped_to_the_token(self):
+        self.get(httpx.Response(200, headers={'ETag': '"abc"'}, json={}))
+        _, (headers,) = self.get(httpx.Response(200, json={}), token='other')
+        self.assertNotIn('If-None-Match', headers)
+
+
+class GitHubRateLimitTests(TestCase):
+    def setUp(self):
+        self.budgets = github.GitHubClient._GitHubClient__budgets
+        self.budget = (hashlib.sha256('token'.encode()).hexdigest()[:16], 'core')
+        self.budgets[self.budget] = (10, time.time() + 3600)
+
+    def tearDown(self):
+        self.budgets.pop(self.budget, None)
+
+    def test_background_request_near_the_reserve_raises_rate_limited_without_requesting(self):
+        async def request():
+            with github.background_priority():
+                return await github.GitHubClient.request('GET', 'https://api.github.com/users/someone', 'token')
+
+        with mock.patch.object(github.httpx.AsyncClient, 'request') as http:
+            with self.assertRaises(github.RateLimited):
+                asyncio.run(request())
+            http.assert_not_called()
+
+    def test_client_is_shared_across_event_loops(self):
+        clients = []
+
+        async def request(client, method, url, **kwargs):
+            clients.append(client)
+            return httpx.Response(200)
+
+        with mock.patch.object(github.httpx.AsyncClient, 'request', autospec=True, side_effect=request):
+            # each async_to_sync call (as from a Celery task or sync view) runs on a new event loop
+            for _ in range(2): async_to_sync(github.GitHubClient.request)('GET', 'https://api.github.com/users/someone', 'token')
+        self.assertEqual(2, len(clients))
+        self.assertIs(clients[0], clients[1])
+
+    def test_request_waiting_for_budget_does_not_hold_a_slot(self):
+        exhausted = (hashlib.sha256('exhausted'.encode()).hexdigest()[:16], 'core')
+        self.budgets[exhausted] = (0, time.time() + 0.5)
+        client = mock.MagicMock()
+        client.request = mock.AsyncMock(return_value=httpx.Response(200))
+        state = []
+
+        def loop_state():
+            # a single slot, created on the loop requests run on
+            if len(state) == 0: state.append((client, asyncio.Semaphore(1), asyncio.Semaphore(1)))
+            return state[0]
+
+        async def request(token: str):
+            await github.GitHubClient.request('GET', 'https://api.github.com/users/someone', token)
+            return time.monotonic() - start
+
+        async def both():
+            return await asyncio.gather(request('exhausted'), request('token'))
+
+        try:
+            with mock.patch.object(github.GitHubClient, '_GitHubClient__loop_state', side_effect=loop_state):
+                start = time.monotonic()
+                waited, unwaited = asyncio.run(both())
+        finally:
+            self.budgets.pop(exhausted, None)
+        self.assertGreaterEqual(waited, 0.4)
+        self.assertLess(unwaited, 0.3)
+
+    def test_rate_limited_refresh_is_skipped(self):
+        from plantit.celery_tasks import github_refresh
+
+        with github_refresh('something'):
+            raise github.RateLimited('exhausted')
@@ -8,6 +8,7 @@ from .miappe.views import *
 from .notifications.consumers import NotificationConsumer
 from .tasks.consumers import TaskConsumer
 from .users.views import UsersViewSet, IDPViewSet
+from .workflows.views import hook as github_hook
 
 router = routers.DefaultRouter()
 
@@ -22,6 +23,8 @@ urlpatterns = [
                   url('agents/', include("plantit.agents.urls")),
                   url('datasets/', include("plantit.datasets.urls")),
                   url('workflows/', include("plantit.workflows.urls")),
+                  # GitHub webhooks, outside the workflows/ prefix so they can't collide with an owner's name
+                  url('hooks/github/', github_hook),
                   url('tasks/', include("plantit.tasks.urls")),
                   url('stats/', include("plantit.stats.urls")),
                   url('notifications/', include("plantit.notifications.urls")),
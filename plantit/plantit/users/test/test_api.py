@@ -0,0 +1,111 @@
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+
+from plantit.redis import RedisClient, encode
+from plantit.users.models import Profile
+from plantit.utils import user_index_entries, get_github_profile, cache_profile, uncache_profile, get_cached_profile, PROFILES_MAX_AGE
+
+
+class UserSearchTests(TestCase):
+    url = '/apis/v1/users/search/'
+    records = [
+        {'username': f"user{i}", 'first_name': 'Alice' if i % 2 == 0 else 'Bob', 'last_name': f"Smith{i}"} for i in range(7)
+    ]
+
+    def setUp(self):
+        user = User.objects.create_user(username='searcher', password='password')
+        Profile.objects.create(user=user, github_token='secret')
+        self.client.force_login(user)
+
+        redis = RedisClient.get()
+        redis.delete('user_records', 'user_index')
+        redis.hset('user_records', mapping={record['username']: encode(record) for record in self.records})
+        redis.zadd('user_index', {entry: 0 for record in self.records for entry in user_index_entries(record)})
+        redis.set('users_updated', timezone.now().timestamp())
+
+    def tearDown(self):
+        RedisClient.get().delete('user_records', 'user_index', 'users_updated', 'cache_refreshes/users')
+
+    def search(self, query: str, **params):
+        response = self.client.get(self.url, {'query': query, **params})
+        self.assertEqual(200, response.status_code)
+        return response.json()
+
+    def test_pages_cover_all_matches_once(self):
+        usernames, cursor = [], None
+        while True:
+            page = self.search('alice', limit=2, **({'cursor': cursor} if cursor else {}))
+            self.assertLessEqual(len(page['users']), 2)
+            usernames += [user['username'] for user in page['users']]
+            cursor = page['cursor']
+            if cursor is None: break
+
+        self.assertEqual(['user0', 'user2', 'user4', 'user6'], usernames)
+
+    def test_last_page_has_no_cursor(self):
+        page = self.search('bob', limit=10)
+        self.assertEqual(['user1', 'user3', 'user5'], [user['username'] for user in page['users']])
+        self.assertIsNone(page['cursor'])
+
+    def test_query_is_case_insensitive_prefix(self):
+        self.assertEqual(['user3'], [user['username'] for user in self.search('SMITH3')['users']])
+
+    def test_malformed_cursor_is_rejected(self):
+        for cursor in ('not base64!', 'AAAA', '_w=='):
+            self.assertEqual(400, self.client.get(self.url, {'query': 'alice', 'cursor': cursor}).status_code)
+
+    def test_cursor_from_another_query_is_rejected(self):
+        cursor = self.search('alice', limit=1)['cursor']
+        self.assertEqual(400, self.client.get(self.url, {'query': 'bob', 'cursor': cursor}).status_code)
+
+    def test_bad_limit_is_rejected(self):
+        self.assertEqual(400, self.client.get(self.url, {'query': 'alice', 'limit': 0}).status_code)
+        self.assertEqual(400, self.client.get(self.url, {'query': 'alice', 'limit': 'ten'}).status_code)
+
+    def test_stale_cache_refresh_is_scheduled_without_the_token(self):
+        RedisClient.get().set('users_updated', timezone.now().timestamp() - 60 * 60 * 24 * 365)
+        with mock.patch('plantit.utils.app.send_task') as send_task:
+            self.search('alice')
+        send_task.assert_called_once_with('plantit.celery_tasks.refresh_users', args=['searcher'])
+
+    def test_refresh_looks_up_the_token(self):
+        from plantit.celery_tasks import refresh_users
+
+        with mock.patch('plantit.celery_tasks.repopulate_user_cache') as repopulate:
+            refresh_users('searcher')
+            refresh_users('nobody')
+        repopulate.assert_called_once_with('secret')
+
+
+class GitHubProfileTests(TestCase):
+    profile = {'login': 'octocat', 'name': 'The Octocat'}
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='viewer', password='password')
+        Profile.objects.create(user=self.user, github_token='secret')
+
+    def tearDown(self):
+        uncache_profile('github', 'octocat')
+        RedisClient.get().delete('cache_refreshes/profiles/github/octocat')
+
+    def test_stale_profile_refresh_is_scheduled_without_the_token(self):
+        cache_profile('github', 'octocat', self.profile)
+        RedisClient.get().set('profiles_updated/github/octocat', timezone.now().timestamp() - PROFILES_MAX_AGE - 1)
+        with mock.patch('plantit.utils.app.send_task') as send_task:
+            self.assertEqual(self.profile, async_to_sync(get_github_profile)('octocat', self.user))
+        send_task.assert_called_once_with('plantit.celery_tasks.refresh_github_profile', args=['octocat', 'viewer'])
+
+    def test_refresh_looks_up_the_token(self):
+        from plantit.celery_tasks import refresh_github_profile
+
+        with mock.patch('plantit.utils.github.get_profile', side_effect=self.get_profile) as get_profile:
+            refresh_github_profile('octocat', 'viewer')
+        get_profile.assert_called_once_with('octocat', 'secret')
+        self.assertEqual(self.profile, get_cached_profile('github', 'octocat')[0])
+
+    async def get_profile(self, owner, token):
+        return self.profile
@@ -25,8 +25,9 @@ from plantit.sns import SnsClient, get_sns_subscription_status
 from plantit.ssh import SSH, execute_command
 from plantit.users.models import Profile
 from plantit.users.serializers import UserSerializer
-from plantit.utils import list_users, calculate_user_statistics, get_user_cyverse_profile, get_user_github_profile, \
-    get_user_private_key_path, get_or_create_user_keypair, get_user_statistics
+from plantit.utils import list_users, search_users, calculate_user_statistics, get_user_cyverse_profile, get_user_github_profile, \
+    get_github_profile, get_user_private_key_path, get_or_create_user_keypair, get_user_statistics, get_user_cyverse_token, USERS_SEARCH_LIMIT, \
+    USERS_SEARCH_MAX_LIMIT
 from plantit.misc import get_csrf_token
 
 
@@ -212,8 +213,24 @@ class UsersViewSet(viewsets.ModelViewSet, mixins.RetrieveModelMixin):
 
     @action(detail=False, methods=['get'])
     def get_all(self, request):
-        users = list_users(request.user.profile.github_token)
-        return JsonResponse({'users': users})
+        users, age = list_users(request.user)
+        return JsonResponse({'users': users, 'age': age})
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        query = request.GET.get('query', '')
+        cursor = request.GET.get('cursor', None)
+        try:
+            limit = min(int(request.GET.get('limit', USERS_SEARCH_LIMIT)), USERS_SEARCH_MAX_LIMIT)
+            if limit < 1: raise ValueError()
+        except ValueError:
+            return HttpResponseBadRequest("Invalid param: 'limit'")
+
+        try:
+            users, cursor, age = search_users(request.user, query, cursor, limit)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid param: 'cursor'")
+        return JsonResponse({'users': users, 'cursor': cursor, 'age': age})
 
     @action(detail=False, methods=['get'])
     def get_current(self, request):
@@ -234,7 +251,7 @@ class UsersViewSet(viewsets.ModelViewSet, mixins.RetrieveModelMixin):
                 'dark_mode': user.profile.dark_mode,
                 'push_notifications': user.profile.push_notification_status,
                 'github_token': user.profile.github_token,
-                'cyverse_token': user.profile.cyverse_access_token,
+                'cyverse_token': '',
                 'tutorials': user.profile.tutorials_shown
             },
             'stats': stats
@@ -242,6 +259,7 @@ class UsersViewSet(viewsets.ModelViewSet, mixins.RetrieveModelMixin):
 
         if request.user.profile.cyverse_access_token != '':
             try:
+                response['django_profile']['cyverse_token'] = get_user_cyverse_token(request.user)
                 response['cyverse_profile'] = get_user_cyverse_profile(request.user)
             except ValueError:
                 # if the CyVerse request fails, log the user out
@@ -261,13 +279,10 @@ class UsersViewSet(viewsets.ModelViewSet, mixins.RetrieveModelMixin):
         # TODO move to configuration file
         if username == 'Computational-Plant-Science' or username == 'van-der-knaap-lab' or username == 'burkelab':
             if request.user.profile.github_token != '':
-                github_response = requests.get(f"https://api.github.com/users/{username}",
-                                               headers={'Authorization':
-                                                            f"Bearer {request.user.profile.github_token}"})
                 return JsonResponse({
                     'django_profile': None,
                     'cyverse_profile': None,
-                    'github_profile': github_response.json()
+                    'github_profile': async_to_sync(get_github_profile)(username, request.user)
                 })
             else:
                 return JsonResponse({
@@ -286,28 +301,16 @@ class UsersViewSet(viewsets.ModelViewSet, mixins.RetrieveModelMixin):
         }
 
         if request.user.username == user.username:
-            response['django_profile']['cyverse_token'] = user.profile.cyverse_access_token
+            response['django_profile']['cyverse_token'] = get_user_cyverse_token(user)
 
         if request.user.profile.cyverse_access_token != '':
-            cyverse_response = requests.get(
-                f"https://de.cyverse.org/terrain/secured/user-info?username={user.username}",
-                headers={'Authorization': f"Bearer {request.user.profile.cyverse_access_token}"})
-            if cyverse_response.status_code == 401:
+            try:
+                response['cyverse_profile'] = get_user_cyverse_profile(user, access_token=get_user_cyverse_token(request.user))
+            except ValueError as e:
+                self.logger.warning(f"Failed to get CyVerse profile for {user.username}: {e}")
                 response['cyverse_profile'] = 'expired token'
-            else:
-                cyverse_profile = cyverse_response.json()
-                if user.username in cyverse_profile:
-                    response['cyverse_profile'] = cyverse_response.json()[user.username]
-                    user.first_name = response['cyverse_profile']['first_name']
-                    user.last_name = response['cyverse_profile']['last_name']
-                    user.save()
-                else:
-                    print(f"No CyVerse profile")
         if request.user.profile.github_token != '' and user.profile.github_username != '':
-            github_response = requests.get(f"https://api.github.com/users/{user.profile.github_username}",
-                                           headers={'Authorization':
-                                                        f"Bearer {request.user.profile.github_token}"})
-            response['github_profile'] = github_response.json()
+            response['github_profile'] = async_to_sync(get_github_profile)(user.profile.github_username, request.user)
         return JsonResponse(response)
 
     @action(detail=False, methods=['get'])
@@ -1,4 +1,5 @@
 import asyncio
+import base64
 import binascii
 import fileinput
 import json
@@ -7,19 +8,19 @@ import os
 import subprocess
 import sys
 import tempfile
+import time
 import uuid
 import pprint
-from collections import Counter
 from datetime import timedelta, datetime
 from math import ceil
 from os import environ
 from os.path import isdir
 from os.path import join
 from pathlib import Path
-from typing import List
+from typing import List, Iterator, Tuple
 from urllib.parse import quote_plus
 
-import numpy as np
+import jwt
 import requests
 import yaml
 from asgiref.sync import async_to_sync
@@ -29,19 +30,20 @@ from dateutil import parser
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import MultipleObjectsReturned
-from django.db.models import Count
+from django.db.models import Count, Sum, F, Q, ExpressionWrapper, DurationField
 from django.utils import timezone
 
 import plantit.github as github
 import plantit.terrain as terrain
 from plantit import settings
 from plantit.agents.models import Agent, AgentAccessPolicy, AgentRole, AgentExecutor, AgentTask
+from plantit.celery import app
 from plantit.datasets.models import DatasetAccessPolicy
 from plantit.docker import parse_image_components, image_exists
 from plantit.miappe.models import Investigation, Study
 from plantit.misc import del_none, format_bind_mount, parse_bind_mount
 from plantit.notifications.models import Notification
-from plantit.redis import RedisClient
+from plantit.redis import RedisClient, LocalCache, single_flight, single_flight_async, encode, decode
 from plantit.ssh import SSH, execute_command
 from plantit.tasks.models import DelayedTask, RepeatingTask, TaskStatus, JobQueueTask, TaskCounter
 from plantit.tasks.models import Task
@@ -52,60 +54,205 @@ from plantit.workflows.models import Workflow
 
 logger = logging.getLogger(__name__)
 
+# refresh CyVerse tokens when they're within this many seconds of expiring
+CYVERSE_TOKEN_REFRESH_WINDOW = int(environ.get('CYVERSE_TOKEN_REFRESH_WINDOW', 300))
+
+# CyVerse access tokens and their expiry timestamps, by username
+cyverse_tokens = dict()
+
+# once a stale cache's background refresh is scheduled, don't schedule another for this many seconds
+CACHE_REFRESH_LOCK_SECONDS = int(environ.get('CACHE_REFRESH_LOCK_SECONDS', 300))
+
+# how many owners' workflow caches the public workflow cache refresh rebuilds at once
+WORKFLOWS_REFRESH_CONCURRENCY = int(environ.get('WORKFLOWS_REFRESH_CONCURRENCY', 4))
+
+# when GitHub push webhooks keep workflow bundles fresh, periodic refreshes are just a safety net for missed deliveries
+WORKFLOWS_WEBHOOK_REFRESH_MINUTES = int(environ.get('WORKFLOWS_WEBHOOK_REFRESH_MINUTES', 24 * 60))
+
+# cached CyVerse and GitHub profiles older than this are refreshed in the background (and served meanwhile)
+PROFILES_MAX_AGE = int(environ.get('PROFILES_MAX_AGE', 3600))  # seconds
+
+# how many users a page of user search results holds by default, and at most
+USERS_SEARCH_LIMIT = int(environ.get('USERS_SEARCH_LIMIT', 20))
+USERS_SEARCH_MAX_LIMIT = int(environ.get('USERS_SEARCH_MAX_LIMIT', 100))
+
+
+# caches
+
+def get_cache_age(updated_key: str):
+    updated = RedisClient.get().get(updated_key)
+    return None if updated is None else timezone.now().timestamp() - float(updated)
+
+
+def revalidate_cache(name: str, age: float, max_age: int, task: str, args: list = None):
+    """
+    If a cache is more than `max_age` seconds old, schedules the given Celery task to refresh it in the background (at most once
+    every `CACHE_REFRESH_LOCK_SECONDS`). Callers serve the stale data meanwhile, so they needn't wait on upstream APIs. An age of
+    None means the cache was never populated, so it's refreshed too.
+    """
+
+    if age is not None and age <= max_age: return
+    if not RedisClient.get().set(f"cache_refreshes/{name}", 1, nx=True, ex=CACHE_REFRESH_LOCK_SECONDS): return
+    if age is None: logger.info(f"Cache {name} is empty, scheduling refresh")
+    else: logger.info(f"Cache {name} is stale ({int(age)}s old, {int(age - max_age)}s past limit), scheduling refresh")
+    app.send_task(task, args=args)
+
 
 # users
 
-def list_users(github_token: str, invalidate: bool = False) -> List[dict]:
+def prepare_user_cache(user: User, invalidate: bool = False) -> float:
+    """
+    Populates the user cache inline (with the requesting user's GitHub token) if it's empty (or missing its search index), or if
+    invalidation is requested. Otherwise the cache is served as is, and refreshed in the background if stale.
+
+    Returns: The cache's age in seconds.
+    """
+
     redis = RedisClient.get()
-    updated = redis.get(f"users_updated")
+    age = get_cache_age('users_updated')
 
-    # repopulate if empty or invalidation requested
-    if updated is None or len(list(redis.scan_iter(match=f"users/*"))) == 0 or invalidate:
-        repopulate_user_cache(github_token)
+    if age is None or redis.hlen('user_records') == 0 or not redis.exists('user_index') or invalidate:
+        async_to_sync(repopulate_user_cache)(user.profile.github_token, full=invalidate)
+        age = 0
     else:
-        age = (datetime.now() - datetime.fromtimestamp(float(updated)))
-        age_secs = age.total_seconds()
-        max_secs = (int(settings.USERS_REFRESH_MINUTES) * 60)
+        # the refresh looks the token up itself, since task arguments are kept in the broker and logged
+        revalidate_cache('users', age, int(settings.USERS_REFRESH_MINUTES) * 60, 'plantit.celery_tasks.refresh_users', [user.username])
+
+    return age
+
+
+def list_users(user: User, invalidate: bool = False) -> Tuple[List[dict], float]:
+    """
+    Returns: The cached users, and the cache's age in seconds.
+    """
 
-        # otherwise only if stale
-        if age_secs > max_secs:
-            logger.info(f"User cache is stale ({age_secs}s old, {age_secs - max_secs}s past limit), repopulating")
-            repopulate_user_cache(github_token)
+    age = prepare_user_cache(user, invalidate)
+    return [decode(record) for record in RedisClient.get().hvals('user_records')], age
 
-    return [json.loads(redis.get(key)) for key in redis.scan_iter(match=f"users/*")]
 
+def search_users(user: User, query: str, cursor: str = None, limit: int = USERS_SEARCH_LIMIT) -> Tuple[List[dict], str, float]:
+    """
+    Finds cached users whose username, first, last or full name, or GitHub username starts with the query (case-insensitively),
+    in lexicographic order of the matching term. Pages are read straight off the `user_index` sorted set, so each costs the same
+    however many users there are. A user matching by more than one term may show up again on a later page.
+
+    Returns: Up to `limit` users, an opaque cursor to pass for the next page (None if this is the last), and the cache's age in seconds.
+    """
 
-def repopulate_user_cache(github_token: str):
+    prefix = query.strip().lower()
+    last = decode_search_cursor(cursor, prefix) if cursor else None
     redis = RedisClient.get()
-    users = User.objects.all()
-    mapped = []
-    for user in list(users.exclude(profile__isnull=True)):
-        if user.profile.github_username:
-            github_profile = requests.get(f"https://api.github.com/users/{user.profile.github_username}",
-                                          headers={'Authorization': f"Bearer {github_token}"}).json()
-            if 'login' in github_profile:
-                mapped.append({
-                    'username': user.username,
-                    'first_name': user.first_name,
-                    'last_name': user.last_name,
-                    'github_username': user.profile.github_username,
-                    'github_profile': github_profile
-                })
-            else:
-                mapped.append({
-                    'username': user.username,
-                    'first_name': user.first_name,
-                    'last_name': user.last_name,
-                })
-        else:
-            mapped.append({
-                'username': user.username,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-            })
+    age = prepare_user_cache(user)
+
+    start = f"({last}" if last is not None else f"[{prefix}"
+    stop = b'[' + prefix.encode() + b'\xff'  # no UTF-8 encoded term contains 0xff, so this sorts after all with the prefix
+
+    # fetch one extra entry to tell whether there's another page
+    members = [member.decode() for member in redis.zrangebylex('user_index', start, stop, start=0, num=limit + 1)]
+    page, more = members[:limit], len(members) > limit
+    usernames = list(dict.fromkeys(member.rpartition('\x00')[2] for member in page))
+    records = redis.hmget('user_records', usernames) if len(usernames) > 0 else []
+    users = [decode(record) for record in records if record is not None]
+    return users, (base64.urlsafe_b64encode(page[-1].encode()).decode() if more else None), age
+
+
+def decode_search_cursor(cursor: str, prefix: str) -> str:
+    """
+    Returns: The index entry a `search_users` cursor (the base64-encoded last entry read) resumes just after. Raises ValueError if the
+    cursor is malformed or wasn't issued for a query with the given prefix.
+    """
+
+    try:
+        last = base64.b64decode(cursor.encode(), altchars=b'-_', validate=True).decode()
+    except ValueError:
+        raise ValueError(f"Malformed cursor: {cursor}")
+    if '\x00' not in last or not last.startswith(prefix): raise ValueError(f"Cursor doesn't belong to query '{prefix}': {cursor}")
+    return last
+
+
+@sync_to_async
+def list_user_identities() -> List[dict]:
+    return list(User.objects.exclude(profile__isnull=True).values('username', 'first_name', 'last_name', 'profile__github_username'))
+
+
+def user_record_outdated(user: dict, record: dict) -> bool:
+    return record is None or \
+           record['first_name'] != user['first_name'] or \
+           record['last_name'] != user['last_name'] or \
+           record.get('github_username', '') != (user['profile__github_username'] or '')
+
+
+def user_index_entries(record: dict) -> set:
+    """
+    Returns: The user's entries in the `user_index` sorted set, each a lowercased search term and the username, NUL-separated.
+    All entries share a score, so the set is ordered lexicographically and prefix queries are ranges. Terms that are prefixes of
+    the user's other terms (e.g. the first name, of the full name) are left out, since the longer term matches the same queries.
+    """
+
+    first_name, last_name = record.get('first_name') or '', record.get('last_name') or ''
+    terms = [record['username'], first_name, last_name, f"{first_name} {last_name}", record.get('github_username') or '']
+    terms = set(term.strip().lower() for term in terms if term.strip() != '')
+    return set(f"{term}\x00{record['username']}" for term in terms if not any(other != term and other.startswith(term) for other in terms))
 
-    logger.info(f"Populating user cache")
-    for user in mapped: redis.set(f"users/{user['username']}", json.dumps(user))
+
+async def repopulate_user_cache(github_token: str, full: bool = False):
+    """
+    Rebuilds the user cache (the `user_records` hash, by username, and the `user_index` search index over it). By default only users added or changed since the last
+    rebuild (or whose GitHub profiles couldn't be fetched last time) are looked up on GitHub, and users since deleted are dropped.
+    With `full`, every user's GitHub profile is refreshed (with conditional requests, so unchanged profiles are cheap). Lookups run
+    concurrently, bounded by the shared GitHub client's concurrency limit.
+    """
+
+    # let only one process rebuild the cache at a time, the rest just wait for it
+    async with single_flight_async('users') as leader:
+        if not leader: return
+
+        redis = RedisClient.get()
+        users = await list_user_identities()
+        records = {username.decode(): decode(record) for username, record in redis.hgetall('user_records').items()}
+        outdated = [user for user in users if full or user_record_outdated(user, records.get(user['username'], None))]
+        removed = set(records.keys()) - set(user['username'] for user in users)
+
+        async def map_user(user: dict) -> dict:
+            record = {
+                'username': user['username'],
+                'first_name': user['first_name'],
+                'last_name': user['last_name'],
+            }
+
+            github_username = user['profile__github_username']
+            if not github_username: return record
+            try:
+                record['github_profile'] = await github.get_profile(github_username, github_token)
+                record['github_username'] = github_username
+            except github.RateLimited as e:
+                # this says nothing about the user, so keep the GitHub profile we had (if any)
+                logger.warning(f"Skipping GitHub profile for {user['username']}: {e}")
+                previous = records.get(user['username'], None) or {}
+                record.update({key: previous[key] for key in ('github_profile', 'github_username') if key in previous})
+            except Exception as e:
+                logger.warning(f"Failed to get GitHub profile for {user['username']} (GitHub user {github_username}): {e}")
+            return record
+
+        mapped = await asyncio.gather(*[map_user(user) for user in outdated])
+
+        logger.info(f"Populating user cache ({len(mapped)} added or updated, {len(removed)} removed, {len(users) - len(mapped)} unchanged)")
+        # update the search index: drop entries of changed or removed users, add those of changed users (or index everyone, if
+        # the index has gone missing, since unchanged users' entries would otherwise never be added)
+        replaced = (set(record['username'] for record in mapped) | removed) & set(records.keys())
+        stale = set().union(*[user_index_entries(records[username]) for username in replaced])
+        fresh = set().union(*[user_index_entries(record) for record in mapped])
+        if not redis.exists('user_index'):
+            fresh |= set().union(*[user_index_entries(record) for username, record in records.items() if username not in removed])
+        stale -= fresh
+
+        pipeline = redis.pipeline()
+        if len(mapped) > 0: pipeline.hset('user_records', mapping={record['username']: encode(record) for record in mapped})
+        if len(removed) > 0: pipeline.hdel('user_records', *removed)
+        if len(stale) > 0: pipeline.zrem('user_index', *stale)
+        if len(fresh) > 0: pipeline.zadd('user_index', {entry: 0 for entry in fresh})
+        pipeline.set("users_updated", timezone.now().timestamp())
+        pipeline.execute()
 
 
 @sync_to_async
@@ -118,8 +265,42 @@ def get_user_django_profile(user: User):
     return user.profile
 
 
-def get_user_cyverse_profile(user: User) -> dict:
-    profile = terrain.get_profile(user.username, user.profile.cyverse_access_token)
+def get_cached_profile(kind: str, name: str) -> Tuple[dict, float]:
+    """
+    Returns: The cached profile of the given kind ('cyverse' or 'github') and name (or None), and its age in seconds (or None).
+    """
+
+    profile = RedisClient.get().get(f"profiles/{kind}/{name}")
+    if profile is None: return None, None
+    return decode(profile), get_cache_age(f"profiles_updated/{kind}/{name}")
+
+
+def cache_profile(kind: str, name: str, profile: dict):
+    pipeline = RedisClient.get().pipeline()
+    pipeline.set(f"profiles/{kind}/{name}", encode(profile))
+    pipeline.set(f"profiles_updated/{kind}/{name}", timezone.now().timestamp())
+    pipeline.execute()
+
+
+def uncache_profile(kind: str, name: str):
+    RedisClient.get().delete(f"profiles/{kind}/{name}", f"profiles_updated/{kind}/{name}")
+
+
+def get_user_cyverse_profile(user: User, access_token: str = None, refresh: bool = False) -> dict:
+    """
+    Returns the user's CyVerse profile. Profiles are cached, and once older than `PROFILES_MAX_AGE` refreshed in the background
+    (with the user's own token) while the cached copy is served. Only if nothing's cached (or with `refresh`) is Terrain asked inline,
+    with the given access token (by default the user's). Raises ValueError if the token is invalid.
+    """
+
+    if not refresh:
+        profile, age = get_cached_profile('cyverse', user.username)
+        if profile is not None:
+            revalidate_cache(f"profiles/cyverse/{user.username}", age, PROFILES_MAX_AGE, 'plantit.celery_tasks.refresh_cyverse_profile', [user.username])
+            return profile
+
+    profile = terrain.get_profile(user.username, access_token if access_token is not None else get_user_cyverse_token(user))
+    cache_profile('cyverse', user.username, profile)
     altered = False
 
     if profile['first_name'] != user.first_name:
@@ -147,98 +328,174 @@ def refresh_user_cyverse_tokens(user: User):
     user.save()
 
 
+def get_token_expiry(token: str) -> float:
+    try:
+        decoded = jwt.decode(token, options={
+            'verify_signature': False,
+            'verify_aud': False,
+            'verify_iat': False,
+            'verify_exp': False,
+            'verify_iss': False
+        })
+        return float(decoded['exp'])
+    except (jwt.InvalidTokenError, KeyError, ValueError):
+        return 0.0
+
+
+def get_user_cyverse_token(user: User, refresh_window: int = None) -> str:
+    """
+    Returns the user's CyVerse access token, first refreshing it if it expires within `refresh_window` seconds
+    (by default `CYVERSE_TOKEN_REFRESH_WINDOW`). Tokens are cached in memory with their expiry time. Refreshes are
+    single-flight per user (see `single_flight()`), so concurrent callers (in any process) share a single refresh, and the
+    lock is held for as long as the refresh (and its retries) takes.
+    """
+
+    window = refresh_window if refresh_window is not None else CYVERSE_TOKEN_REFRESH_WINDOW
+    token = user.profile.cyverse_access_token
+    if token == '': return token
+
+    # prefer whichever of the cached and stored tokens lasts longer (the user may have logged in again, or the passed object may be stale)
+    cached = cyverse_tokens.get(user.username, None)
+    if cached is None or cached[0] != token:
+        expiry = get_token_expiry(token)
+        if cached is None or expiry >= cached[1]:
+            cached = (token, expiry)
+            cyverse_tokens[user.username] = cached
+    if cached[1] - time.time() > window: return cached[0]
+
+    with single_flight(f"cyverse_tokens/{user.username}") as refreshing:
+        # another caller may have refreshed while we were waiting
+        user.profile.refresh_from_db()
+        token = user.profile.cyverse_access_token
+        expiry = get_token_expiry(token)
+        if refreshing and expiry - time.time() <= window:
+            logger.info(f"Refreshing CyVerse tokens for {user.username} (access token expires in {int(expiry - time.time())}s)")
+            refresh_user_cyverse_tokens(user)
+            token = user.profile.cyverse_access_token
+            expiry = get_token_expiry(token)
+
+        cyverse_tokens[user.username] = (token, expiry)
+        return token
+
+
+async def get_github_profile(owner: str, user: User, refresh: bool = False) -> dict:
+    """
+    Returns the GitHub user's profile (requested with the given user's GitHub token), cached like CyVerse profiles (see
+    `get_user_cyverse_profile()`).
+    """
+
+    if not refresh:
+        profile, age = await sync_to_async(get_cached_profile)('github', owner)
+        if profile is not None:
+            # the refresh looks the token up itself, since task arguments are kept in the broker and logged
+            await sync_to_async(revalidate_cache)(f"profiles/github/{owner}", age, PROFILES_MAX_AGE, 'plantit.celery_tasks.refresh_github_profile', [owner, user.username])
+            return profile
+
+    token = (await get_user_django_profile(user)).github_token
+    profile = await github.get_profile(owner, token)
+    await sync_to_async(cache_profile)('github', owner, profile)
+    return profile
+
+
 async def get_user_github_profile(user: User) -> dict:
     profile = await get_user_django_profile(user)
-    return await github.get_profile(profile.github_username, profile.github_token)
+    return await get_github_profile(profile.github_username, user)
 
 
 @sync_to_async
-def filter_tasks(user: User, completed: bool = None):
-    if completed is not None and completed:
-        tasks = Task.objects.filter(user=user, completed__isnull=False)
-    else:
-        tasks = Task.objects.filter(user=user)
-    return list(tasks)
+def aggregate_user_task_statistics(user: User) -> dict:
+    """
+    Aggregates the user's tasks, workflow and agent usage in the database (rather than loading every task and agent).
+    """
 
+    tasks = Task.objects.filter(user=user)
+    completed = Q(completed__isnull=False)
+    totals = tasks.aggregate(
+        tasks=Count('id'),
+        runtime=Sum(ExpressionWrapper(F('completed') - F('created'), output_field=DurationField()), filter=completed),
+        results=Sum('results__len', filter=completed))
+    workflow_usage = sorted((f"{usage['workflow_owner']}/{usage['workflow_name']}", usage['count']) for usage in
+                            tasks.values('workflow_owner', 'workflow_name').annotate(count=Count('id')).order_by())
+    agent_usage = [(usage['agent__name'], usage['count']) for usage in
+                   tasks.filter(agent__isnull=False).values('agent__name').annotate(count=Count('id')).order_by('agent__name')]
+    # count each status on its own, so tasks still created or running aren't mistaken for failures
+    status_usage = [(usage['status'].upper(), usage['count']) for usage in
+                    tasks.values('status').annotate(count=Count('id')).order_by('status')]
 
-@sync_to_async
-def filter_agents(user: User = None, guest: User = None):
-    if user is not None and guest is None:
-        return list(Agent.objects.filter(user=user))
-    elif user is None and guest is not None:
-        return list(Agent.objects.filter(users_authorized__username=guest.username))
-    else:
-        raise ValueError(f"Expected either user or guest to be None")
+    return {
+        'total_tasks': totals['tasks'],
+        'total_task_seconds': totals['runtime'].total_seconds() if totals['runtime'] is not None else 0,
+        'total_task_results': totals['results'] or 0,
+        'workflow_usage': {
+            'values': [count for _, count in workflow_usage],
+            'labels': [workflow for workflow, _ in workflow_usage],
+        },
+        'agent_usage': {
+            'values': [count for _, count in agent_usage],
+            'labels': [agent for agent, _ in agent_usage],
+        },
+        'task_status': {
+            'values': [count for _, count in status_usage],
+            'labels': [status for status, _ in status_usage],
+        },
+        'owned_agents': list(Agent.objects.filter(user=user).values_list('name', flat=True)),
+        'guest_agents': list(Agent.objects.filter(users_authorized__username=user.username).values_list('name', flat=True)),
+    }
 
 
 def get_user_statistics(user: User) -> dict:
-    redis = RedisClient.get()
+    """
+    Returns the user's cached usage statistics, or None if they've not been aggregated yet. Missing statistics, or those older than
+    `USERS_STATS_REFRESH_MINUTES`, are (re)aggregated in the background.
+    """
+
+    stats = get_cached_user_statistics(user)
     stats_last_aggregated = user.profile.stats_last_aggregated
+    age = None if stats is None or stats_last_aggregated is None else (timezone.now() - stats_last_aggregated).total_seconds()
+    revalidate_cache(f"stats/{user.username}", age, int(settings.USERS_STATS_REFRESH_MINUTES) * 60, 'plantit.celery_tasks.refresh_user_statistics', [user.username])
+    return stats
 
-    if stats_last_aggregated is None:
-        logger.info(f"No usage statistics for {user.username}. Aggregating stats...")
-        stats = async_to_sync(calculate_user_statistics)(user)
-        redis = RedisClient.get()
-        redis.set(f"stats/{user.username}", json.dumps(stats))
-        user.profile.stats_last_aggregated = timezone.now()
-        user.profile.save()
-    else:
-        stats = redis.get(f"stats/{user.username}")
-        stats_age_minutes = (timezone.now() - stats_last_aggregated).total_seconds() / 60
-
-        if stats is None or stats_age_minutes > int(os.environ.get('USERS_STATS_REFRESH_MINUTES')):
-            logger.info(f"{stats_age_minutes} elapsed since last aggregating usage statistics for {user.username}. Refreshing stats...")
-            stats = async_to_sync(calculate_user_statistics)(user)
-            redis = RedisClient.get()
-            redis.set(f"stats/{user.username}", json.dumps(stats))
-            user.profile.stats_last_aggregated = timezone.now()
-            user.profile.save()
-        else:
-            stats = json.loads(stats)
 
+def update_user_statistics(user: User):
+    logger.info(f"Aggregating usage statistics for {user.username}")
+    stats = async_to_sync(calculate_user_statistics)(user)
+    cache_user_statistics(user, stats)
+    user.profile.stats_last_aggregated = timezone.now()
+    user.profile.save()
+
+
+def get_cached_user_statistics(user: User):
+    key = f"stats/{user.username}"
+    stats = LocalCache.get(key)
+    if stats is not None: return stats
+
+    generation = LocalCache.generation()
+    stats = RedisClient.get().get(key)
+    if stats is None: return None
+    stats = decode(stats)
+    LocalCache.put(key, stats, generation)
     return stats
 
 
+def cache_user_statistics(user: User, stats: dict):
+    key = f"stats/{user.username}"
+    pipeline = RedisClient.get().pipeline()
+    pipeline.set(key, encode(stats))
+    LocalCache.invalidate([key], pipeline)
+    pipeline.execute()
+
+
 async def calculate_user_statistics(user: User) -> dict:
-    all_tasks = await filter_tasks(user=user)
-    completed_tasks = await filter_tasks(user=user, completed=True)
     profile = await get_user_django_profile(user)
-
-    total_tasks = len(all_tasks)
-    total_time = sum([(task.completed - task.created).total_seconds() for task in completed_tasks])
-    total_results = sum([len(task.results if task.results is not None else []) for task in completed_tasks])
+    stats = await aggregate_user_task_statistics(user)
     owned_workflows = [f"{workflow['repo']['owner']['login']}/{workflow['config']['name'] if 'name' in workflow['config'] else '[unnamed]'}" for
-                       workflow in await list_personal_workflows(owner=profile.github_username)] if profile.github_username != '' else []
-    used_workflows = [f"{task.workflow_owner}/{task.workflow_name}" for task in all_tasks]
-    used_workflows_counter = Counter(used_workflows)
-    unique_used_workflows = list(np.unique(used_workflows))
-    owned_agents = [(await sync_to_async(agent_to_dict)(agent, user))['name'] for agent in await filter_agents(user=user)]
-    guest_agents = [(await sync_to_async(agent_to_dict)(agent, user))['name'] for agent in await filter_agents(guest=user)]
-    used_agents = [(await sync_to_async(agent_to_dict)(await get_task_agent(task), user))['name'] for task in all_tasks]
-    used_agents_counter = Counter(used_agents)
-    unique_used_agents = list(np.unique(used_agents))
+                       workflow in (await list_personal_workflows(owner=profile.github_username))[0]] if profile.github_username != '' else []
     # owned_datasets = terrain.list_dir(f"/iplant/home/{user.username}", profile.cyverse_access_token)
     # guest_datasets = terrain.list_dir(f"/iplant/home/", profile.cyverse_access_token)
 
     return {
-        'total_tasks': total_tasks,
-        'total_task_seconds': total_time,
-        'total_task_results': total_results,
+        **stats,
         'owned_workflows': owned_workflows,
-        'workflow_usage': {
-            'values': [used_workflows_counter[workflow] for workflow in unique_used_workflows],
-            'labels': unique_used_workflows,
-        },
-        'agent_usage': {
-            'values': [used_agents_counter[agent] for agent in unique_used_agents],
-            'labels': unique_used_agents,
-        },
-        'task_status': {
-            'values': [1 if task.status == 'success' else 0 for task in all_tasks],
-            'labels': ['SUCCESS' if task.status == 'success' else 'FAILURE' for task in all_tasks],
-        },
-        'owned_agents': owned_agents,
-        'guest_agents': guest_agents,
         'institution': profile.institution
     }
 
@@ -285,57 +542,65 @@ def get_user_public_key_path(username: str) -> Path:
 
 
 def repopulate_institutions_cache():
+    with single_flight('institutions') as leader:
+        if not leader: return
+
+        redis = RedisClient.get()
+        institution_counts = list(Profile.objects.exclude(institution__exact='').values('institution').annotate(Count('institution')))
+        institutions = dict()
+
+        for institution_count in institution_counts:
+            institution = institution_count['institution']
+            count = institution_count['institution__count']
+
+            place = quote_plus(institution)
+            response = requests.get(f"https://api.mapbox.com/geocoding/v5/mapbox.places/{place}.json?access_token={settings.MAPBOX_TOKEN}")
+            content = response.json()
+            feature = content['features'][0]
+            feature['id'] = institution
+            feature['properties'] = {
+                'name': institution,
+                'count': count
+            }
+            institutions[f"institutions/{institution}"] = json.dumps({
+                'institution': institution,
+                'count': count,
+                'geocode': feature
+            })
+
+        # swap the new entries in atomically (dropping any institutions no longer listed)
+        stale = [key for key in redis.scan_iter(match='institutions/*') if key.decode() not in institutions]
+        pipeline = redis.pipeline()
+        if len(stale) > 0: pipeline.delete(*stale)
+        if len(institutions) > 0: pipeline.mset(institutions)
+        pipeline.set("institutions_updated", timezone.now().timestamp())
+        pipeline.execute()
+
+
+def list_institutions(invalidate: bool = False) -> Tuple[List[dict], float]:
+    """
+    Returns: The cached institutions, and the cache's age in seconds.
+    """
+
     redis = RedisClient.get()
-    institution_counts = list(Profile.objects.exclude(institution__exact='').values('institution').annotate(Count('institution')))
-
-    for institution_count in institution_counts:
-        institution = institution_count['institution']
-        count = institution_count['institution__count']
-
-        place = quote_plus(institution)
-        response = requests.get(f"https://api.mapbox.com/geocoding/v5/mapbox.places/{place}.json?access_token={settings.MAPBOX_TOKEN}")
-        content = response.json()
-        feature = content['features'][0]
-        feature['id'] = institution
-        feature['properties'] = {
-            'name': institution,
-            'count': count
-        }
-        redis.set(f"institutions/{institution}", json.dumps({
-            'institution': institution,
-            'count': count,
-            'geocode': feature
-        }))
-
-    redis.set("institutions_updated", timezone.now().timestamp())
-
-
-def list_institutions(invalidate: bool = False) -> List[dict]:
-    redis = RedisClient.get()
-    updated = redis.get('institutions_updated')
+    age = get_cache_age('institutions_updated')
 
-    # repopulate if empty or invalidation requested
-    if updated is None or len(list(redis.scan_iter(match=f"institutions/*"))) == 0 or invalidate:
+    # repopulate inline if empty or invalidation requested, otherwise serve what we have (refreshing in the background if stale)
+    if age is None or len(list(redis.scan_iter(match=f"institutions/*"))) == 0 or invalidate:
         logger.info(f"Populating user institution cache")
         repopulate_institutions_cache()
+        age = 0
     else:
-        age = (datetime.now() - datetime.fromtimestamp(float(updated)))
-        age_secs = age.total_seconds()
-        max_secs = (int(settings.MAPBOX_FEATURE_REFRESH_MINUTES) * 60)
+        revalidate_cache('institutions', age, int(settings.MAPBOX_FEATURE_REFRESH_MINUTES) * 60, 'plantit.celery_tasks.refresh_user_institutions')
 
-        # otherwise only if stale
-        if age_secs > max_secs:
-            logger.info(f"User institution cache is stale ({age_secs}s old, {age_secs - max_secs}s past limit), repopulating")
-            repopulate_institutions_cache()
-
-    return [json.loads(redis.get(key)) for key in redis.scan_iter(match='institutions/*')]
+    return [json.loads(redis.get(key)) for key in redis.scan_iter(match='institutions/*')], age
 
 
 # workflows
 
 @sync_to_async
 def list_workflows(user: User = None, public: bool = None):
-    workflows = Workflow.objects.all()
+    workflows = Workflow.objects.select_related('user__profile')
     if user is not None: workflows = workflows.filter(user=user)
     if public is not None: workflows = workflows.filter(public=public)
     return list(workflows)
@@ -351,9 +616,21 @@ async def workflow_to_dict(workflow: Workflow, token: str) -> dict:
         workflow.repo_owner,
         workflow.repo_name,
         token)
+    return bundle_to_workflow_dict(workflow, bundle)
+
+
+async def workflows_to_dicts(workflows: List[Workflow], token: str) -> List[dict]:
+    # fetch all the workflows' repositories in a few batched requests rather than a couple each
+    bundles = await github.get_repo_bundles([(workflow.repo_owner, workflow.repo_name) for workflow in workflows], token)
+    return [bundle_to_workflow_dict(workflow, bundles[(workflow.repo_owner, workflow.repo_name)])
+            for workflow in workflows if (workflow.repo_owner, workflow.repo_name) in bundles]
+
+
+def bundle_to_workflow_dict(workflow: Workflow, bundle: dict) -> dict:
     return {
         'config': bundle['config'],
         'repo': bundle['repo'],
+        'sha': bundle.get('sha', None),
         'validation': bundle['validation'],
         'public': workflow.public,
         'bound': True
@@ -363,119 +640,127 @@ async def workflow_to_dict(workflow: Workflow, token: str) -> dict:
 async def repopulate_personal_workflow_cache(owner: str):
     if owner is None or owner == '': raise ValueError(f"No owner name provided")
 
-    try:
-        profile = await sync_to_async(Profile.objects.get)(github_username=owner)
-        user = await get_profile_user(profile)
-    except MultipleObjectsReturned:
-        logger.warning(f"Multiple users bound to Github user {owner}!")
-        return
-    except:
-        logger.warning(f"Github user {owner} does not exist")
-        return
-
-    empty_personal_workflow_cache(owner)
+    # let only one process rebuild the cache at a time, the rest serve what's cached (or if nothing is, wait for it)
+    cached = RedisClient.get().scard(f"workflow_owners/{owner}") > 0
+    async with single_flight_async(f"workflows/owner/{owner}", wait=not cached) as leader:
+        if not leader: return
 
-    profile = await get_user_django_profile(user)
-    owned = await list_workflows(user=user)
-    bind = asyncio.gather(*[workflow_to_dict(workflow, profile.github_token) for workflow in owned])
-    tasks = await asyncio.gather(*[bind, github.list_connectable_repos_by_owner(owner, profile.github_token)])
-    bound = tasks[0]
-    bindable = tasks[1]
-    both = []
-
-    for ba in bindable:
-        if not any(['name' in ed['config'] and 'name' in ba['config'] and ed['config']['name'] == ba['config']['name'] for ed in bound]):
-            ba['public'] = False
-            ba['bound'] = False
-            both.append(ba)
-
-    missing = 0
-    for bo in [b for b in bound if b['repo']['owner']['login'] == owner]:  # omit manually added workflows (e.g., owned by a GitHub Organization)
-        name = bo['config']['name']
-        if not any(['name' in ba['config'] and ba['config']['name'] == name for ba in bindable]):
-            missing += 1
-            logger.warning(f"Configuration file missing for {owner}'s workflow {name}")
-            bo['validation'] = {
-                'is_valid': False,
-                'errors': ["Configuration file missing"]
-            }
-        both.append(bo)
+        try:
+            profile = await sync_to_async(Profile.objects.get)(github_username=owner)
+            user = await get_profile_user(profile)
+        except MultipleObjectsReturned:
+            logger.warning(f"Multiple users bound to Github user {owner}!")
+            return
+        except:
+            logger.warning(f"Github user {owner} does not exist")
+            return
+
+        profile = await get_user_django_profile(user)
+        owned = await list_workflows(user=user)
+        bind = workflows_to_dicts(owned, profile.github_token)
+        tasks = await asyncio.gather(*[bind, github.list_connectable_repos_by_owner(owner, profile.github_token)])
+        bound = tasks[0]
+        bindable = tasks[1]
+        both = []
+
+        for ba in bindable:
+            if not any(['name' in ed['config'] and 'name' in ba['config'] and ed['config']['name'] == ba['config']['name'] for ed in bound]):
+                ba['public'] = False
+                ba['bound'] = False
+                both.append(ba)
+
+        missing = 0
+        for bo in [b for b in bound if b['repo']['owner']['login'] == owner]:  # omit manually added workflows (e.g., owned by a GitHub Organization)
+            # bundles whose configuration couldn't be loaded have no name to match, and their validation errors already say why
+            if 'name' in bo['config'] and not any(['name' in ba['config'] and ba['config']['name'] == bo['config']['name'] for ba in bindable]):
+                missing += 1
+                logger.warning(f"Configuration file missing for {owner}'s workflow {bo['config']['name']}")
+                bo['validation'] = {
+                    'is_valid': False,
+                    'errors': ["Configuration file missing"]
+                }
+            both.append(bo)
 
-    redis = RedisClient.get()
-    for workflow in both: redis.set(f"workflows/{owner}/{workflow['repo']['name']}", json.dumps(del_none(workflow)))
-    redis.set(f"workflows_updated/{owner}", timezone.now().timestamp())
-    logger.info(f"Added {len(bound)} bound, {len(bindable) - len(bound)} bindable, {len(both)} total to {owner}'s workflow cache" + (
-        "" if missing == 0 else f"({missing} with missing configuration files)"))
+        replace_cached_workflows(owner, both)
+        logger.info(f"Added {len(bound)} bound, {len(bindable) - len(bound)} bindable, {len(both)} total to {owner}'s workflow cache" + (
+            "" if missing == 0 else f"({missing} with missing configuration files)"))
 
 
 async def repopulate_public_workflow_cache(token: str):
-    redis = RedisClient.get()
-    public_workflows = await list_workflows(public=True)
-    encountered_users = []
-
-    for workflow, user in list(zip(public_workflows, [await get_workflow_user(workflow) for workflow in public_workflows])):
-        if user is None:
-            # workflow is not owned by any particular user (e.g., added by admins for shared GitHub group) so explicitly refresh the binding
-            logger.info(f"Binding unclaimed workflow {workflow.repo_owner}/{workflow.repo_name}")
-            bundle = await workflow_to_dict(workflow, token)
-            redis.set(f"workflows/{workflow.repo_owner}/{workflow.repo_name}", json.dumps(del_none(bundle)))
-        else:
-            # otherwise refresh all the workflow owner's workflows (but only once)
-            if user.username in encountered_users: continue
-            profile = await get_user_django_profile(user)
-            empty_personal_workflow_cache(profile.github_username)
-            await repopulate_personal_workflow_cache(profile.github_username)
-            encountered_users.append(user.username)
+    cached = RedisClient.get().hlen('workflow_bundles') > 0
+    async with single_flight_async('workflows/public', wait=not cached) as leader:
+        if not leader: return
+
+        redis = RedisClient.get()
+        public_workflows = await list_workflows(public=True)  # users and profiles come along in the same query
 
-    redis.set(f"public_workflows_updated", timezone.now().timestamp())
+        # workflows not owned by any particular user (e.g., added by admins for shared GitHub group) need their bindings explicitly refreshed
+        unclaimed = [workflow for workflow in public_workflows if workflow.user is None]
+        for workflow in unclaimed: logger.info(f"Binding unclaimed workflow {workflow.repo_owner}/{workflow.repo_name}")
 
+        async def bind_unclaimed():
+            pipeline = redis.pipeline()
+            for bundle in await workflows_to_dicts(unclaimed, token): cache_workflow(bundle['repo']['owner']['login'], bundle['repo']['name'], bundle, pipeline)
+            pipeline.execute()
+
+        # otherwise refresh all the workflow owners' workflows (once per owner, a few owners at a time)
+        owners = list(dict.fromkeys(workflow.user.profile.github_username for workflow in public_workflows
+                                     if workflow.user is not None and workflow.user.profile.github_username))
+        semaphore = asyncio.Semaphore(WORKFLOWS_REFRESH_CONCURRENCY)
+
+        async def repopulate(owner: str):
+            async with semaphore:
+                await repopulate_personal_workflow_cache(owner)
+
+        results = await asyncio.gather(bind_unclaimed(), *[repopulate(owner) for owner in owners], return_exceptions=True)
+        for owner, result in zip(['(unclaimed)'] + owners, results):
+            if isinstance(result, Exception): logger.warning(f"Failed to refresh workflows for {owner}: {result}")
+
+        redis.set(f"public_workflows_updated", timezone.now().timestamp())
+
+
+async def list_public_workflows(user: User, invalidate: bool = False) -> Tuple[List[dict], float]:
+    """
+    Returns: The public workflows (populated, if need be, with the requesting user's GitHub token), and the cache's age in seconds.
+    """
 
-async def list_public_workflows(token: str, invalidate: bool = False) -> List[dict]:
     redis = RedisClient.get()
-    updated = redis.get('public_workflows_updated')
+    age = get_cache_age('public_workflows_updated')
 
-    # repopulate if empty or invalidation requested
-    if updated is None or len(list(redis.scan_iter(match=f"workflows/*"))) == 0 or invalidate:
+    # repopulate inline if empty or invalidation requested, otherwise serve what we have (refreshing in the background if stale)
+    if age is None or redis.hlen('workflow_bundles') == 0 or invalidate:
         logger.info(f"Populating public workflow cache")
-        await repopulate_public_workflow_cache(token)
+        await repopulate_public_workflow_cache((await get_user_django_profile(user)).github_token)
+        age = 0
     else:
-        age = (datetime.now() - datetime.fromtimestamp(float(updated)))
-        age_secs = age.total_seconds()
-        max_secs = (int(settings.WORKFLOWS_REFRESH_MINUTES) * 60)
+        # the refresh looks the token up itself, since task arguments are kept in the broker and logged
+        revalidate_cache('public_workflows', age, get_workflow_cache_max_age(), 'plantit.celery_tasks.refresh_all_workflows', [user.username])
 
-        # otherwise only if stale
-        if age_secs > max_secs:
-            logger.info(f"Public workflow cache is stale ({age_secs}s old, {age_secs - max_secs}s past limit), repopulating")
-            await repopulate_public_workflow_cache(token)
+    return list_cached_workflows(public=True), age
 
-    workflows = [json.loads(redis.get(key)) for key in redis.scan_iter(match='workflows/*')]
-    return [workflow for workflow in workflows if workflow['public']]
 
+async def list_personal_workflows(owner: str, invalidate: bool = False) -> Tuple[List[dict], float]:
+    """
+    Returns: The owner's workflows, and the cache's age in seconds.
+    """
 
-async def list_personal_workflows(owner: str, invalidate: bool = False) -> List[dict]:
     redis = RedisClient.get()
-    updated = redis.get(f"workflows_updated/{owner}")
+    age = get_cache_age(f"workflows_updated/{owner}")
 
-    # repopulate if empty or invalidation requested
-    if updated is None or len(list(redis.scan_iter(match=f"workflows/{owner}/*"))) == 0 or invalidate:
+    # repopulate inline if empty or invalidation requested, otherwise serve what we have (refreshing in the background if stale)
+    if age is None or redis.scard(f"workflow_owners/{owner}") == 0 or invalidate:
         await repopulate_personal_workflow_cache(owner)
+        age = 0
     else:
-        age = (datetime.now() - datetime.fromtimestamp(float(updated)))
-        age_secs = age.total_seconds()
-        max_secs = (int(settings.WORKFLOWS_REFRESH_MINUTES) * 60)
-
-        # otherwise only if stale
-        if age_secs > max_secs:
-            logger.info(f"GitHub user {owner}'s workflow cache is stale ({age_secs}s old, {age_secs - max_secs}s past limit), repopulating")
-            await repopulate_personal_workflow_cache(owner)
+        revalidate_cache(f"workflows/{owner}", age, get_workflow_cache_max_age(), 'plantit.celery_tasks.refresh_personal_workflows', [owner])
 
-    return [json.loads(redis.get(key)) for key in redis.scan_iter(match=f"workflows/{owner}/*")]
+    return list_cached_workflows(owner=owner), age
 
 
 async def get_workflow(owner: str, name: str, token: str, invalidate: bool = False) -> dict:
     redis = RedisClient.get()
     updated = redis.get(f"workflows_updated/{owner}")
-    workflow = redis.get(f"workflows/{owner}/{name}")
+    workflow = get_cached_workflow(owner, name)
 
     if updated is None or workflow is None or invalidate:
         try:
@@ -484,20 +769,132 @@ async def get_workflow(owner: str, name: str, token: str, invalidate: bool = Fal
             raise ValueError(f"Workflow {owner}/{name} not found")
 
         workflow = await workflow_to_dict(workflow, token)
-        redis.set(f"workflows/{owner}/{name}", json.dumps(del_none(workflow)))
+        cache_workflow(owner, name, workflow)
 
     return workflow
 
 
+def get_workflow_cache_max_age() -> int:
+    # with a webhook secret configured, GitHub tells us when workflows change, so the cache rarely needs a full refresh
+    if settings.GITHUB_WEBHOOK_SECRET: return WORKFLOWS_WEBHOOK_REFRESH_MINUTES * 60
+    return int(settings.WORKFLOWS_REFRESH_MINUTES) * 60
+
+
+async def refresh_workflow_cache(owner: str, name: str):
+    """
+    Refreshes a single workflow's cached bundle (e.g., when GitHub notifies us of a push to its repository).
+
+    Returns: The refreshed bundle, or None if the workflow is neither bound nor cached.
+    """
+
+    workflow = await sync_to_async(Workflow.objects.filter(repo_owner=owner, repo_name=name).select_related('user__profile').first)()
+
+    if workflow is not None:
+        # workflows not owned by any particular user (e.g., added by admins for shared GitHub group) are fetched anonymously
+        token = workflow.user.profile.github_token if workflow.user is not None else ''
+        bundle = await workflow_to_dict(workflow, token)
+    elif get_cached_workflow(owner, name) is not None:
+        # bindable (but not yet bound) repository in the owner's personal cache
+        profile = await sync_to_async(Profile.objects.filter(github_username=owner).first)()
+        bundle = await github.get_repo_bundle(owner, name, profile.github_token if profile is not None else '')
+        if isinstance(bundle['repo'], Exception): raise bundle['repo']
+        bundle['public'] = False
+        bundle['bound'] = False
+    else:
+        logger.info(f"Workflow {owner}/{name} is neither bound nor cached, not refreshing")
+        return None
+
+    cache_workflow(owner, name, bundle)
+    logger.info(f"Refreshed workflow {owner}/{name}")
+    return bundle
+
+
 def empty_personal_workflow_cache(owner: str):
     redis = RedisClient.get()
-    keys = list(redis.scan_iter(match=f"workflows/{owner}/*"))
-    cleaned = len(keys)
-    for key in keys: redis.delete(key)
+    names = [name.decode() for name in redis.smembers(f"workflow_owners/{owner}")]
+    cleaned = len(names)
+    pipeline = redis.pipeline()
+    if cleaned > 0:
+        pipeline.hdel('workflow_bundles', *[f"{owner}/{name}" for name in names])
+        pipeline.srem('workflow_public', *[f"{owner}/{name}" for name in names])
+        LocalCache.invalidate([f"workflow_bundles/{owner}/{name}" for name in names], pipeline)
+    pipeline.delete(f"workflow_owners/{owner}")
+    pipeline.execute()
     logger.info(f"Emptied {cleaned} workflows from GitHub user {owner}'s cache")
     return cleaned
 
 
+# Cached workflow bundles are stored as JSON in the `workflow_bundles` hash, keyed by "owner/name". The `workflow_owners/{owner}`
+# sets (of repository names) and the `workflow_public` set (of "owner/name") index them, so listings never need to scan the keyspace.
+
+def cache_workflow(owner: str, name: str, bundle: dict, pipeline=None):
+    redis = pipeline if pipeline is not None else RedisClient.get().pipeline()
+    redis.hset('workflow_bundles', f"{owner}/{name}", encode(del_none({**bundle, 'repo': github.trim_repo(bundle['repo'])})))
+    redis.sadd(f"workflow_owners/{owner}", name)
+    if bundle.get('public', False): redis.sadd('workflow_public', f"{owner}/{name}")
+    else: redis.srem('workflow_public', f"{owner}/{name}")
+    LocalCache.invalidate([f"workflow_bundles/{owner}/{name}"], redis)
+    if pipeline is None: redis.execute()
+
+
+def replace_cached_workflows(owner: str, bundles: List[dict]):
+    """
+    Swaps the owner's cached workflows for the given bundles in a single transaction, so readers see either the old set or the new one.
+    """
+
+    names = set(bundle['repo']['name'] for bundle in bundles)
+    index = f"workflow_owners/{owner}"
+
+    def swap(pipeline):
+        stale = [f"{owner}/{name.decode()}" for name in pipeline.smembers(index) if name.decode() not in names]
+        pipeline.multi()
+        if len(stale) > 0:
+            pipeline.hdel('workflow_bundles', *stale)
+            pipeline.srem('workflow_public', *stale)
+            LocalCache.invalidate([f"workflow_bundles/{key}" for key in stale], pipeline)
+        pipeline.delete(index)
+        for bundle in bundles: cache_workflow(owner, bundle['repo']['name'], bundle, pipeline)
+        pipeline.set(f"workflows_updated/{owner}", timezone.now().timestamp())
+
+    # retried if the index changes (e.g., a workflow is bound) while we're reading it
+    RedisClient.get().transaction(swap, index)
+
+
+def get_cached_workflow(owner: str, name: str):
+    bundles = get_cached_bundles([f"{owner}/{name}"])
+    return bundles[0] if len(bundles) > 0 else None
+
+
+def get_cached_workflows(workflows: List[Workflow]) -> List[dict]:
+    return get_cached_bundles([f"{workflow.repo_owner}/{workflow.repo_name}" for workflow in workflows])
+
+
+def list_cached_workflows(owner: str = None, public: bool = False) -> List[dict]:
+    redis = RedisClient.get()
+    if owner is not None: keys = sorted(f"{owner}/{name.decode()}" for name in redis.smembers(f"workflow_owners/{owner}"))
+    elif public: keys = sorted(key.decode() for key in redis.smembers('workflow_public'))
+    else: keys = sorted(key.decode() for key in redis.hkeys('workflow_bundles'))
+    return get_cached_bundles(keys)
+
+
+def get_cached_bundles(keys: List[str]) -> List[dict]:
+    """
+    Reads the given ("owner/name") workflow bundles, from this process's local cache where possible and otherwise with a single
+    HMGET. Bundles which aren't cached (e.g., index entries whose bundles have since been removed) are skipped.
+    """
+
+    bundles = {key: LocalCache.get(f"workflow_bundles/{key}") for key in keys}
+    missing = [key for key, bundle in bundles.items() if bundle is None]
+    if len(missing) > 0:
+        generation = LocalCache.generation()
+        for key, bundle in zip(missing, RedisClient.get().hmget('workflow_bundles', missing)):
+            if bundle is None: continue
+            bundles[key] = decode(bundle)
+            LocalCache.put(f"workflow_bundles/{key}", bundles[key], generation)
+
+    return [bundles[key] for key in keys if bundles[key] is not None]
+
+
 # tasks
 
 @sync_to_async
@@ -595,7 +992,7 @@ def parse_task_cli_options(task: Task) -> (List[str], PlantITCLIOptions):
         image = config['image']
         if 'docker' in image:
             image_owner, image_name, image_tag = parse_image_components(image)
-            if not image_exists(image_name, image_owner, image_tag):
+            if image_exists(image_name, image_owner, image_tag) is False:
                 errors.append(f"Image '{image}' not found on Docker Hub")
 
     work_dir = None
@@ -656,7 +1053,8 @@ def parse_task_cli_options(task: Task) -> (List[str], PlantITCLIOptions):
         if kind == 'file':
             input = Input(path=path, kind='file')
         elif kind == 'files':
-            input = Input(path=path, kind='files', patterns=config['input']['patterns'] if 'patterns' in config['input'] else None)
+            patterns = config['input']['filetypes'] if 'filetypes' in config['input'] else config['input']['patterns'] if 'patterns' in config['input'] else None
+            input = Input(path=path, kind='files', patterns=patterns)
         elif kind == 'directory':
             input = Input(path=path, kind='directory')
         else:
@@ -754,6 +1152,7 @@ def create_task(username: str, agent_name: str, workflow: dict, name: str = None
                 study: str = None):
     repo_owner = workflow['repo']['owner']['login']
     repo_name = workflow['repo']['name']
+    repo_sha = workflow.get('sha', None)  # the commit the configuration was read from
     agent = Agent.objects.get(name=agent_name)
     user = User.objects.get(username=username)
     if guid is None: guid = str(uuid.uuid4())  # if the browser client hasn't set a GUID, create one
@@ -770,6 +1169,7 @@ def create_task(username: str, agent_name: str, workflow: dict, name: str = None
         workflow=workflow,
         workflow_owner=repo_owner,
         workflow_name=repo_name,
+        workflow_sha=repo_sha,
         agent=agent,
         status=TaskStatus.CREATED,
         created=now,
@@ -786,6 +1186,7 @@ def create_task(username: str, agent_name: str, workflow: dict, name: str = None
             workflow=workflow,
             workflow_owner=repo_owner,
             workflow_name=repo_name,
+            workflow_sha=repo_sha,
             agent=agent,
             status=TaskStatus.CREATED,
             created=now,
@@ -800,7 +1201,7 @@ def create_task(username: str, agent_name: str, workflow: dict, name: str = None
     # add repo logo
     if 'logo' in workflow['config']:
         logo_path = workflow['config']['logo']
-        task.workflow_image_url = f"https://raw.githubusercontent.com/{repo_name}/{repo_owner}/master/{logo_path}"
+        task.workflow_image_url = f"https://raw.githubusercontent.com/{repo_owner}/{repo_name}/{repo_sha if repo_sha is not None else 'HEAD'}/{logo_path}"
 
     for tag in workflow['config']['tags']: task.tags.add(tag)  # add task tags
     task.workdir = f"{task.guid}/"  # use GUID for working directory name
@@ -939,20 +1340,12 @@ def compose_task_pull_command(task: Task, options: PlantITCLIOptions) -> str:
     if input is None: return ''
     kind = input['kind']
 
-    if input['kind'] != InputKind.FILE and 'patterns' in input:
-        # allow for both spellings of JPG
-        patterns = [pattern.lower() for pattern in input['patterns']]
-        if 'jpg' in patterns and 'jpeg' not in patterns:
-            patterns.append("jpeg")
-        elif 'jpeg' in patterns and 'jpg' not in patterns:
-            patterns.append("jpg")
-    else:
-        patterns = []
+    patterns = terrain.filetype_patterns(input['patterns']) if input['kind'] != InputKind.FILE and 'patterns' in input else []
 
     command = f"plantit terrain pull \"{input['path']}\"" \
               f" -p \"{join(task.agent.workdir, task.workdir, 'input')}\"" \
               f" {' '.join(['--pattern ' + pattern for pattern in patterns])}" \
-              f""f" --terrain_token {task.user.profile.cyverse_access_token}"
+              f""f" --terrain_token {get_user_cyverse_token(task.user)}"
 
     if task.agent.callbacks:
         callback_url = settings.API_URL + 'tasks/' + task.guid + '/status/'
@@ -962,7 +1355,7 @@ def compose_task_pull_command(task: Task, options: PlantITCLIOptions) -> str:
     return command
 
 
-def compose_task_run_commands(task: Task, options: PlantITCLIOptions, inputs: List[str]) -> List[str]:
+def compose_task_run_commands(task: Task, options: PlantITCLIOptions, input_count: int) -> List[str]:
     docker_username = environ.get('DOCKER_USERNAME', None)
     docker_password = environ.get('DOCKER_PASSWORD', None)
     commands = []
@@ -975,7 +1368,7 @@ def compose_task_run_commands(task: Task, options: PlantITCLIOptions, inputs: Li
     # otherwise use the CLI
     else:
         command = f"plantit run {task.guid}.yaml"
-        if task.agent.job_array and len(inputs) > 0:
+        if task.agent.job_array and input_count > 0:
             command += f" --slurm_job_array"
 
         if docker_username is not None and docker_password is not None:
@@ -1054,22 +1447,27 @@ def compose_task_run_script(task: Task, options: PlantITCLIOptions, template: st
     if 'input' in options and options['input'] is not None:
         kind = options['input']['kind']
         path = options['input']['path']
-        cyverse_token = task.user.profile.cyverse_access_token
-        inputs = [terrain.get_file(path, cyverse_token)] if kind == InputKind.FILE else terrain.list_dir(path, cyverse_token)
+        cyverse_token = get_user_cyverse_token(task.user)
+        if kind == InputKind.FILE:
+            terrain.get_file(path, cyverse_token)
+            input_count = 1
+        else:
+            # count rather than list, some input collections are too large to hold in memory
+            input_count = terrain.count_dir(path, cyverse_token, options['input'].get('patterns', None))
     else:
-        inputs = []
+        input_count = 0
 
-    resource_requests = [] if task.agent.executor == AgentExecutor.LOCAL else compose_jobqueue_task_resource_requests(task, options, inputs)
+    resource_requests = [] if task.agent.executor == AgentExecutor.LOCAL else compose_jobqueue_task_resource_requests(task, options, input_count)
     pull_command = compose_task_pull_command(task, options)
-    run_commands = compose_task_run_commands(task, options, inputs)
+    run_commands = compose_task_run_commands(task, options, input_count)
     zip_command = compose_task_zip_command(task, options)
     push_command = compose_task_push_command(task, options)
 
     return template_header + resource_requests + [task.agent.pre_commands] + [pull_command] + run_commands + [zip_command] + [push_command]
 
 
-def compose_jobqueue_task_resource_requests(task: JobQueueTask, options: PlantITCLIOptions, inputs: List[str]) -> List[str]:
-    nodes = min(len(inputs), task.agent.max_nodes) if inputs is not None and not task.agent.job_array else 1
+def compose_jobqueue_task_resource_requests(task: JobQueueTask, options: PlantITCLIOptions, input_count: int) -> List[str]:
+    nodes = min(input_count, task.agent.max_nodes) if input_count > 0 and not task.agent.job_array else 1
 
     if 'jobqueue' not in options: return []
     gpu = task.agent.gpu and ('gpu' in options and options['gpu'])
@@ -1086,7 +1484,7 @@ def compose_jobqueue_task_resource_requests(task: JobQueueTask, options: PlantIT
         walltime = timedelta(hours=hours, minutes=minutes, seconds=seconds)
 
         # adjust walltime to compensate for inputs processed in parallel [requested walltime * input files / nodes]
-        adjusted = walltime * (len(inputs) / nodes) if len(inputs) > 0 else walltime
+        adjusted = walltime * (input_count / nodes) if input_count > 0 else walltime
 
         # round up to the nearest hour
         hours = f"{min(ceil(adjusted.total_seconds() / 60 / 60), task.agent.max_nodes)}"
@@ -1103,9 +1501,9 @@ def compose_jobqueue_task_resource_requests(task: JobQueueTask, options: PlantIT
     if task.agent.queue is not None and task.agent.queue != '': commands.append(
         f"#SBATCH --partition={task.agent.gpu_queue if gpu else task.agent.queue}")
     if task.agent.project is not None and task.agent.project != '': commands.append(f"#SBATCH -A {task.agent.project}")
-    if len(inputs) > 0 and options['input']['kind'] == 'files':
+    if input_count > 0 and options['input']['kind'] == 'files':
         if task.agent.job_array:
-            commands.append(f"#SBATCH --array=1-{len(inputs)}")
+            commands.append(f"#SBATCH --array=1-{input_count}")
         commands.append(f"#SBATCH -N {nodes}")
         commands.append(f"#SBATCH --ntasks={nodes}")
     else:
@@ -1434,6 +1832,7 @@ def transfer_task_results_to_cyverse(task: Task, auth: dict, path: str):
     # workflow = redis.get(f"workflows/{task.workflow_owner}/{task.workflow_name}")
     # workflow = json.loads(workflow)
     workflow = task.workflow
+    token = get_user_cyverse_token(task.user)
 
     with ssh:
         with ssh.client.open_sftp() as sftp:
@@ -1445,17 +1844,19 @@ def transfer_task_results_to_cyverse(task: Task, auth: dict, path: str):
                 local_dir = tempfile.gettempdir()
                 local_path = join(local_dir, file['name'])
                 sftp.get(file['name'], local_path)
-                terrain.push_file(local_path, path, task.user.profile.cyverse_access_token)
+                terrain.push_file(local_path, path, token)
 
 
-def list_task_input_files(task: Task, options: PlantITCLIOptions) -> List[str]:
-    input_files = terrain.list_dir(options['input']['path'], task.user.profile.cyverse_access_token)
-    msg = f"Found {len(input_files)} input file(s)"
+def list_task_input_files(task: Task, options: PlantITCLIOptions) -> Iterator[str]:
+    path = options['input']['path']
+    patterns = options['input'].get('patterns', None)
+    token = get_user_cyverse_token(task.user)
+    msg = f"Found {terrain.count_dir(path, token, patterns)} input file(s)"
     log_task_status(task, [msg])
     async_to_sync(push_task_event)(task)
     logger.info(msg)
 
-    return input_files
+    return (file['path'] for file in terrain.iter_dir(path, token, filetypes=patterns))
 
 
 def get_task_ssh_client(task: Task, auth: dict) -> SSH:
@@ -1521,6 +1922,7 @@ def task_to_dict(task: Task) -> dict:
         'cleanup_time': None if task.cleanup_time is None else task.cleanup_time.isoformat(),
         'workflow_owner': task.workflow_owner,
         'workflow_name': task.workflow_name,
+        'workflow_sha': task.workflow_sha,
         'tags': [str(tag) for tag in task.tags.all()],
         'is_complete': task.is_complete,
         'is_success': task.is_success,
@@ -1531,7 +1933,7 @@ def task_to_dict(task: Task) -> dict:
         'result_previews_loaded': task.previews_loaded,
         'cleaned_up': task.cleaned_up,
         'transferred': task.transferred,
-        'output_files': json.loads(results) if results is not None else []
+        'output_files': decode(results) if results is not None else []
     }
 
     if isinstance(task, JobQueueTask):
@@ -1661,7 +2063,6 @@ def agent_to_dict_async(agent: Agent, user: User = None):
 
 def agent_to_dict(agent: Agent, user: User = None) -> dict:
     tasks = AgentTask.objects.filter(agent=agent)
-    redis = RedisClient.get()
     users_authorized = agent.users_authorized.all() if agent.users_authorized is not None else []
     workflows_authorized = agent.workflows_authorized.all() if agent.workflows_authorized is not None else []
     workflows_blocked = agent.workflows_blocked.all() if agent.workflows_blocked is not None else []
@@ -1693,8 +2094,8 @@ def agent_to_dict(agent: Agent, user: User = None) -> dict:
             'last_name': user.last_name,
             'github_profile': async_to_sync(get_user_github_profile)(user)
         } for user in users_authorized if user is not None],
-        'workflows_authorized': [json.loads(redis.get(f"workflows/{workflow.repo_owner}/{workflow.repo_name}")) for workflow in workflows_authorized],
-        'workflows_blocked': [json.loads(redis.get(f"workflows/{workflow.repo_owner}/{workflow.repo_name}")) for workflow in workflows_blocked]
+        'workflows_authorized': get_cached_workflows(workflows_authorized),
+        'workflows_blocked': get_cached_workflows(workflows_blocked)
     }
 
     if agent.user is not None: mapped['user'] = agent.user.username
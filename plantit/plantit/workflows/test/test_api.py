@@ -0,0 +1,139 @@
+import hashlib
+import hmac
+import json
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.urls import resolve
+
+from plantit.redis import RedisClient
+from plantit.users.models import Profile
+from plantit.utils import list_public_workflows
+from plantit.workflows.views import hook
+
+SECRET = 'secret'
+
+
+def sign(body: bytes, secret: str = SECRET) -> str:
+    return 'sha256=' + hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+
+def push(ref: str = 'refs/heads/master', files: list = None) -> dict:
+    return {
+        'ref': ref,
+        'after': 'abc123',
+        'repository': {'full_name': 'owner/workflow', 'default_branch': 'master'},
+        'commits': [{'added': [], 'modified': files if files is not None else ['plantit.yaml'], 'removed': []}]
+    }
+
+
+@override_settings(GITHUB_WEBHOOK_SECRET=SECRET)
+class GitHubHookTests(TestCase):
+    url = '/apis/v1/hooks/github/'
+
+    def deliver(self, payload: dict, event: str = 'push', signature: str = None):
+        body = json.dumps(payload).encode('utf-8')
+        with mock.patch('plantit.workflows.views.refresh_workflow') as refresh_workflow:
+            response = self.client.post(
+                self.url,
+                data=body,
+                content_type='application/json',
+                HTTP_X_GITHUB_EVENT=event,
+                HTTP_X_HUB_SIGNATURE_256=signature if signature is not None else sign(body))
+        return response, refresh_workflow
+
+    def test_bad_signature_is_rejected(self):
+        response, refresh_workflow = self.deliver(push(), signature=sign(b'something else'))
+        self.assertEqual(403, response.status_code)
+        refresh_workflow.s.assert_not_called()
+
+    def test_missing_signature_is_rejected(self):
+        response, refresh_workflow = self.deliver(push(), signature='')
+        self.assertEqual(403, response.status_code)
+        refresh_workflow.s.assert_not_called()
+
+    @override_settings(GITHUB_WEBHOOK_SECRET=None)
+    def test_not_found_without_secret(self):
+        response, _ = self.deliver(push())
+        self.assertEqual(404, response.status_code)
+
+    def test_ping_is_acknowledged(self):
+        response, refresh_workflow = self.deliver({'zen': 'Keep it logically awesome.'}, event='ping')
+        self.assertEqual(200, response.status_code)
+        refresh_workflow.s.assert_not_called()
+
+    def test_other_events_are_ignored(self):
+        response, refresh_workflow = self.deliver(push(), event='issues')
+        self.assertEqual(204, response.status_code)
+        refresh_workflow.s.assert_not_called()
+
+    def test_malformed_push_is_rejected(self):
+        response, refresh_workflow = self.deliver({'ref': 'refs/heads/master'})
+        self.assertEqual(400, response.status_code)
+        refresh_workflow.s.assert_not_called()
+
+    def test_push_without_default_branch_is_rejected(self):
+        payload = push()
+        del payload['repository']['default_branch']
+        response, refresh_workflow = self.deliver(payload)
+        self.assertEqual(400, response.status_code)
+        refresh_workflow.s.assert_not_called()
+
+    def test_push_with_malformed_repository_is_rejected(self):
+        response, refresh_workflow = self.deliver({**push(), 'repository': 'owner/workflow'})
+        self.assertEqual(400, response.status_code)
+        refresh_workflow.s.assert_not_called()
+
+    def test_push_to_other_branch_is_ignored(self):
+        response, refresh_workflow = self.deliver(push(ref='refs/heads/feature'))
+        self.assertEqual(204, response.status_code)
+        refresh_workflow.s.assert_not_called()
+
+    def test_push_without_watched_files_is_ignored(self):
+        response, refresh_workflow = self.deliver(push(files=['src/main.py']))
+        self.assertEqual(204, response.status_code)
+        refresh_workflow.s.assert_not_called()
+
+    def test_push_changing_config_schedules_refresh(self):
+        response, refresh_workflow = self.deliver(push(files=['plantit.yaml']))
+        self.assertEqual(202, response.status_code)
+        refresh_workflow.s.assert_called_once_with('owner', 'workflow')
+        refresh_workflow.s.return_value.apply_async.assert_called_once()
+
+    def test_push_changing_readme_schedules_refresh(self):
+        response, refresh_workflow = self.deliver(push(files=['README.md']))
+        self.assertEqual(202, response.status_code)
+        refresh_workflow.s.assert_called_once_with('owner', 'workflow')
+
+    def test_hook_does_not_shadow_owner_named_hook(self):
+        self.assertEqual(hook, resolve(self.url).func)
+        self.assertNotEqual(hook, resolve('/apis/v1/workflows/hook/').func)
+
+
+class PublicWorkflowsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='viewer', password='password')
+        Profile.objects.create(user=self.user, github_token='secret')
+
+    def tearDown(self):
+        RedisClient.get().delete('workflow_bundles', 'public_workflows_updated', 'cache_refreshes/public_workflows')
+
+    def test_stale_cache_refresh_is_scheduled_without_the_token(self):
+        redis = RedisClient.get()
+        redis.hset('workflow_bundles', 'owner/workflow', '{}')
+        redis.set('public_workflows_updated', timezone.now().timestamp() - 60 * 60 * 24 * 365)
+        with mock.patch('plantit.utils.app.send_task') as send_task, \
+             mock.patch('plantit.utils.list_cached_workflows', return_value=[]):
+            async_to_sync(list_public_workflows)(self.user)
+        send_task.assert_called_once_with('plantit.celery_tasks.refresh_all_workflows', args=['viewer'])
+
+    def test_refresh_looks_up_the_token(self):
+        from plantit.celery_tasks import refresh_all_workflows
+
+        with mock.patch('plantit.celery_tasks.repopulate_public_workflow_cache') as repopulate:
+            refresh_all_workflows('viewer')
+            refresh_all_workflows('nobody')
+        repopulate.assert_called_once_with('secret')
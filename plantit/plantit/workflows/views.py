@@ -1,15 +1,20 @@
+import hashlib
+import hmac
 import json
 import logging
+import re
 
 from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse, HttpResponseNotFound, HttpResponseForbidden
+from django.http import JsonResponse, HttpResponseNotFound, HttpResponseForbidden, HttpResponse, HttpResponseBadRequest
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
+from plantit.celery_tasks import refresh_workflow
 from plantit.github import get_repo_readme, get_repo
-from plantit.redis import RedisClient
 from plantit.utils import get_user_django_profile, list_public_workflows, list_personal_workflows, get_workflow, \
-    workflow_to_dict
-from plantit.misc import del_none
+    workflow_to_dict, cache_workflow, get_cached_workflow, list_cached_workflows
 from plantit.users.models import Profile
 from plantit.workflows.models import Workflow
 
@@ -17,15 +22,20 @@ logger = logging.getLogger(__name__)
 
 # TODO: when this (https://code.djangoproject.com/ticket/31949) gets merged, remove the sync_to_async/async_to_sync hack
 
+# files whose changes affect a workflow's cached bundle (the configuration file and the README, at the repository root)
+WEBHOOK_WATCHED_FILES = re.compile(r'^(plantit\.yaml|readme(\.[a-z]+)?)$', re.IGNORECASE)
+
+# GitHub truncates push payloads' commit lists, so beyond this many we can't tell which files changed
+WEBHOOK_MAX_COMMITS = 20
+
 
 @sync_to_async
 @login_required
 @async_to_sync
 async def list_public(request):
-    profile = await get_user_django_profile(request.user)
     invalidate = request.GET.get('invalidate', False)
-    bundles = await list_public_workflows(token=profile.github_token, invalidate=bool(invalidate))
-    return JsonResponse({'workflows': bundles})
+    bundles, age = await list_public_workflows(request.user, invalidate=bool(invalidate))
+    return JsonResponse({'workflows': bundles, 'age': age})
 
 
 @sync_to_async
@@ -40,8 +50,8 @@ async def list_personal(request, owner):
             return HttpResponseNotFound()
 
     invalidate = request.GET.get('invalidate', False)
-    bundles = await list_personal_workflows(owner=owner, invalidate=bool(invalidate))
-    return JsonResponse({'workflows': bundles})
+    bundles, age = await list_personal_workflows(owner=owner, invalidate=bool(invalidate))
+    return JsonResponse({'workflows': bundles, 'age': age})
 
 
 @sync_to_async
@@ -72,19 +82,19 @@ async def refresh(request, owner, name):
     except:
         return HttpResponseNotFound()
 
-    redis = RedisClient.get()
     profile = await get_user_django_profile(request.user)
     bundle = await workflow_to_dict(workflow, profile.github_token)
-    redis.set(f"workflows/{owner}/{name}", json.dumps(del_none(bundle)))
+    cache_workflow(owner, name, bundle)
     logger.info(f"Refreshed workflow {owner}/{name}")
     return JsonResponse(bundle)
 
 
-# @sync_to_async
+@sync_to_async
 @login_required
-# @async_to_sync
-def readme(request, owner, name):
-    rm = get_repo_readme(name, owner, request.user.profile.github_token)
+@async_to_sync
+async def readme(request, owner, name):
+    profile = await get_user_django_profile(request.user)
+    rm = await get_repo_readme(owner, name, profile.github_token)
     return JsonResponse({'readme': rm})
 
 
@@ -101,13 +111,12 @@ async def toggle_public(request, owner, name):
     except:
         return HttpResponseNotFound()
 
-    redis = RedisClient.get()
     workflow.public = not workflow.public
     await sync_to_async(workflow.save)()
     bundle = await workflow_to_dict(workflow, profile.github_token)
-    redis.set(f"workflows/{owner}/{name}", json.dumps(del_none(bundle)))
+    cache_workflow(owner, name, bundle)
     logger.info(f"Workflow {owner}/{name} is now {'public' if workflow.public else 'private'}")
-    return JsonResponse({'workflows': [json.loads(redis.get(key)) for key in redis.scan_iter(match=f"workflows/{owner}/*")]})
+    return JsonResponse({'workflows': list_cached_workflows(owner=owner)})
 
 
 @login_required
@@ -115,13 +124,13 @@ def bind(request, owner, name):
     if owner != request.user.profile.github_username:
         return HttpResponseForbidden()
 
-    redis = RedisClient.get()
     body = json.loads(request.body.decode('utf-8'))
     body['bound'] = True
-    redis.set(f"workflows/{owner}/{name}", json.dumps(del_none(body)))
+    body['public'] = False
+    cache_workflow(owner, name, body)
     Workflow.objects.create(user=request.user, repo_owner=owner, repo_name=name, public=False)
     logger.info(f"Created binding for workflow {owner}/{name} as {body['config']['name']}")
-    return JsonResponse({'workflows': [json.loads(redis.get(key)) for key in redis.scan_iter(match=f"workflows/{owner}/*")]})
+    return JsonResponse({'workflows': list_cached_workflows(owner=owner)})
 
 
 @login_required
@@ -135,10 +144,47 @@ def unbind(request, owner, name):
         return HttpResponseNotFound()
 
     workflow.delete()
-    redis = RedisClient.get()
-    cached = json.loads(redis.get(f"workflows/{owner}/{name}"))
-    cached['public'] = False
-    cached['bound'] = False
-    redis.set(f"workflows/{owner}/{name}", json.dumps(del_none(cached)))
+    cached = get_cached_workflow(owner, name)
+    if cached is not None: cache_workflow(owner, name, {**cached, 'public': False, 'bound': False})
     logger.info(f"Removed binding for workflow {owner}/{name}")
-    return JsonResponse({'workflows': [json.loads(redis.get(key)) for key in redis.scan_iter(match=f"workflows/{owner}/*")]})
+    return JsonResponse({'workflows': list_cached_workflows(owner=owner)})
+
+
+@csrf_exempt
+@require_POST
+def hook(request):
+    secret = settings.GITHUB_WEBHOOK_SECRET
+    if not secret: return HttpResponseNotFound()
+
+    # verify the payload was signed with our secret
+    signature = request.headers.get('X-Hub-Signature-256', '')
+    expected = 'sha256=' + hmac.new(secret.encode('utf-8'), request.body, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(signature, expected):
+        logger.warning(f"Rejected GitHub webhook delivery {request.headers.get('X-GitHub-Delivery')} with bad signature")
+        return HttpResponseForbidden()
+
+    event = request.headers.get('X-GitHub-Event')
+    if event == 'ping': return HttpResponse()
+    if event != 'push': return HttpResponse(status=204)
+
+    try:
+        payload = json.loads(request.body.decode('utf-8'))
+        repository = payload['repository']
+        owner, name = repository['full_name'].split('/')
+        default_branch = repository['default_branch']
+        ref = payload['ref']
+        commits = payload.get('commits', [])
+    except (ValueError, KeyError, TypeError):
+        return HttpResponseBadRequest()
+
+    # we only read configuration files from the default branch
+    if ref != f"refs/heads/{default_branch}": return HttpResponse(status=204)
+
+    changed = [file for commit in commits for file in commit.get('added', []) + commit.get('modified', []) + commit.get('removed', [])]
+    if len(commits) < WEBHOOK_MAX_COMMITS and not any(WEBHOOK_WATCHED_FILES.match(file) for file in changed):
+        return HttpResponse(status=204)
+
+    # refresh in the background so GitHub isn't left waiting on us
+    refresh_workflow.s(owner, name).apply_async()
+    logger.info(f"Scheduled refresh for workflow {owner}/{name} (push {payload.get('after')})")
+    return HttpResponse(status=202)
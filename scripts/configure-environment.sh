@@ -146,6 +146,7 @@ GITHUB_AUTH_URI=https://github.com/login/oauth/authorize
 GITHUB_REDIRECT_URI=http://localhost:3000/apis/v1/users/github_handle_temporary_code/
 GITHUB_KEY=$github_client_id
 GITHUB_SECRET=$github_secret
+GITHUB_WEBHOOK_SECRET=${GITHUB_WEBHOOK_SECRET}
 GITHUB_CLIENT_ID=d15df2f5710e9597290f
 DOCKER_USERNAME=$docker_username
 DOCKER_PASSWORD=$docker_password